@@ -0,0 +1,184 @@
+import click
+from datetime import datetime, timedelta
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import case, delete, func, insert, select
+from db import db
+from models import Appointment, Bill, BillAgingSnapshot, Doctor
+
+# Accounts receivable aging. Outstanding (not Paid) bills bucketed by how many
+# days ago they were raised, per doctor of the appointment they bill for and per
+# specialization. Computed with one grouped query off ix_bills_status_created;
+# `flask aging-snapshot`, run nightly, saves the result so that with
+# AGING_FROM_SNAPSHOT GET /bills/aging only reads a few saved rows during the day.
+#
+# POST /appointments used to save its bill before the appointment had an id, so
+# those bills have no appointment_id (and say "Bill for appointment None").
+# `flask link-appointment-bills` links them back where the appointment is clear.
+
+BUCKETS = ('0-30', '31-60', '61-90', '90+')
+
+
+def compute(now):
+    """(doctor_id, specialization, bucket, bill count, amount) of outstanding bills
+    as of now. Bills not raised for an appointment have no doctor."""
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    bucket = case(
+        (Bill.creation_date >= today - timedelta(days=30), BUCKETS[0]),
+        (Bill.creation_date >= today - timedelta(days=60), BUCKETS[1]),
+        (Bill.creation_date >= today - timedelta(days=90), BUCKETS[2]),
+        else_=BUCKETS[3],
+    ).label('bucket')
+    return db.session.execute(
+        select(Appointment.doctor_id, Doctor.specialization, bucket, func.count(), func.sum(Bill.amount))
+        .select_from(Bill)
+        .outerjoin(Appointment, Appointment.id == Bill.appointment_id)
+        .outerjoin(Doctor, Doctor.id == Appointment.doctor_id)
+        .where(Bill.status != 'Paid')
+        .group_by(Appointment.doctor_id, Doctor.specialization, bucket),
+        # Bills for deleted doctors are still owed
+        execution_options={'include_deleted': True},
+    ).all()
+
+
+def latest_snapshot(max_age_hours, now):
+    """(taken_at, rows like compute's) of the newest snapshot younger than
+    max_age_hours, or None."""
+    taken_at = db.session.execute(select(func.max(BillAgingSnapshot.taken_at))).scalar()
+    if taken_at is None or now - taken_at > timedelta(hours=max_age_hours):
+        return None
+    rows = db.session.execute(
+        select(BillAgingSnapshot.doctor_id, BillAgingSnapshot.specialization, BillAgingSnapshot.bucket,
+               BillAgingSnapshot.bill_count, BillAgingSnapshot.amount)
+        .where(BillAgingSnapshot.taken_at == taken_at)
+    ).all()
+    return taken_at, rows
+
+
+def _empty():
+    return {bucket: {"count": 0, "amount": 0.0} for bucket in BUCKETS}
+
+
+def _add(buckets, bucket, count, amount):
+    buckets[bucket]["count"] += count
+    buckets[bucket]["amount"] = round(buckets[bucket]["amount"] + (amount or 0), 2)
+
+
+def build_report(rows, as_of, source):
+    doctor_ids = {row[0] for row in rows if row[0] is not None}
+    doctors = {}
+    if doctor_ids:
+        doctors = {doctor.id: doctor for doctor in db.session.execute(
+            select(Doctor.id, Doctor.title, Doctor.first_name, Doctor.surname).where(Doctor.id.in_(doctor_ids)),
+            execution_options={'include_deleted': True},
+        )}
+
+    total = _empty()
+    by_doctor = {}
+    by_specialization = {}
+    for doctor_id, specialization, bucket, count, amount in rows:
+        if not count:
+            continue
+        _add(total, bucket, count, amount)
+        if doctor_id not in by_doctor:
+            doctor = doctors.get(doctor_id)
+            by_doctor[doctor_id] = {
+                "doctor_id": doctor_id,
+                "name": " ".join(filter(None, (doctor.title, doctor.first_name, doctor.surname))) if doctor else None,
+                "specialization": specialization,
+                "buckets": _empty(),
+            }
+        _add(by_doctor[doctor_id]["buckets"], bucket, count, amount)
+        if specialization not in by_specialization:
+            by_specialization[specialization] = {"specialization": specialization, "buckets": _empty()}
+        _add(by_specialization[specialization]["buckets"], bucket, count, amount)
+
+    def outstanding(entry):
+        return sum(bucket["amount"] for bucket in entry["buckets"].values())
+
+    return {
+        "as_of": as_of,
+        "source": source,
+        "buckets": list(BUCKETS),
+        "total": total,
+        # Largest outstanding first
+        "by_doctor": sorted(by_doctor.values(), key=outstanding, reverse=True),
+        "by_specialization": sorted(by_specialization.values(), key=outstanding, reverse=True),
+    }
+
+
+@click.command('aging-snapshot')
+@click.option('--keep-days', type=int, help='Delete snapshots older than this. Defaults to AGING_SNAPSHOT_KEEP_DAYS.')
+@with_appcontext
+def aging_snapshot_command(keep_days):
+    """Save today's bill aging report for GET /bills/aging to serve."""
+    keep_days = keep_days if keep_days is not None else current_app.config['AGING_SNAPSHOT_KEEP_DAYS']
+    now = datetime.utcnow()
+    # With nothing outstanding an empty row still marks the snapshot as taken
+    rows = compute(now) or [(None, None, BUCKETS[0], 0, 0.0)]
+    db.session.rollback()
+    with db.engine.begin() as connection:
+        connection.execute(insert(BillAgingSnapshot), [
+            {'taken_at': now, 'doctor_id': doctor_id, 'specialization': specialization, 'bucket': bucket,
+             'bill_count': count, 'amount': amount or 0}
+            for doctor_id, specialization, bucket, count, amount in rows
+        ])
+        pruned = connection.execute(
+            delete(BillAgingSnapshot).where(BillAgingSnapshot.taken_at < now - timedelta(days=keep_days))
+        ).rowcount
+    click.echo(f'Saved {len(rows):,} aging rows as of {now:%Y-%m-%d %H:%M} UTC, deleted {pruned:,} old ones')
+
+
+# Saved by POST /appointments before the appointment had been flushed
+UNLINKED_DESCRIPTION = 'Bill for appointment None'
+# The bill and its appointment were inserted in the same transaction
+LINK_TOLERANCE = timedelta(seconds=5)
+
+
+@click.command('link-appointment-bills')
+@click.option('--batch-size', type=int, default=1000, show_default=True, help='Bills per transaction.')
+@click.option('--dry-run', is_flag=True, help='Count the bills that would be linked but save nothing.')
+@with_appcontext
+def link_bills_command(batch_size, dry_run):
+    """Link the bills POST /appointments saved without their appointment_id.
+
+    A bill is linked to the appointment of the same patient and cost created
+    within a few seconds of it, when exactly one such appointment has no bill."""
+    linked = skipped = 0
+    last_id = 0
+    while True:
+        bills = (Bill.query.filter(Bill.appointment_id.is_(None), Bill.description == UNLINKED_DESCRIPTION,
+                                   Bill.id > last_id)
+                 .order_by(Bill.id).limit(batch_size).all())
+        if not bills:
+            break
+        last_id = bills[-1].id
+        billed = select(Bill.appointment_id).where(Bill.appointment_id.is_not(None))
+        candidates = {}
+        for appointment in db.session.execute(
+            select(Appointment.id, Appointment.patient_id, Appointment.cost, Appointment.created_at)
+            .where(Appointment.patient_id.in_({bill.patient_id for bill in bills}), Appointment.id.not_in(billed))
+        ):
+            candidates.setdefault(appointment.patient_id, []).append(appointment)
+
+        claimed = set()
+        for bill in bills:
+            matches = [
+                appointment for appointment in candidates.get(bill.patient_id, ())
+                if appointment.id not in claimed and appointment.cost == bill.amount
+                and appointment.created_at and bill.creation_date
+                and abs(appointment.created_at - bill.creation_date) <= LINK_TOLERANCE
+            ]
+            if len(matches) != 1:
+                skipped += 1
+                continue
+            claimed.add(matches[0].id)
+            bill.appointment_id = matches[0].id
+            bill.description = f'Bill for appointment {matches[0].id}'
+            linked += 1
+        if dry_run:
+            db.session.rollback()
+        else:
+            db.session.commit()
+    action = 'Would link' if dry_run else 'Linked'
+    click.echo(f'{action} {linked:,} bills to their appointment, {skipped:,} left unlinked (no single match)')
@@ -1,56 +1,162 @@
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, jsonify
 from flask_jwt_extended import JWTManager
 from flask_cors import CORS
-from flasgger import Swagger  # Import Flasgger
-from routes.auth import auth_bp
-from routes.doctors import doctors_bp
-from routes.patients import patients_bp
-from routes.appointments import appointments_bp 
-from routes.bills import bills_bp
-from routes.records import records_bp
-from routes.transactions import transactions_bp
+from werkzeug.middleware.proxy_fix import ProxyFix
+from sqlalchemy import text
+from sqlalchemy.orm import configure_mappers
+import importlib
 
 import logging  
 from config import Config
 
-from db import db
-
-app = Flask(__name__)
+from db import (db, init_db, init_query_instrumentation, add_missing_columns, widen_string_columns,
+                add_sqlite_autoincrement, create_missing_indexes)
+from serializers import SelectionError
+from hashing import HashingBusy
+from json_provider import OrjsonProvider
+import versioning  # noqa: F401 - registers the table version counters
+import changes  # noqa: F401 - registers the change feed outbox
+from ledger import ledger_cli  # also posts ledger entries for new bills and payments
+from middleware.compression import compress_response
+from middleware.lazy import LazySetup, ensure_loaded
+from middleware.ratelimit import init_ratelimit
+from metrics import init_metrics
+from seed import seed_command
+from archive import archive_command
+from soft_delete import purge_command  # also hides soft-deleted rows from ORM queries
+from reconcile import reconcile_command
+from aging import aging_snapshot_command, link_bills_command
+from openapi import init_openapi, openapi_command
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app.config.from_object(Config)
+# (module, blueprint, url prefix). Modules are imported on registration, which
+# LAZY_BLUEPRINTS puts off until the first request.
+BLUEPRINTS = [
+    ('routes.auth', 'auth_bp', '/auth'),
+    ('routes.doctors', 'doctors_bp', '/doctors'),
+    ('routes.patients', 'patients_bp', '/patients'),
+    ('routes.appointments', 'appointments_bp', '/appointments'),
+    ('routes.records', 'records_bp', '/records'),
+    ('routes.bills', 'bills_bp', '/bills'),
+    ('routes.transactions', 'transactions_bp', '/transactions'),
+    ('routes.changes', 'changes_bp', None),
+    ('routes.batch', 'batch_bp', None),
+    ('routes.metrics', 'metrics_bp', None),
+]
+
+
+def register_blueprints(app):
+    for module_name, name, url_prefix in BLUEPRINTS:
+        blueprint = getattr(importlib.import_module(module_name), name)
+        app.register_blueprint(blueprint, url_prefix=url_prefix)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///hospital.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db.init_app(app)
+    # Swagger setup, once the routes it documents are registered
+    init_openapi(app)
 
-# JWT Setup
-app.config['JWT_SECRET_KEY'] = 'your_jwt_secret_key'  
-jwt = JWTManager(app)
 
-# Swagger setup
-swagger = Swagger(app)  # Initialize Swagger
+def handle_selection_error(error):
+    return jsonify({"error": error.description}), 400
+
+
+def handle_hashing_busy(error):
+    response = jsonify({"message": error.description})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
 
-# Register Blueprints
-app.register_blueprint(auth_bp, url_prefix='/auth')
-app.register_blueprint(doctors_bp, url_prefix='/doctors')
-app.register_blueprint(patients_bp, url_prefix='/patients')
-app.register_blueprint(appointments_bp, url_prefix='/appointments') 
-app.register_blueprint(records_bp, url_prefix='/records')
-app.register_blueprint(bills_bp, url_prefix='/bills')
-app.register_blueprint(transactions_bp, url_prefix='/transactions')
-CORS(app, resources={r"/*": {"origins": "*"}})
 
-@app.route('/')
 def index():
     return "Welcome to the Hospital Management System API"
 
-if __name__ == '__main__':
+
+def create_app(config=Config):
+    """Build the app from a config object, or a dict of overrides on top of Config."""
+    app = Flask(__name__)
+    if isinstance(config, dict):
+        app.config.from_object(Config)
+        app.config.update(config)
+    else:
+        app.config.from_object(config)
+
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    init_db(app)
+    init_query_instrumentation(app)
+    init_metrics(app)
+    init_ratelimit(app)
+
+    # JSON encoding
+    if app.config['JSON_PROVIDER'] == 'orjson':
+        app.json = OrjsonProvider(app)
+        app.json.datetime_format = app.config['JSON_DATETIME_FORMAT']
+
+    # JWT Setup
+    JWTManager(app)
+
+    # Register Blueprints
+    if app.config['LAZY_BLUEPRINTS']:
+        app.wsgi_app = LazySetup(app, register_blueprints)
+    else:
+        register_blueprints(app)
+
+    CORS(app, resources={r"/*": {"origins": "*"}})
+
+    # Behind nginx or a load balancer, take the client's address (and scheme and
+    # host) from the X-Forwarded-* headers the trusted proxies add
+    hops = app.config['TRUSTED_PROXY_HOPS']
+    if hops:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops, x_host=hops)
+
+    # CLI commands
+    app.cli.add_command(seed_command)
+    app.cli.add_command(openapi_command)
+    app.cli.add_command(archive_command)
+    app.cli.add_command(purge_command)
+    app.cli.add_command(reconcile_command)
+    app.cli.add_command(ledger_cli)
+    app.cli.add_command(aging_snapshot_command)
+    app.cli.add_command(link_bills_command)
+
+    # Compress large responses for clients that accept gzip/brotli
+    app.after_request(compress_response)
+
+    app.register_error_handler(SelectionError, handle_selection_error)
+    app.register_error_handler(HashingBusy, handle_hashing_busy)
+    app.add_url_rule('/', 'index', index)
+
+    # Create any tables, columns and indexes added since the database was first set up
+    with app.app_context():
+        db.create_all()
+        add_missing_columns()
+        widen_string_columns()
+        add_sqlite_autoincrement()
+        create_missing_indexes()
+    return app
+
+
+def warm_up(app):
+    """Do the one-off work a worker would otherwise do on its first requests:
+    load the blueprints and API spec, configure the ORM mappers and connect to
+    the database (which also initialises the dialect). Meant to run in the
+    gunicorn master with preload_app, so the forked workers inherit the result."""
+    ensure_loaded(app)
+    configure_mappers()
     with app.app_context():
-        db.create_all()  # Create database tables
-    app.run(debug=False)
+        with db.engine.connect() as connection:
+            connection.execute(text('SELECT 1'))
+
 
+def __getattr__(name):
+    # `app:app` (gunicorn, flask run, `from app import app`) gets a default app,
+    # built on first use rather than at import
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+if __name__ == '__main__':
+    create_app().run(debug=False)
@@ -0,0 +1,133 @@
+import click
+import heapq
+import time
+from datetime import datetime, timedelta
+from flask import current_app, request
+from flask.cli import with_appcontext
+from sqlalchemy import and_, delete, desc, exists, func, insert, not_, select
+from db import db
+from models import Appointment, AppointmentArchive, Bill, BillArchive, ChangeEvent, Transaction, TransactionArchive
+from versioning import bump_versions
+
+# Archival tier. Settled history older than ARCHIVE_AFTER_DAYS moves from the live
+# appointment, bills and transactions tables into same-shaped *_archive tables,
+# so everyday queries only scan recent rows. Routes union the archive back in
+# when asked with ?include_archived=1.
+
+ARCHIVED_APPOINTMENT_STATUSES = ('completed', 'canceled', 'cancelled')
+
+
+def include_archived():
+    return request.args.get('include_archived', '').lower() in ('1', 'true')
+
+
+def load_with_archive(serializer, fields, archive_model, order_by=None, **filters):
+    """The serializer model's rows matching filters, newest first by order_by.
+    With ?include_archived=1 the matching archive rows are merged in."""
+    models = [serializer.model] + ([archive_model] if include_archived() else [])
+    results = []
+    for model in models:
+        extra = (order_by,) if order_by and len(models) > 1 else ()
+        query = model.query.filter_by(**filters).options(serializer.load_only(fields, extra=extra, model=model))
+        if order_by:
+            query = query.order_by(desc(getattr(model, order_by)))
+        results.append(query.all())
+    if len(results) == 1:
+        return results[0]
+    if not order_by:
+        return [row for rows in results for row in rows]
+    return list(heapq.merge(*results, key=lambda row: getattr(row, order_by) or datetime.min, reverse=True))
+
+
+def archivable(cutoff):
+    """(model, archive model, condition) in the order they must be moved: a row
+    only goes once nothing left in the live tables points at it."""
+    return [
+        (Bill, BillArchive, and_(
+            Bill.status == 'Paid',
+            Bill.creation_date < cutoff,
+        )),
+        (Transaction, TransactionArchive, and_(
+            Transaction.status != 'Pending',
+            Transaction.transaction_date < cutoff.strftime('%Y-%m-%d %H:%M:%S'),
+            not_(exists().where(Bill.transaction_id == Transaction.id)),
+        )),
+        (Appointment, AppointmentArchive, and_(
+            func.lower(Appointment.status).in_(ARCHIVED_APPOINTMENT_STATUSES),
+            Appointment.created_at < cutoff,
+            not_(exists().where(Bill.appointment_id == Appointment.id)),
+        )),
+    ]
+
+
+def archive_rows(connection, model, archive_model, condition, batch_size):
+    """Move matching rows in batches of ascending id, one short transaction each,
+    so writers are never locked out for long. Returns the number of rows moved."""
+    table, archive_table = model.__table__, archive_model.__table__
+    columns = [column.name for column in table.columns]
+    moved = 0
+    while True:
+        ids = connection.execute(
+            select(table.c.id).where(condition).order_by(table.c.id).limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            return moved
+        # Bounded by id range rather than an IN list, which keeps the statement
+        # size fixed whatever the batch size
+        batch = and_(condition, table.c.id.between(ids[0], ids[-1]))
+        connection.execute(insert(archive_table).from_select(columns, select(*table.c).where(batch)))
+        connection.execute(delete(table).where(batch))
+        bump_versions(connection, [table.name, archive_table.name])
+        connection.commit()
+        moved += len(ids)
+
+
+def prune_changes(connection, cutoff, batch_size):
+    """Delete change feed events older than cutoff, oldest first, in batches.
+    Returns the number of events deleted."""
+    pruned = 0
+    while True:
+        seqs = connection.execute(
+            select(ChangeEvent.seq).where(ChangeEvent.changed_at < cutoff).order_by(ChangeEvent.seq).limit(batch_size)
+        ).scalars().all()
+        if not seqs:
+            return pruned
+        connection.execute(delete(ChangeEvent).where(ChangeEvent.seq.between(seqs[0], seqs[-1])))
+        connection.commit()
+        pruned += len(seqs)
+
+
+@click.command('archive')
+@click.option('--days', type=int, help='Archive settled rows older than this. Defaults to ARCHIVE_AFTER_DAYS.')
+@click.option('--batch-size', type=int, help='Rows per transaction. Defaults to ARCHIVE_BATCH_SIZE.')
+@click.option('--dry-run', is_flag=True, help='Only count what would be moved.')
+@with_appcontext
+def archive_command(days, batch_size, dry_run):
+    """Move settled appointments, bills and transactions into the archive tables
+    and prune old change feed events."""
+    config = current_app.config
+    cutoff = datetime.now() - timedelta(days=days if days is not None else config['ARCHIVE_AFTER_DAYS'])
+    batch_size = batch_size or config['ARCHIVE_BATCH_SIZE']
+
+    started = time.perf_counter()
+    with db.engine.connect() as connection:
+        for model, archive_model, condition in archivable(cutoff):
+            if dry_run:
+                count = connection.execute(select(func.count()).select_from(model.__table__).where(condition)).scalar()
+                click.echo(f'{model.__tablename__:<14}{count:>12,}')
+            else:
+                moved = archive_rows(connection, model, archive_model, condition, batch_size)
+                click.echo(f'{model.__tablename__:<14}{moved:>12,}')
+        changes_cutoff = datetime.utcnow() - timedelta(days=config['CHANGE_FEED_RETENTION_DAYS'])
+        if dry_run:
+            count = connection.execute(
+                select(func.count()).select_from(ChangeEvent).where(ChangeEvent.changed_at < changes_cutoff)
+            ).scalar()
+        else:
+            count = prune_changes(connection, changes_cutoff, batch_size)
+        click.echo(f'{ChangeEvent.__tablename__:<14}{count:>12,}')
+    if dry_run:
+        # Their bills haven't moved yet in a dry run
+        click.echo('Transactions and appointments still referenced by live bills are not counted.')
+    else:
+        click.echo(f'Archived rows older than {cutoff:%Y-%m-%d %H:%M} in {time.perf_counter() - started:.1f}s')
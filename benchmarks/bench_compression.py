@@ -0,0 +1,59 @@
+"""Measure the latency/bandwidth trade-off of response compression.
+
+    python -m benchmarks.bench_compression --patients 3000 --repeat 10
+
+For each encoding and level, reports the response size, the median server
+time and the estimated time to deliver the response over a few link speeds
+(server time + bytes / bandwidth).
+"""
+import argparse
+
+from benchmarks.common import make_app, seed, timed, median
+
+LINKS_MBIT = (1, 5, 50)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--patients', type=int, default=3000)
+    parser.add_argument('--records', type=int, default=3000)
+    parser.add_argument('--url', default='/doctors/patients/1')
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    app = make_app()
+    seed(app, doctors=2, patients=args.patients, appointments=args.patients * 4, records=args.records,
+         record_size=1500)
+
+    from middleware.compression import brotli
+
+    variants = [('identity', None)] + [('gzip', level) for level in (1, 6, 9)]
+    if brotli is not None:
+        variants += [('br', level) for level in (1, 4, 9)]
+    else:
+        print("brotli is not installed, only gzip is measured")
+
+    client = app.test_client()
+    header = f"{'encoding':<10}{'level':>6}{'bytes':>12}{'server ms':>11}"
+    header += ''.join(f"{f'@{mbit}Mbit ms':>14}" for mbit in LINKS_MBIT)
+    print(f"GET {args.url}")
+    print(header)
+    for encoding, level in variants:
+        if encoding == 'br':
+            app.config['COMPRESSION_BROTLI_LEVEL'] = level
+        elif level is not None:
+            app.config['COMPRESSION_LEVEL'] = level
+
+        responses = []
+        timings = timed(lambda: responses.append(client.get(args.url, headers={'Accept-Encoding': encoding})),
+                        args.repeat)
+        size = len(responses[-1].data)
+        server_ms = median(timings) * 1000
+        line = f"{encoding:<10}{level if level is not None else '-':>6}{size:>12}{server_ms:>11.1f}"
+        for mbit in LINKS_MBIT:
+            line += f"{server_ms + size * 8 / (mbit * 1000):>14.1f}"
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
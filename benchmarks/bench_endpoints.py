@@ -0,0 +1,364 @@
+"""Latency and throughput of every route against a seeded synthetic hospital.
+
+    python -m benchmarks.bench_endpoints --doctors 50 --patients 5000 --requests 200
+    python -m benchmarks.bench_endpoints --baseline benchmarks/results/<earlier run>.json
+    python -m benchmarks.bench_endpoints --compare old.json new.json
+
+Runs fully offline: the app is built against a temporary SQLite database and
+talks to the M-Pesa stand-in (benchmarks/mpesa_standin.py) on a local port.
+Every run is saved as JSON under
+benchmarks/results/ (or --output). With --baseline/--compare, routes whose
+p50 or p99 grew by more than --threshold are listed and the exit code is 1.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from benchmarks.common import make_app, seed, percentile, BENCH_PASSWORD
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+# Differences smaller than this are noise whatever the ratio
+NOISE_FLOOR_MS = 0.5
+
+
+class Context:
+    def __init__(self, client, args):
+        self.client = client
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.counter = itertools.count(1)
+
+    def doctor_id(self):
+        return self.rng.randint(1, self.args.doctors)
+
+    def patient_id(self):
+        return self.rng.randint(1, self.args.patients)
+
+    def appointment_id(self):
+        return self.rng.randint(1, self.args.appointments)
+
+    def record_id(self):
+        return self.rng.randint(1, self.args.records)
+
+    def bill_id(self):
+        return self.rng.randint(1, self.args.appointments)
+
+    def unique(self):
+        return f'{next(self.counter)}-{uuid.uuid4().hex[:8]}'
+
+    def doctor_payload(self):
+        return {
+            'title': 'Dr.', 'first_name': 'Bench', 'surname': f'Doc{self.unique()}', 'gender': 'Male',
+            'date_of_birth': '1980-01-01', 'specialization': 'Cardiology', 'phone_number_country_code': '+254',
+            'phone_number': '700000000', 'email': f'doc-{self.unique()}@bench.test', 'address': 'Nairobi',
+            'years_of_experience': 5, 'qualifications': ['MBChB'], 'start_of_employment': '2020-01-01',
+            'emergency_contact': '0711000000', 'emergency_contact_country_code': '+254',
+        }
+
+    def patient_payload(self):
+        return {
+            'first_name': 'Bench', 'last_name': f'Pat{self.unique()}', 'date_of_birth': '1990-01-01',
+            'gender': 'Female', 'phone_number': '700000000', 'email': f'pat-{self.unique()}@bench.test',
+            'address': 'Mombasa', 'doctor_id': self.doctor_id(), 'emergency_contact_phone_number': '0711000000',
+        }
+
+    def created_id(self, url, payload, key):
+        response = self.client.post(url, json=payload)
+        return response.get_json()[key]
+
+    def callback_payload(self):
+        transaction_id = self.rng.randint(1, max(1, self.args.transactions))
+        return {'Body': {'stkCallback': {'CheckoutRequestID': f'ws_CO_bench_{transaction_id}', 'ResultCode': 0}}}
+
+
+def route_specs(ctx):
+    """endpoint -> function returning (method, url, request kwargs) for one call.
+
+    Setup needed by destructive routes (e.g. creating the row a DELETE removes)
+    happens inside these functions, outside the timed section. Streams are asked
+    for with buffered=False and timed to their first chunk.
+    """
+    def delete_doctor():
+        doctor = ctx.doctor_payload()
+        ctx.client.post('/doctors/', json=doctor)
+        from models import Doctor
+        with ctx.client.application.app_context():
+            doctor_id = Doctor.query.filter_by(email=doctor['email']).first().id
+        return 'DELETE', f'/doctors/{doctor_id}', {}
+
+    def delete_patient():
+        patient_id = ctx.created_id('/patients/', ctx.patient_payload(), 'patient_id')
+        return 'DELETE', f'/patients/{patient_id}', {}
+
+    paid_transactions = None
+
+    def refund():
+        # Small partial refunds of the seeded paid transactions, round robin
+        nonlocal paid_transactions
+        if paid_transactions is None:
+            from models import Transaction
+            with ctx.client.application.app_context():
+                paid_transactions = itertools.cycle([row.id for row in Transaction.query.with_entities(
+                    Transaction.id).filter_by(status='Paid').order_by(Transaction.id).limit(1000)])
+        return 'POST', f'/transactions/{next(paid_transactions)}/refund', {'json': {'amount': 1}}
+
+    def patient_batch():
+        # What a patient's page would otherwise fetch in three round trips
+        patient_id = ctx.patient_id()
+        return 'POST', '/batch', {'json': {'requests': [
+            {'path': f'/patients/{patient_id}'},
+            {'path': f'/appointments/patient/{patient_id}'},
+            {'path': f'/patients/{patient_id}/bills'},
+        ]}}
+
+    return {
+        'index': lambda: ('GET', '/', {}),
+        'auth_bp.register': lambda: ('POST', '/auth/register', {
+            'json': {'email': f'user-{ctx.unique()}@bench.test', 'password': BENCH_PASSWORD}}),
+        'auth_bp.login': lambda: ('POST', '/auth/login', {
+            'json': {'email': f'pat{ctx.rng.randint(1, ctx.args.users)}@bench.test', 'password': BENCH_PASSWORD}}),
+        'auth_bp.users': lambda: ('GET', '/auth/users', {}),
+        'doctors.add_doctor': lambda: ('POST', '/doctors/', {'json': ctx.doctor_payload()}),
+        'doctors.get_doctors': lambda: ('GET', '/doctors/', {}),
+        'doctors.edit_doctor': lambda: ('PATCH', f'/doctors/{ctx.doctor_id()}', {'json': ctx.doctor_payload()}),
+        'doctors.get_doctors_by_specialization': lambda: (
+            'GET', '/doctors/specialization?specialization=Cardiology', {}),
+        'doctors.delete_doctor': delete_doctor,
+        'doctors.get_patients_by_doctor': lambda: ('GET', f'/doctors/patients/{ctx.doctor_id()}', {}),
+        'patients.add_patient': lambda: ('POST', '/patients/', {'json': ctx.patient_payload()}),
+        'patients.get_patients': lambda: ('GET', '/patients/', {}),
+        'patients.update_patient': lambda: ('PATCH', f'/patients/{ctx.patient_id()}', {'json': ctx.patient_payload()}),
+        'patients.delete_patient': delete_patient,
+        'patients.get_patient': lambda: ('GET', f'/patients/{ctx.patient_id()}', {}),
+        'patients.get_patient_chart': lambda: ('GET', f'/patients/{ctx.patient_id()}/chart', {}),
+        'patients.get_patient_balance': lambda: ('GET', f'/patients/{ctx.patient_id()}/balance', {}),
+        'patients.get_bills_by_patient': lambda: ('GET', f'/patients/{ctx.patient_id()}/bills', {}),
+        'patients.get_records_for_patient': lambda: ('GET', f'/patients/{ctx.patient_id()}/records', {}),
+        'appointments.create_appointment': lambda: ('POST', '/appointments/', {'json': {
+            'patient_id': ctx.patient_id(), 'doctor_id': ctx.doctor_id(), 'appointment_date': '2024-03-01',
+            'cost': 1000}}),
+        'appointments.get_appointments_by_doctor': lambda: ('GET', f'/appointments/doctor/{ctx.doctor_id()}', {}),
+        'appointments.get_appointments_by_patient': lambda: (
+            'GET', f'/appointments/patient/{ctx.patient_id()}', {}),
+        'appointments.update_appointment_status': lambda: ('PATCH', f'/appointments/{ctx.appointment_id()}', {
+            'json': {'status': 'Completed', 'notes': 'Benchmark'}}),
+        'records.add_record': lambda: ('POST', '/records/', {'json': {
+            'subject': 'Benchmark', 'patient_id': ctx.patient_id(), 'record': 'x' * ctx.args.record_size}}),
+        'records.get_record': lambda: ('GET', f'/records/{ctx.record_id()}', {}),
+        'bills.create_bill': lambda: ('POST', '/bills/', {'json': {
+            'patient_id': ctx.patient_id(), 'status': 'Pending', 'amount': 1000, 'description': 'Benchmark'}}),
+        'bills.get_bills': lambda: (
+            'GET', '/bills/?ids=' + ','.join(str(ctx.bill_id()) for _ in range(20)), {}),
+        'bills.get_bills_aging': lambda: ('GET', '/bills/aging?live=1', {}),
+        'transactions.add_transaction': lambda: ('POST', '/transactions/', {'json': {
+            'checkout_request_id': f'ws_CO_{ctx.unique()}', 'bill_id': ctx.bill_id(), 'status': 'Pending',
+            'amount': 1000, 'paying_phone_number': '254700000000', 'receipt_number': f'R{ctx.unique()}',
+            'transaction_date': '2024-03-01 10:00:00'}}),
+        'transactions.get_all_transactions': lambda: ('GET', '/transactions/', {}),
+        'transactions.initiate_mpesa_payment': lambda: ('POST', '/transactions/deposit', {'json': {
+            'bill_id': ctx.bill_id(), 'phone_number': '254700000000'}}),
+        'transactions.initiate_bulk_mpesa_payments': lambda: ('POST', '/transactions/deposit/bulk', {'json': {
+            'payments': [{'bill_id': ctx.bill_id(), 'phone_number': '254700000000'} for _ in range(10)]}}),
+        'transactions.refund_transaction': refund,
+        'transactions.mpesa_callback': lambda: ('POST', '/transactions/callback', {'json': ctx.callback_payload()}),
+        'appointments.stream_appointments_by_doctor': lambda: (
+            'GET', f'/appointments/doctor/{ctx.doctor_id()}/events', {'buffered': False}),
+        'bills.stream_bill_status': lambda: ('GET', f'/bills/{ctx.bill_id()}/events', {'buffered': False}),
+        'transactions.stream_transaction_status': lambda: (
+            'GET', f'/transactions/{ctx.rng.randint(1, max(1, ctx.args.transactions))}/events', {'buffered': False}),
+        'batch.run_batch': patient_batch,
+        'changes.get_changes': lambda: ('GET', f'/changes?since={ctx.rng.randint(0, ctx.args.records)}', {}),
+        'metrics.get_metrics': lambda: ('GET', '/metrics', {}),
+        'flasgger.apispec_1': lambda: ('GET', '/apispec_1.json', {}),
+        'flasgger.apidocs': lambda: ('GET', '/apidocs/', {}),
+    }
+
+
+def start_mpesa_standin(app):
+    """Serve the M-Pesa stand-in from a background thread and point the app at it."""
+    import threading
+    from werkzeug.serving import make_server
+    from benchmarks.mpesa_standin import create_standin
+
+    server = make_server('127.0.0.1', 0, create_standin(), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    app.config['MPESA_BASE_URL'] = f'http://127.0.0.1:{server.server_port}'
+    # Time the routes, not the pacing to Safaricom's rate
+    app.config['MPESA_STK_PUSH_RATE'] = 0
+
+
+def summarize(timings, statuses, wall_time):
+    return {
+        'requests': len(timings),
+        'p50_ms': round(percentile(timings, 50) * 1000, 3),
+        'p99_ms': round(percentile(timings, 99) * 1000, 3),
+        'mean_ms': round(sum(timings) / len(timings) * 1000, 3),
+        'throughput_rps': round(len(timings) / wall_time, 1) if wall_time else None,
+        'statuses': {str(status): statuses.count(status) for status in sorted(set(statuses))},
+    }
+
+
+def bench_route(ctx, spec, requests, warmup):
+    client = ctx.client
+    timings, statuses = [], []
+    for i in range(warmup + requests):
+        method, url, kwargs = spec()
+        start = time.perf_counter()
+        response = client.open(url, method=method, **kwargs)
+        if not kwargs.get('buffered', True):
+            # Up to the first chunk (subscribed and sending), then hang up
+            next(response.iter_encoded(), None)
+            response.close()
+        elapsed = time.perf_counter() - start
+        if i >= warmup:
+            timings.append(elapsed)
+            statuses.append(response.status_code)
+    return summarize(timings, statuses, sum(timings))
+
+
+def bench_callback_burst(app, ctx, burst, concurrency):
+    """Fire `burst` M-Pesa callbacks from `concurrency` threads at once."""
+    payloads = [ctx.callback_payload() for _ in range(burst)]
+
+    def send(payload):
+        client = app.test_client()
+        start = time.perf_counter()
+        response = client.post('/transactions/callback', json=payload)
+        return time.perf_counter() - start, response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(send, payloads))
+    wall_time = time.perf_counter() - start
+    result = summarize([r[0] for r in results], [r[1] for r in results], wall_time)
+    result['concurrency'] = concurrency
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, current, threshold):
+    """Print per-route changes and return the routes that regressed."""
+    regressions = []
+    print(f"\n{'route':<48}{'p50 base':>10}{'p50 now':>10}{'p99 base':>10}{'p99 now':>10}")
+    for name, now in current['routes'].items():
+        base = baseline['routes'].get(name)
+        if base is None:
+            continue
+        flags = []
+        for metric in ('p50_ms', 'p99_ms'):
+            if now[metric] - base[metric] > max(NOISE_FLOOR_MS, base[metric] * threshold):
+                flags.append(metric[:3])
+        if flags:
+            regressions.append(name)
+        print(f"{name:<48}{base['p50_ms']:>10.2f}{now['p50_ms']:>10.2f}{base['p99_ms']:>10.2f}{now['p99_ms']:>10.2f}"
+              + (f"  REGRESSION ({', '.join(flags)})" if flags else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--doctors', type=int, default=20)
+    parser.add_argument('--patients', type=int, default=2000)
+    parser.add_argument('--appointments', type=int, default=8000)
+    parser.add_argument('--records', type=int, default=4000)
+    parser.add_argument('--record-size', type=int, default=2000)
+    parser.add_argument('--transactions', type=int, default=4000)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=100, help='timed requests per route')
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--burst', type=int, default=500, help='callbacks in the /transactions/callback burst')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--routes', help='comma-separated endpoint names to run (default: all)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='where to save the results JSON')
+    parser.add_argument('--baseline', help='results JSON to compare this run against')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'), help='compare two saved runs and exit')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative slowdown counted as a regression')
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            current = json.load(f)
+        sys.exit(1 if compare(baseline, current, args.threshold) else 0)
+
+    app = make_app()
+    seed(app, doctors=args.doctors, patients=args.patients, appointments=args.appointments, records=args.records,
+         record_size=args.record_size, transactions=args.transactions, users=args.users, seed=args.seed)
+    start_mpesa_standin(app)
+    # Seeded with bulk inserts, which the ledger doesn't see; post them as a deployment would
+    app.test_cli_runner().invoke(args=['ledger', 'backfill'])
+    app.test_cli_runner().invoke(args=['ledger', 'snapshot'])
+
+    ctx = Context(app.test_client(), args)
+    specs = route_specs(ctx)
+    selected = args.routes.split(',') if args.routes else None
+
+    endpoints = sorted({rule.endpoint for rule in app.url_map.iter_rules()
+                        if not rule.endpoint.endswith('static') and rule.endpoint != 'flasgger.<lambda>'})
+    missing = [endpoint for endpoint in endpoints if endpoint not in specs]
+    if missing:
+        print(f"No benchmark for: {', '.join(missing)}")
+
+    results = {
+        'meta': {
+            'started_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'params': {key: value for key, value in vars(args).items()
+                       if key not in ('output', 'baseline', 'compare', 'threshold')},
+        },
+        'routes': {},
+    }
+
+    print(f"{'route':<48}{'p50 ms':>9}{'p99 ms':>9}{'req/s':>9}  statuses")
+    for endpoint in endpoints:
+        if endpoint not in specs or (selected and endpoint not in selected):
+            continue
+        result = bench_route(ctx, specs[endpoint], args.requests, args.warmup)
+        results['routes'][endpoint] = result
+        print(f"{endpoint:<48}{result['p50_ms']:>9.2f}{result['p99_ms']:>9.2f}{result['throughput_rps']:>9.1f}"
+              f"  {result['statuses']}")
+
+    if args.burst and (not selected or 'transactions.mpesa_callback' in selected):
+        burst = bench_callback_burst(app, ctx, args.burst, args.concurrency)
+        results['routes']['transactions.mpesa_callback[burst]'] = burst
+        print(f"{'transactions.mpesa_callback[burst]':<48}{burst['p50_ms']:>9.2f}{burst['p99_ms']:>9.2f}"
+              f"{burst['throughput_rps']:>9.1f}  {burst['statuses']} x{args.concurrency} threads")
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        output = os.path.join(RESULTS_DIR, f'endpoints-{stamp}.json')
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nSaved {output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(baseline, results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Compare Flask's stdlib JSON provider with OrjsonProvider on the list endpoints.
+
+    python -m benchmarks.bench_json --patients 2000 --repeat 20
+
+Reports the median request time and the part of it spent encoding JSON, and
+checks that both providers produce identical bodies.
+"""
+import argparse
+import time
+
+from benchmarks.common import make_app, seed, median
+
+ENDPOINTS = [
+    '/doctors/',
+    '/patients/',
+    '/transactions/',
+    '/appointments/doctor/1',
+    '/doctors/patients/1',
+    '/patients/1/bills',
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--patients', type=int, default=2000)
+    parser.add_argument('--appointments', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    app = make_app()
+    seed(app, doctors=5, patients=args.patients, appointments=args.appointments, records=args.patients)
+
+    from flask.json.provider import DefaultJSONProvider
+    from json_provider import OrjsonProvider, orjson
+
+    if orjson is None:
+        print("orjson is not installed, OrjsonProvider will use the stdlib encoder")
+
+    client = app.test_client()
+    providers = [('stdlib', DefaultJSONProvider(app)), ('orjson', OrjsonProvider(app))]
+
+    print(f"{'endpoint':<28}{'provider':<10}{'bytes':>10}{'request ms':>12}{'encode ms':>11}{'encode %':>10}")
+    for url in ENDPOINTS:
+        bodies = {}
+        for name, provider in providers:
+            encode_time = []
+            response_method = provider.response
+
+            def timed_response(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return response_method(*args, **kwargs)
+                finally:
+                    encode_time.append(time.perf_counter() - start)
+
+            provider.response = timed_response
+            app.json = provider
+
+            request_time = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                response = client.get(url)
+                request_time.append(time.perf_counter() - start)
+            bodies[name] = response.data
+
+            req, enc = median(request_time) * 1000, median(encode_time) * 1000
+            print(f"{url:<28}{name:<10}{len(response.data):>10}{req:>12.2f}{enc:>11.2f}{enc / req * 100:>9.0f}%")
+            del provider.response
+
+        if len(set(bodies.values())) != 1:
+            print(f"  !! bodies differ for {url}")
+
+
+if __name__ == '__main__':
+    main()
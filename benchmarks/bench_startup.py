@@ -0,0 +1,164 @@
+"""Cold-start time and per-worker memory of the app.
+
+    python -m benchmarks.bench_startup
+    python -m benchmarks.bench_startup --runs 10 --workers 4 --output startup.json
+
+Every measurement runs in a fresh interpreter. For each way of building the app
+(`import`: `from app import app`, `eager`: create_app(), `lazy`: create_app()
+with LAZY_BLUEPRINTS) it reports the time to build the app, the time to serve
+the first request and the RSS after it. The worker rows mimic gunicorn: with
+--preload the app is built and warmed up once and then forked, without it every
+forked worker builds its own. Private memory is what a worker does not share
+with the master, the number that adds up across workers (Linux only).
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.common import median
+
+MODES = ('import', 'eager', 'lazy')
+
+
+def memory_kb():
+    """(rss, private) of this process in kB; private is None off Linux."""
+    rss = private = None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1])
+        with open('/proc/self/smaps_rollup') as f:
+            private = sum(int(line.split()[1]) for line in f if line.startswith(('Private_Clean:', 'Private_Dirty:')))
+    except OSError:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss, private
+
+
+def build(mode, db_uri):
+    if mode == 'import':
+        os.environ['DATABASE_URL'] = db_uri
+        import app as module
+        return module.app
+    from app import create_app
+    return create_app({'SQLALCHEMY_DATABASE_URI': db_uri, 'LAZY_BLUEPRINTS': mode == 'lazy'})
+
+
+def first_request(app):
+    start = time.perf_counter()
+    response = app.test_client().get('/doctors/')
+    assert response.status_code == 200, response.status_code
+    return (time.perf_counter() - start) * 1000
+
+
+def run_child(args):
+    """Runs in the fresh interpreter; prints one JSON result."""
+    import logging
+    logging.disable(logging.CRITICAL)
+
+    if args.workers:
+        print(json.dumps(run_workers(args)))
+        return
+
+    start = time.perf_counter()
+    app = build(args.child, args.db)
+    build_ms = (time.perf_counter() - start) * 1000
+    request_ms = first_request(app)
+    rss, _ = memory_kb()
+    print(json.dumps({'build_ms': build_ms, 'first_request_ms': request_ms, 'rss_kb': rss}))
+
+
+def run_workers(args):
+    if args.preload:
+        app = build(args.child, args.db)
+        import gc
+        import app as module
+        # Trees from before the app factory have no warm_up()
+        if hasattr(module, 'warm_up'):
+            module.warm_up(app)
+        gc.freeze()
+
+    results = []
+    for _ in range(args.workers):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            start = time.perf_counter()
+            worker_app = app if args.preload else build(args.child, args.db)
+            ready_ms = (time.perf_counter() - start) * 1000
+            request_ms = first_request(worker_app)
+            rss, private = memory_kb()
+            with os.fdopen(write_fd, 'w') as f:
+                json.dump({'ready_ms': ready_ms, 'first_request_ms': request_ms, 'rss_kb': rss,
+                           'private_kb': private}, f)
+            os._exit(0)
+        os.close(write_fd)
+        with os.fdopen(read_fd) as f:
+            results.append(json.load(f))
+        os.waitpid(pid, 0)
+    return summarize(results)
+
+
+def spawn(args, mode, db_uri, workers=0, preload=False):
+    command = [sys.executable, '-m', 'benchmarks.bench_startup', '--child', mode, '--db', db_uri]
+    if workers:
+        command += ['--workers', str(workers)] + (['--preload'] if preload else [])
+    start = time.perf_counter()
+    output = subprocess.run(command, check=True, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result['wall_ms'] = (time.perf_counter() - start) * 1000
+    return result
+
+
+def summarize(runs):
+    return {key: median([run[key] for run in runs]) if runs[0][key] is not None else None for key in runs[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per measurement')
+    parser.add_argument('--workers', type=int, default=4, help='forked workers per worker measurement')
+    parser.add_argument('--modes', default=','.join(MODES), help='comma-separated modes to measure')
+    parser.add_argument('--output', help='where to save the results JSON')
+    parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument('--db', help=argparse.SUPPRESS)
+    parser.add_argument('--preload', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+
+    db_uri = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='hms-bench-'), 'bench.db')
+    modes = args.modes.split(',')
+    # Create the tables up front so no run pays for it
+    spawn(args, modes[0], db_uri)
+
+    results = {}
+    print(f"{'':<24}{'wall ms':>10}{'build ms':>10}{'1st req ms':>12}{'RSS MB':>9}{'private MB':>12}")
+    for mode in modes:
+        rows = [(mode, [spawn(args, mode, db_uri) for _ in range(args.runs)])]
+        for preload in (False, True):
+            name = f"{mode}, {args.workers} workers{', preload' if preload else ''}"
+            rows.append((name, [spawn(args, mode, db_uri, args.workers, preload) for _ in range(args.runs)]))
+        for name, runs in rows:
+            result = results[name] = summarize(runs)
+            build_ms = result.get('build_ms', result.get('ready_ms'))
+            private = f"{result['private_kb'] / 1024:.1f}" if result.get('private_kb') is not None else '-'
+            print(f"{name:<24}{result['wall_ms']:>10.0f}{build_ms:>10.1f}{result['first_request_ms']:>12.1f}"
+                  f"{result['rss_kb'] / 1024:>9.1f}{private:>12}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
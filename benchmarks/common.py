@@ -0,0 +1,107 @@
+"""Helpers shared by the benchmark scripts."""
+import os
+import random
+import statistics
+import tempfile
+import time
+import warnings
+
+
+def make_app(db_path=None):
+    if db_path is None:
+        db_path = os.path.join(tempfile.mkdtemp(prefix='hms-bench-'), 'bench.db')
+    warnings.filterwarnings('ignore', category=DeprecationWarning)
+
+    from app import create_app
+    return create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.abspath(db_path)})
+
+
+BENCH_PASSWORD = 'bench-password'
+
+
+def seed(app, doctors=20, patients=500, appointments=2000, records=1000, record_size=2000, transactions=None,
+         users=50, seed=1):
+    """Fill the database with a synthetic hospital using bulk inserts.
+
+    transactions defaults to one per paid bill. The first `users` patients get a
+    login (patN@bench.test / BENCH_PASSWORD) sharing one precomputed hash.
+    """
+    from datetime import datetime, timedelta
+    from db import db
+    from models import Doctor, Patient, Appointment, Bill, Record, Transaction, User
+
+    rng = random.Random(seed)
+    now = datetime(2024, 1, 1)
+    specializations = ['Cardiology', 'Pediatrics', 'Surgery', 'Dermatology', 'Oncology']
+
+    with app.app_context():
+        db.session.execute(db.insert(Doctor), [{
+            'id': i, 'title': 'Dr.', 'first_name': f'Doc{i}', 'surname': 'Bench', 'gender': 'Female',
+            'date_of_birth': '1980-01-01', 'specialization': rng.choice(specializations),
+            'phone_number_country_code': '+254', 'phone_number': f'7{i:08d}', 'email': f'doc{i}@bench.test',
+            'address': 'Nairobi', 'years_of_experience': rng.randint(1, 30), 'qualifications': '["MBChB"]',
+            'start_of_employment': '2015-01-01', 'emergency_contact': '0700000000',
+            'emergency_contact_country_code': '+254',
+        } for i in range(1, doctors + 1)])
+        db.session.execute(db.insert(Patient), [{
+            'id': i, 'first_name': f'Pat{i}', 'last_name': 'Bench', 'date_of_birth': '1990-01-01',
+            'gender': rng.choice(['Male', 'Female']), 'phone_number': f'7{i:08d}', 'email': f'pat{i}@bench.test',
+            'address': 'Mombasa', 'doctor_id': rng.randint(1, doctors), 'emergency_contact_phone_number': '0711000000',
+        } for i in range(1, patients + 1)])
+        db.session.execute(db.insert(Appointment), [{
+            'id': i, 'patient_id': rng.randint(1, patients), 'doctor_id': rng.randint(1, doctors),
+            'cost': rng.choice([500, 1000, 2500]), 'appointment_date': '2024-02-01', 'status': 'Scheduled',
+            'reason_for_visit': 'Checkup', 'notes': 'Routine visit', 'created_at': now + timedelta(minutes=i),
+            'updated_at': now + timedelta(minutes=i),
+        } for i in range(1, appointments + 1)])
+        appointment_rows = db.session.execute(db.select(Appointment.id, Appointment.patient_id, Appointment.cost))
+        db.session.execute(db.insert(Bill), [{
+            'patient_id': patient_id, 'appointment_id': appointment_id, 'amount': float(cost),
+            'status': rng.choice(['Pending', 'Paid']), 'description': f'Bill for appointment {appointment_id}',
+            'creation_date': now + timedelta(minutes=appointment_id),
+        } for appointment_id, patient_id, cost in appointment_rows])
+
+        bill_rows = db.session.execute(db.select(Bill.id, Bill.amount, Bill.status)).all()
+        if transactions is None:
+            paying = [row for row in bill_rows if row.status == 'Paid']
+        else:
+            paying = [rng.choice(bill_rows) for _ in range(transactions)] if bill_rows else []
+        if paying:
+            db.session.execute(db.insert(Transaction), [{
+                'checkout_request_id': f'ws_CO_bench_{i}', 'bill_id': bill.id,
+                'status': 'Paid' if bill.status == 'Paid' else 'Pending', 'amount': bill.amount,
+                'paying_phone_number': '254700000000', 'receipt_number': f'RB{i:09d}',
+                'transaction_date': (now + timedelta(minutes=i)).strftime('%Y-%m-%d %H:%M:%S'),
+            } for i, bill in enumerate(paying, start=1)])
+
+        template = User(email='')
+        template.set_password(BENCH_PASSWORD)
+        db.session.execute(db.insert(User), [{
+            'email': f'pat{i}@bench.test', 'password_hash': template.password_hash, 'patient_id': str(i), 'role': 3,
+        } for i in range(1, min(users, patients) + 1)])
+
+        # Goes through the ORM so bodies are stored the same way the routes store them
+        db.session.add_all([Record(
+            subject=f'Visit note {i}', patient_id=rng.randint(1, patients), record='x' * record_size,
+            creation_date=now + timedelta(minutes=i),
+        ) for i in range(1, records + 1)])
+        db.session.commit()
+
+
+def timed(func, repeat):
+    """Run func repeat times and return the per-call timings in seconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def percentile(timings, pct):
+    ordered = sorted(timings)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def median(timings):
+    return statistics.median(timings)
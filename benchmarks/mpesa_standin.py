@@ -0,0 +1,107 @@
+"""A local stand-in for the Daraja (M-Pesa) API, to run payments offline.
+
+    python -m benchmarks.mpesa_standin --port 8099 --paid 0.6 --failed 0.2 --latency 50
+    MPESA_BASE_URL=http://127.0.0.1:8099 flask reconcile-mpesa --minutes 0
+
+Serves the OAuth token, STK push and STK query endpoints. Each checkout's
+query outcome (paid, failed or still processing) is drawn from its
+CheckoutRequestID, so repeated queries agree. Phone numbers not starting with
+254 are refused like the real API does. GET /stats counts the calls made.
+"""
+import argparse
+import hashlib
+import threading
+import time
+import uuid
+
+from flask import Flask, jsonify, request
+
+
+def create_standin(paid=0.6, failed=0.2, latency_ms=0.0):
+    app = Flask(__name__)
+    tokens = set()
+    stats = {'oauth_token': 0, 'stk_push': 0, 'stk_query': 0}
+    lock = threading.Lock()
+
+    def called(operation):
+        with lock:
+            stats[operation] += 1
+        if latency_ms:
+            time.sleep(latency_ms / 1000)
+
+    def authorized():
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        return scheme == 'Bearer' and token in tokens
+
+    def outcome(checkout_request_id):
+        draw = int(hashlib.sha256(checkout_request_id.encode()).hexdigest()[:8], 16) / 0xFFFFFFFF
+        if draw < paid:
+            return '0', 'The service request is processed successfully.'
+        if draw < paid + failed:
+            return '1032', 'Request cancelled by user'
+        return None, None
+
+    @app.get('/oauth/v1/generate')
+    def oauth_token():
+        called('oauth_token')
+        if not request.authorization:
+            return jsonify({'errorCode': '400.008.01', 'errorMessage': 'Invalid Authentication passed'}), 400
+        token = uuid.uuid4().hex
+        tokens.add(token)
+        return jsonify({'access_token': token, 'expires_in': '3599'})
+
+    @app.post('/mpesa/stkpush/v1/processrequest')
+    def stk_push():
+        called('stk_push')
+        if not authorized():
+            return jsonify({'errorCode': '404.001.03', 'errorMessage': 'Invalid Access Token'}), 401
+        data = request.get_json()
+        if not str(data.get('PhoneNumber', '')).startswith('254'):
+            return jsonify({'errorCode': '400.002.02', 'errorMessage': 'Bad Request - Invalid PhoneNumber'}), 400
+        return jsonify({
+            'MerchantRequestID': uuid.uuid4().hex[:20],
+            'CheckoutRequestID': f'ws_CO_standin_{uuid.uuid4().hex}',
+            'ResponseCode': '0',
+            'ResponseDescription': 'Success. Request accepted for processing',
+            'CustomerMessage': 'Success. Request accepted for processing',
+        })
+
+    @app.post('/mpesa/stkpushquery/v1/query')
+    def stk_query():
+        called('stk_query')
+        if not authorized():
+            return jsonify({'errorCode': '404.001.03', 'errorMessage': 'Invalid Access Token'}), 401
+        checkout_request_id = request.get_json()['CheckoutRequestID']
+        result_code, result_desc = outcome(checkout_request_id)
+        if result_code is None:
+            return jsonify({'errorCode': '500.001.1001', 'errorMessage': 'The transaction is being processed'}), 500
+        return jsonify({
+            'ResponseCode': '0',
+            'ResponseDescription': 'The service request has been accepted successsfully',
+            'MerchantRequestID': uuid.uuid4().hex[:20],
+            'CheckoutRequestID': checkout_request_id,
+            'ResultCode': result_code,
+            'ResultDesc': result_desc,
+        })
+
+    @app.get('/stats')
+    def get_stats():
+        with lock:
+            return jsonify(stats)
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--paid', type=float, default=0.6, help='Share of checkouts the query reports paid.')
+    parser.add_argument('--failed', type=float, default=0.2, help='Share reported failed; the rest stay processing.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Milliseconds added to every call.')
+    args = parser.parse_args()
+    create_standin(args.paid, args.failed, args.latency).run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
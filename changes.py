@@ -0,0 +1,46 @@
+from datetime import datetime
+from sqlalchemy import event, insert, inspect
+from sqlalchemy.orm import Session
+from models import Appointment, Bill, ChangeEvent, Doctor, Patient, Record, Transaction
+
+# Transactional outbox. Every flush appends one compact event per created,
+# updated or deleted row of the tables below to change_events, in the same
+# transaction as the write, and GET /changes pages through them by sequence
+# number. Consumers keep the last seq they saw and fetch only what came after.
+#
+# Core statements (flask seed, flask archive) bypass the ORM and are not
+# recorded; archived rows still exist as far as consumers are concerned.
+#
+# seq order is commit order because SQLite serialises writers. With concurrent
+# writers (e.g. Postgres) an event could commit after one with a higher seq.
+
+FEED_RESOURCES = {
+    Patient: 'patients',
+    Doctor: 'doctors',
+    Appointment: 'appointments',
+    Record: 'records',
+    Bill: 'bills',
+    Transaction: 'transactions',
+}
+
+
+@event.listens_for(Session, 'after_flush')
+def _record_changes(session, flush_context):
+    now = datetime.utcnow()
+    rows = []
+    for op, objects in (('created', session.new), ('updated', session.dirty), ('deleted', session.deleted)):
+        for obj in objects:
+            resource = FEED_RESOURCES.get(type(obj))
+            if resource is None:
+                continue
+            row_op = op
+            if op == 'updated':
+                # dirty also holds objects whose attributes were set to the values they had
+                if not session.is_modified(obj, include_collections=False):
+                    continue
+                # To consumers a soft delete (soft_delete.py) is a delete
+                if 'deleted_at' in obj.__table__.c and inspect(obj).attrs.deleted_at.history.added not in ([], [None]):
+                    row_op = 'deleted'
+            rows.append({'resource': resource, 'resource_id': obj.id, 'op': row_op, 'changed_at': now})
+    if rows:
+        session.connection().execute(insert(ChangeEvent), rows)
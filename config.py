@@ -3,8 +3,152 @@
 import os
 
 class Config:
+    SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL', 'sqlite:///hospital.db')
+    JWT_SECRET_KEY = os.getenv('JWT_SECRET_KEY', 'your_jwt_secret_key')
+
+    # Read routing. GET requests read from DATABASE_REPLICA_URL when it is set. On
+    # SQLite, READ_REPLICA_SQLITE=true instead switches the database to WAL mode and
+    # reads through a separate pool of query_only connections. After a write, a
+    # client's reads stay on the primary for READ_YOUR_WRITES_WINDOW seconds.
+    SQLALCHEMY_REPLICA_URI = os.getenv('DATABASE_REPLICA_URL')
+    READ_REPLICA_SQLITE = os.getenv('READ_REPLICA_SQLITE', 'false').lower() == 'true'
+    READ_YOUR_WRITES_WINDOW = int(os.getenv('READ_YOUR_WRITES_WINDOW', 5))
+
+    # Import and register the blueprints (and API docs) on the first request instead
+    # of in create_app(), for fast CLI commands and tests. Under gunicorn, warm_up()
+    # in gunicorn.conf.py loads them in the master before forking either way.
+    LAZY_BLUEPRINTS = os.getenv('LAZY_BLUEPRINTS', 'false').lower() == 'true'
+
+    # Login rate limits (token buckets): up to LOGIN_IP_LIMIT attempts per address and
+    # LOGIN_ACCOUNT_LIMIT per email in a burst, refilled over the matching window in
+    # seconds. Buckets are per process unless RATELIMIT_STORAGE_URL points at Redis.
+    RATELIMIT_ENABLED = os.getenv('RATELIMIT_ENABLED', 'true').lower() == 'true'
+    RATELIMIT_STORAGE_URL = os.getenv('RATELIMIT_STORAGE_URL')
+    RATELIMIT_MAX_KEYS = int(os.getenv('RATELIMIT_MAX_KEYS', 100000))  # per process, least recently used dropped
+    LOGIN_IP_LIMIT = int(os.getenv('LOGIN_IP_LIMIT', 20))
+    LOGIN_IP_WINDOW = float(os.getenv('LOGIN_IP_WINDOW', 60))
+    LOGIN_ACCOUNT_LIMIT = int(os.getenv('LOGIN_ACCOUNT_LIMIT', 10))
+    LOGIN_ACCOUNT_WINDOW = float(os.getenv('LOGIN_ACCOUNT_WINDOW', 300))
+
+    # Reverse proxies in front of the app. Set to how many add X-Forwarded-For
+    # (1 for a single nginx or load balancer) so request.remote_addr, and with it
+    # the per-address login limit, is the client's and not the proxy's. Leave at 0
+    # when clients connect directly, or they could forge their address.
+    TRUSTED_PROXY_HOPS = int(os.getenv('TRUSTED_PROXY_HOPS', 0))
+
+    # Password hashing (hashing.py). New hashes use PASSWORD_HASH_METHOD (pbkdf2 or
+    # scrypt) at the cost below; older hashes are upgraded on the next login.
+    # Hashes run on PASSWORD_HASH_WORKERS processes per worker (0 hashes on the
+    # request thread; gunicorn.conf.py sets 1 for gevent and gthread workers), and
+    # past PASSWORD_HASH_MAX_PENDING waiting per worker requests get a 503.
+    PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'pbkdf2')
+    PASSWORD_PBKDF2_ITERATIONS = int(os.getenv('PASSWORD_PBKDF2_ITERATIONS', 600000))
+    PASSWORD_SCRYPT_N = int(os.getenv('PASSWORD_SCRYPT_N', 32768))  # power of two, r=8 and p=1
+    PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', 0))
+    PASSWORD_HASH_MAX_PENDING = int(os.getenv('PASSWORD_HASH_MAX_PENDING', 8))
+
     MPESA_CONSUMER_KEY = os.getenv('MPESA_CONSUMER_KEY', 'zmDTtXkhe4diI75DwTHrfGai11MgVvkx')
     MPESA_CONSUMER_SECRET = os.getenv('MPESA_CONSUMER_SECRET', 'onNX4p5OrApTaHRj')
     MPESA_SHORTCODE = os.getenv('MPESA_SHORTCODE', '174379')
-    MPESA_PASSKEY = os.getenv('MPESA_PASSKEY', 'c9ad901de83c496e631b8f3f6bbda12924ee956eb4684a00c2da50946d63c143')
+    # Daraja sandbox passkey of the test shortcode 174379, which STK pushes used
+    # before the passkey came from config
+    MPESA_PASSKEY = os.getenv('MPESA_PASSKEY', 'bfb279f9aa9bdbcf158e97dd71a467cd2e0c893059b10f78e6b72ada1ed2c919')
     MPESA_CALLBACK_URL = os.getenv('MPESA_CALLBACK_URL', 'https://geographical-euphemia-wazo-tank-f4308d3f.koyeb.app/transactions/callback')
+    # Daraja API root; point it at benchmarks/mpesa_standin.py to run offline
+    MPESA_BASE_URL = os.getenv('MPESA_BASE_URL', 'https://sandbox.safaricom.co.ke')
+    MPESA_TIMEOUT = float(os.getenv('MPESA_TIMEOUT', 10))  # seconds per API call
+    MPESA_STK_PUSH_RATE = float(os.getenv('MPESA_STK_PUSH_RATE', 10))  # per second per worker, 0 for no limit
+
+    # POST /transactions/deposit/bulk sends up to MPESA_BULK_MAX_BILLS STK pushes,
+    # MPESA_BULK_WORKERS at a time, and saves the accepted ones every
+    # MPESA_BULK_CHUNK_SIZE pushes. Pacing makes a request take about
+    # MPESA_BULK_MAX_BILLS / MPESA_STK_PUSH_RATE seconds (10 at the defaults), which
+    # has to stay well inside GUNICORN_TIMEOUT on sync and gthread workers.
+    MPESA_BULK_MAX_BILLS = int(os.getenv('MPESA_BULK_MAX_BILLS', 100))
+    MPESA_BULK_WORKERS = int(os.getenv('MPESA_BULK_WORKERS', 8))
+    MPESA_BULK_CHUNK_SIZE = int(os.getenv('MPESA_BULK_CHUNK_SIZE', 20))
+
+    # `flask reconcile-mpesa` asks the STK query API about transactions still Pending
+    # MPESA_RECONCILE_AFTER_MINUTES after they were started, MPESA_RECONCILE_WORKERS
+    # at a time, and saves the answers in transactions of MPESA_RECONCILE_BATCH_SIZE.
+    MPESA_RECONCILE_AFTER_MINUTES = int(os.getenv('MPESA_RECONCILE_AFTER_MINUTES', 15))
+    MPESA_RECONCILE_WORKERS = int(os.getenv('MPESA_RECONCILE_WORKERS', 8))
+    MPESA_RECONCILE_BATCH_SIZE = int(os.getenv('MPESA_RECONCILE_BATCH_SIZE', 100))
+
+    # Record bodies larger than this many bytes are compressed at rest
+    RECORD_COMPRESSION_THRESHOLD = int(os.getenv('RECORD_COMPRESSION_THRESHOLD', 1024))
+    RECORD_COMPRESSION = os.getenv('RECORD_COMPRESSION', 'zlib')  # 'zlib', 'zstd' or 'none'
+
+    JSON_PROVIDER = os.getenv('JSON_PROVIDER', 'orjson')  # 'orjson' or 'stdlib'
+    JSON_DATETIME_FORMAT = os.getenv('JSON_DATETIME_FORMAT', 'http')  # 'http' (Flask default) or 'iso'
+
+    # Negotiated gzip/brotli compression of responses
+    COMPRESSION_ENABLED = os.getenv('COMPRESSION_ENABLED', 'true').lower() == 'true'
+    COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', 1024))  # bytes, streamed responses are always compressed
+    COMPRESSION_LEVEL = int(os.getenv('COMPRESSION_LEVEL', 6))  # gzip, 1-9
+    COMPRESSION_BROTLI_LEVEL = int(os.getenv('COMPRESSION_BROTLI_LEVEL', 4))  # brotli, 0-11
+    COMPRESSION_MIMETYPES = ['application/json', 'text/html', 'text/plain', 'text/event-stream']
+
+    # Per-request SQL statement counts/timings and repeated-statement (N+1) detection
+    SQL_INSTRUMENTATION = os.getenv('SQL_INSTRUMENTATION', 'true').lower() == 'true'
+    SQL_N_PLUS_ONE_THRESHOLD = int(os.getenv('SQL_N_PLUS_ONE_THRESHOLD', 5))
+
+    # Prometheus metrics served on /metrics. Set METRICS_DIR to a directory shared by
+    # the gunicorn workers to aggregate across them.
+    METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+    METRICS_DIR = os.getenv('METRICS_DIR')
+    METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 5))  # seconds
+
+    # API docs. The OpenAPI spec is compiled from the route docstrings once at startup,
+    # or read from OPENAPI_SPEC_PATH if that file exists (build it with `flask openapi`
+    # on deploy). SWAGGER_UI_ENABLED=false drops flasgger and /apidocs entirely; the
+    # prebuilt spec, if any, is still served.
+    SWAGGER_UI_ENABLED = os.getenv('SWAGGER_UI_ENABLED', 'true').lower() == 'true'
+    OPENAPI_SPEC_PATH = os.getenv('OPENAPI_SPEC_PATH')
+
+    # Archival. `flask archive` moves paid bills, settled transactions and finished
+    # appointments older than ARCHIVE_AFTER_DAYS into the *_archive tables, in
+    # transactions of ARCHIVE_BATCH_SIZE rows.
+    ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', 365))
+    ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', 1000))
+
+    # Deleted patients and doctors are hidden at once; `flask purge` removes them and the
+    # rows that depend on them once they've been deleted for PURGE_GRACE_DAYS, in
+    # transactions of PURGE_BATCH_SIZE rows.
+    PURGE_GRACE_DAYS = float(os.getenv('PURGE_GRACE_DAYS', 0))
+    PURGE_BATCH_SIZE = int(os.getenv('PURGE_BATCH_SIZE', 1000))
+
+    # Rows per transaction (and per query) of `flask ledger backfill` and `flask ledger verify`
+    LEDGER_BATCH_SIZE = int(os.getenv('LEDGER_BATCH_SIZE', 1000))
+
+    # GET /bills/aging. With AGING_FROM_SNAPSHOT it serves the report saved by the
+    # nightly `flask aging-snapshot` while that is under AGING_SNAPSHOT_MAX_AGE hours
+    # old, and computes it live otherwise (or when asked with ?live=1).
+    AGING_FROM_SNAPSHOT = os.getenv('AGING_FROM_SNAPSHOT', 'false').lower() == 'true'
+    AGING_SNAPSHOT_MAX_AGE = float(os.getenv('AGING_SNAPSHOT_MAX_AGE', 26))
+    AGING_SNAPSHOT_KEEP_DAYS = int(os.getenv('AGING_SNAPSHOT_KEEP_DAYS', 90))
+
+    # Change feed (GET /changes). Pages hold at most CHANGE_FEED_PAGE_SIZE events;
+    # `flask archive` prunes events older than CHANGE_FEED_RETENTION_DAYS.
+    CHANGE_FEED_PAGE_SIZE = int(os.getenv('CHANGE_FEED_PAGE_SIZE', 500))
+    CHANGE_FEED_RETENTION_DAYS = int(os.getenv('CHANGE_FEED_RETENTION_DAYS', 30))
+
+    # GET /patients/<id>/chart returns up to CHART_SECTION_LIMIT rows per section by default,
+    # CHART_MAX_SECTION_LIMIT at most. With CHART_CACHE_TTL > 0 (seconds) each worker also keeps
+    # up to RESPONSE_CACHE_SIZE charts in memory, never served once a table they read changes.
+    CHART_SECTION_LIMIT = int(os.getenv('CHART_SECTION_LIMIT', 20))
+    CHART_MAX_SECTION_LIMIT = int(os.getenv('CHART_MAX_SECTION_LIMIT', 100))
+    CHART_CACHE_TTL = float(os.getenv('CHART_CACHE_TTL', 0))
+    RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 512))
+
+    # POST /batch: most sub-requests per batch, and threads for running its reads in parallel
+    BATCH_MAX_REQUESTS = int(os.getenv('BATCH_MAX_REQUESTS', 20))
+    BATCH_MAX_WORKERS = int(os.getenv('BATCH_MAX_WORKERS', 4))
+
+    # Server-sent event streams (pubsub.py). Each worker polls the change feed every
+    # SSE_POLL_INTERVAL seconds while it has open streams. A stream falling more than
+    # SSE_QUEUE_SIZE events behind is closed; its client reconnects and catches up.
+    SSE_POLL_INTERVAL = float(os.getenv('SSE_POLL_INTERVAL', 1))  # seconds
+    SSE_HEARTBEAT_INTERVAL = float(os.getenv('SSE_HEARTBEAT_INTERVAL', 15))  # seconds
+    SSE_QUEUE_SIZE = int(os.getenv('SSE_QUEUE_SIZE', 100))
+    SSE_RETRY_MS = int(os.getenv('SSE_RETRY_MS', 3000))  # client reconnect delay
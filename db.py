@@ -1,4 +1,321 @@
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from flask import g, has_app_context, has_request_context, request
+from sqlalchemy import MetaData, event, inspect, text
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.engine import Engine, make_url
+from collections import Counter
+import json
+import logging
+import re
+import time
 
-db = SQLAlchemy()
-    
\ No newline at end of file
+REPLICA_BIND = 'replica'
+# Set after a write when reads go to a separate database, so the client's next
+# reads see its own writes even if the replica lags behind
+PRIMARY_PIN_COOKIE = 'hms_read_primary'
+
+
+class RoutingSession(Session):
+    """Sends the reads of GET/HEAD requests to the replica bind, when there is one.
+
+    Everything else stays on the primary: other methods, flushes and DML, and once
+    a session has written, all its later reads too (read-your-writes)."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self.info.get('wrote'):
+            if self._flushing or (clause is not None and getattr(clause, 'is_dml', False)):
+                self.info['wrote'] = True
+            elif _reads_from_replica():
+                engine = self._db.engines.get(REPLICA_BIND)
+                if engine is not None:
+                    return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _reads_from_replica():
+    return (
+        has_request_context()
+        and request.method in ('GET', 'HEAD')
+        and PRIMARY_PIN_COOKIE not in request.cookies
+    )
+
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+logger = logging.getLogger(__name__)
+sql_logger = logging.getLogger('sql')
+
+# Bound parameter placeholders for the DBAPI paramstyles we may run on
+_PLACEHOLDER = r'(?:\?|%\(\w+\)s|%s|:\w+)'
+_PARAM_LIST = re.compile(r'\(\s*' + _PLACEHOLDER + r'(?:\s*,\s*' + _PLACEHOLDER + r')*\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def statement_shape(statement):
+    """Statement text with whitespace and IN (...) lists normalised, so repeats of
+    the same query with different values compare equal."""
+    return _PARAM_LIST.sub('(?)', _WHITESPACE.sub(' ', statement)).strip()
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+
+    def repeated(self, threshold):
+        return [(shape, count) for shape, count in self.shapes.most_common() if count >= threshold]
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start_time'].pop()
+    stats = g.get('sql_stats') if has_app_context() else None
+    if stats is not None:
+        stats.count += 1
+        stats.duration += elapsed
+        stats.shapes[statement_shape(statement)] += 1
+
+
+@event.listens_for(Engine, 'handle_error')
+def _discard_query_start(context):
+    # A statement that raised never gets to after_cursor_execute
+    starts = context.connection.info.get('query_start_time') if context.connection is not None else None
+    if starts:
+        starts.pop()
+
+
+def _start_query_stats():
+    g.sql_stats = QueryStats()
+
+
+def _report_query_stats(app):
+    def report(response):
+        stats = g.pop('sql_stats', None)
+        if stats is None:
+            return response
+
+        repeated = stats.repeated(app.config['SQL_N_PLUS_ONE_THRESHOLD'])
+        if app.debug:
+            response.headers['X-SQL-Queries'] = str(stats.count)
+            response.headers['X-SQL-Time-Ms'] = f'{stats.duration * 1000:.2f}'
+            if repeated:
+                shape, count = repeated[0]
+                response.headers['X-SQL-Repeated'] = f'{count}x {shape[:200]}'
+            return response
+
+        entry = {
+            'event': 'sql_stats',
+            'method': request.method,
+            'endpoint': request.endpoint,
+            'path': request.path,
+            'status': response.status_code,
+            'queries': stats.count,
+            'sql_ms': round(stats.duration * 1000, 2),
+        }
+        if repeated:
+            entry['event'] = 'n_plus_one'
+            entry['repeated'] = [{'count': count, 'statement': shape[:500]} for shape, count in repeated]
+            sql_logger.warning(json.dumps(entry))
+        else:
+            sql_logger.info(json.dumps(entry))
+        return response
+    return report
+
+
+def init_query_instrumentation(app):
+    """Count statements and their time per request and flag repeated statement
+    shapes (N+1 loops). Reported as X-SQL-* headers in debug mode and as JSON log
+    lines on the 'sql' logger otherwise."""
+    if not app.config['SQL_INSTRUMENTATION']:
+        return
+    app.before_request(_start_query_stats)
+    app.after_request(_report_query_stats(app))
+
+
+def begin_immediate():
+    """Take SQLite's write lock now rather than at the session's first write, so
+    another request can't write between this one's reads and its writes. Other
+    databases lock the rows read with .with_for_update() instead."""
+    connection = db.session.connection()
+    if connection.dialect.name == 'sqlite' and not connection.connection.dbapi_connection.in_transaction:
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+
+def add_missing_columns():
+    """create_all() doesn't alter tables that already exist, so nullable columns
+    added to their models later are added here."""
+    inspector = inspect(db.engine)
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                if not column.nullable:
+                    logger.warning('Not adding NOT NULL column %s.%s to the existing table', table.name, column.name)
+                    continue
+                preparer = connection.dialect.identifier_preparer
+                connection.execute(text(
+                    f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} '
+                    f'{column.type.compile(dialect=connection.dialect)}'
+                ))
+
+
+def widen_string_columns():
+    """Widen existing VARCHAR columns whose model now declares a longer String,
+    such as users.password_hash for scrypt hashes. SQLite doesn't enforce
+    VARCHAR lengths, so there is nothing to do there."""
+    engine = db.engine
+    if engine.dialect.name == 'sqlite':
+        return
+    inspector = inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+    with engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            lengths = {column['name']: getattr(column['type'], 'length', None)
+                       for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                length = getattr(column.type, 'length', None)
+                if length is None or lengths.get(column.name) is None or lengths[column.name] >= length:
+                    continue
+                logger.warning('Widening %s.%s to %s', table.name, column.name, length)
+                column_type = column.type.compile(dialect=connection.dialect)
+                if engine.dialect.name == 'mysql':
+                    change = (f'MODIFY {preparer.format_column(column)} {column_type}'
+                              f'{"" if column.nullable else " NOT NULL"}')
+                else:
+                    change = f'ALTER COLUMN {preparer.format_column(column)} TYPE {column_type}'
+                connection.execute(text(f'ALTER TABLE {preparer.format_table(table)} {change}'))
+
+
+def add_sqlite_autoincrement():
+    """Rebuild existing SQLite tables whose model has since been given
+    sqlite_autoincrement, which SQLite can't add with ALTER TABLE. Their
+    sequence starts past the highest id in the table and in its _archive copy,
+    so ids moved to the archive aren't reused. Indexes are dropped with the old
+    table; create_missing_indexes() puts them back."""
+    engine = db.engine
+    if engine.dialect.name != 'sqlite':
+        return
+    preparer = engine.dialect.identifier_preparer
+    inspector = inspect(engine)
+    for table in db.metadata.sorted_tables:
+        if not table.dialect_options['sqlite'].get('autoincrement') or not inspector.has_table(table.name):
+            continue
+        with engine.connect() as connection:
+            sql = connection.execute(
+                text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': table.name}
+            ).scalar()
+        if 'AUTOINCREMENT' in sql.upper():
+            continue
+
+        logger.warning('Rebuilding table %s with AUTOINCREMENT', table.name)
+        # A copy under another name, alongside the tables its foreign keys point to
+        metadata = MetaData()
+        for other in db.metadata.sorted_tables:
+            other.to_metadata(metadata)
+        rebuilt = table.to_metadata(metadata, name=f'_rebuild_{table.name}')
+        rebuilt.indexes.clear()
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        columns = ', '.join(preparer.quote(column.name) for column in table.columns if column.name in existing)
+        statements = [
+            str(CreateTable(rebuilt).compile(dialect=engine.dialect)),
+            f'INSERT INTO {preparer.format_table(rebuilt)} ({columns}) '
+            f'SELECT {columns} FROM {preparer.format_table(table)}',
+            f'DROP TABLE {preparer.format_table(table)}',
+            f'ALTER TABLE {preparer.format_table(rebuilt)} RENAME TO {preparer.format_table(table)}',
+        ]
+        highest = [f'SELECT max(id) FROM {preparer.format_table(table)}']
+        archive = db.metadata.tables.get(f'{table.name}_archive')
+        if archive is not None and inspector.has_table(archive.name):
+            highest.append(f'SELECT max(id) FROM {preparer.format_table(archive)}')
+
+        # pysqlite doesn't put DDL in a transaction; BEGIN explicitly so a failure
+        # leaves the table as it was
+        dbapi_connection = engine.raw_connection()
+        isolation_level = dbapi_connection.isolation_level
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            for statement in statements:
+                cursor.execute(statement)
+            top = max(cursor.execute(query).fetchone()[0] or 0 for query in highest)
+            cursor.execute('DELETE FROM sqlite_sequence WHERE name = ?', (table.name,))
+            cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)', (table.name, top))
+            cursor.execute('COMMIT')
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+        finally:
+            cursor.close()
+            dbapi_connection.isolation_level = isolation_level
+            dbapi_connection.close()
+
+
+def create_missing_indexes(bind=None):
+    """create_all() skips tables that already exist, so indexes added to their
+    models later are created here, on bind if given."""
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind or db.engine, checkfirst=True)
+
+
+def _sqlite_pragmas(*pragmas):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+    return on_connect
+
+
+def _pin_to_primary(app):
+    def pin(response):
+        if request.method not in ('GET', 'HEAD') and db.session.registry.has() and db.session.info.get('wrote'):
+            response.set_cookie(PRIMARY_PIN_COOKIE, '1', max_age=app.config['READ_YOUR_WRITES_WINDOW'],
+                                httponly=True, samesite='Lax')
+        return response
+    return pin
+
+
+def init_db(app):
+    """db.init_app() plus read routing: with SQLALCHEMY_REPLICA_URI, or READ_REPLICA_SQLITE
+    on a SQLite database, a 'replica' bind is added that RoutingSession sends GET reads to."""
+    primary = app.config['SQLALCHEMY_DATABASE_URI']
+    replica = app.config['SQLALCHEMY_REPLICA_URI']
+    sqlite_replica = (
+        not replica
+        and app.config['READ_REPLICA_SQLITE']
+        and make_url(primary).get_backend_name() == 'sqlite'
+        and make_url(primary).database not in (None, '', ':memory:')
+    )
+    if sqlite_replica:
+        # A second pool on the same file. In WAL mode its readers don't block on,
+        # or get blocked by, the writer.
+        replica = primary
+    if replica:
+        app.config['SQLALCHEMY_BINDS'] = {**app.config.get('SQLALCHEMY_BINDS', {}), REPLICA_BIND: replica}
+
+    db.init_app(app)
+    if not replica:
+        return
+
+    with app.app_context():
+        engines = db.engines
+    if sqlite_replica:
+        event.listen(engines[None], 'connect', _sqlite_pragmas('PRAGMA journal_mode = WAL'))
+        event.listen(engines[REPLICA_BIND], 'connect', _sqlite_pragmas('PRAGMA query_only = ON'))
+    else:
+        app.after_request(_pin_to_primary(app))
@@ -0,0 +1,75 @@
+import gc
+import multiprocessing
+import os
+
+# gunicorn -c gunicorn.conf.py app:app
+#
+# The app is built and warmed up once in the master and then forked, so workers
+# start ready to serve and share the master's memory pages.
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+preload_app = True
+
+# gevent workers: a request waiting on the database, M-Pesa, a password hash or
+# an open server-sent event stream is a greenlet rather than a thread, so a
+# worker holds up to worker_connections of them. GUNICORN_WORKER_CLASS=gthread
+# (with GUNICORN_THREADS) or sync serve one request per thread instead, and an
+# SSE stream then holds its thread for as long as the dashboard stays open.
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+threads = int(os.getenv('GUNICORN_THREADS', 1))
+# Seconds a worker may go without checking in before the master restarts it.
+# Async workers check in between requests' waits, so long-lived streams are
+# fine; a sync or gthread worker is killed by a request running longer.
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+if worker_class in ('gevent', 'gthread'):
+    # Requests wait for password hashes on a process pool (hashing.py) while the
+    # worker serves others; a sync worker would only wait, so it hashes inline
+    os.environ.setdefault('PASSWORD_HASH_WORKERS', '1')
+if worker_class == 'gevent':
+    # Patch before the app is preloaded, so the locks, queues and sockets it
+    # creates in the master are already cooperative
+    from gevent import monkey
+    monkey.patch_all()
+
+
+def on_starting(server):
+    from app import app
+    import metrics
+    # Snapshots left by a previous master's workers would be summed with ours
+    if app.config['METRICS_ENABLED'] and app.config['METRICS_DIR']:
+        metrics.clear(app.config['METRICS_DIR'])
+
+
+def when_ready(server):
+    from app import app, warm_up
+    warm_up(app)
+    # Leave the warmed-up objects out of garbage collection, so collections in
+    # the workers don't write to (and un-share) their pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from app import app
+    from db import db
+    # Connections opened in the master must not be used by the workers; drop
+    # them from the worker's pool without closing the master's sockets
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+
+def worker_exit(server, worker):
+    from app import app
+    import metrics
+    # Counts since the last periodic flush
+    if app.config['METRICS_ENABLED'] and app.config['METRICS_DIR']:
+        metrics.flush(app.config['METRICS_DIR'])
+
+
+def child_exit(server, worker):
+    from app import app
+    import metrics
+    if app.config['METRICS_ENABLED'] and app.config['METRICS_DIR']:
+        metrics.retire(app.config['METRICS_DIR'], worker.pid)
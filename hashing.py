@@ -0,0 +1,130 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from flask import current_app, has_app_context
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import check_password_hash, generate_password_hash
+from config import Config
+import metrics
+
+# Password hashing off the request thread. Each worker process lazily starts a
+# small pool of hashing processes (PASSWORD_HASH_WORKERS) and submits the
+# deliberately slow PBKDF2/scrypt work there, so it runs in parallel with the
+# worker's other requests instead of holding its GIL. At most
+# PASSWORD_HASH_MAX_PENDING hashes wait or run per worker; beyond that callers
+# get a 503 rather than a queue that grows for as long as a login flood lasts.
+#
+# That only pays off in a worker serving other requests while one waits for
+# its hash: gunicorn's gevent (or gthread) worker, for which gunicorn.conf.py
+# turns the pool on. Elsewhere (the sync worker, the dev server, flask CLI
+# commands, scripts) PASSWORD_HASH_WORKERS defaults to 0 and hashes run on the
+# calling thread, with the login rate limits bounding the cost.
+#
+# The pool is started with `spawn`: the processes import only what hashing
+# needs, and never inherit locks held by the worker's other threads. Like any
+# spawn pool it re-imports the __main__ module, so a script that enables it must
+# keep its entry point under `if __name__ == '__main__':`, or the first hash
+# fails with BrokenProcessPool.
+
+
+class HashingBusy(ServiceUnavailable):
+    description = 'Too many passwords are being checked, try again shortly'
+
+
+def _setting(name):
+    if has_app_context():
+        return current_app.config.get(name, getattr(Config, name))
+    return getattr(Config, name)
+
+
+def current_method():
+    """Werkzeug method string for new hashes, with the configured cost."""
+    algorithm = _setting('PASSWORD_HASH_METHOD')
+    if algorithm == 'scrypt':
+        return f"scrypt:{_setting('PASSWORD_SCRYPT_N')}:8:1"
+    if algorithm == 'pbkdf2':
+        return f"pbkdf2:sha256:{_setting('PASSWORD_PBKDF2_ITERATIONS')}"
+    raise ValueError(f'Unsupported PASSWORD_HASH_METHOD {algorithm!r}')
+
+
+def _generate(password, method):
+    return generate_password_hash(password, method)
+
+
+def _verify(pwhash, password, method):
+    """(matches, new hash) where the new hash replaces one made with another
+    method or cost; checked and rehashed in one trip to the pool."""
+    if not check_password_hash(pwhash, password):
+        return False, None
+    if pwhash.split('$', 1)[0] == method:
+        return True, None
+    return True, generate_password_hash(password, method)
+
+
+class HashingPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self.pending = 0
+
+    def _get_executor(self, workers):
+        # Created on first use in each worker; one inherited across a fork is useless
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            self._pid = os.getpid()
+        return self._executor
+
+    def run(self, operation, func, *args):
+        workers = _setting('PASSWORD_HASH_WORKERS')
+        with self._lock:
+            if self.pending >= _setting('PASSWORD_HASH_MAX_PENDING'):
+                metrics.inc('password_hash_rejected_total', operation=operation)
+                raise HashingBusy()
+            self.pending += 1
+            executor = self._get_executor(workers) if workers > 0 else None
+        start = time.perf_counter()
+        try:
+            if executor is None:
+                return func(*args)
+            try:
+                return executor.submit(func, *args).result()
+            except BrokenProcessPool:
+                # A hashing process died; start a new pool on the next call
+                with self._lock:
+                    if self._executor is executor:
+                        self._executor = None
+                raise
+        finally:
+            metrics.observe('password_hash_duration_seconds', time.perf_counter() - start, operation=operation)
+            with self._lock:
+                self.pending -= 1
+
+
+pool = HashingPool()
+
+
+def hash_password(password):
+    return pool.run('hash', _generate, password, current_method())
+
+
+def verify_password(pwhash, password):
+    """(matches, new hash or None), see _verify."""
+    matches, new_hash = pool.run('verify', _verify, pwhash, password, current_method())
+    if new_hash is not None:
+        metrics.inc('password_rehashed_total')
+    return matches, new_hash
+
+
+metrics.describe('password_hash_duration_seconds', 'histogram', 'Time to hash or check a password, queueing included.')
+metrics.describe('password_hash_rejected_total', 'counter', 'Password hashes refused because too many were pending.')
+metrics.describe('password_rehashed_total', 'counter', 'Password hashes upgraded to the current method on login.')
+metrics.describe('password_hash_pending', 'gauge', 'Password hashes waiting or running in this process.')
+
+
+@metrics.gauge_callback
+def _pending():
+    yield 'password_hash_pending', {}, pool.pending
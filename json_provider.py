@@ -0,0 +1,88 @@
+import re
+from datetime import date, datetime, time, timezone
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the stdlib encoder is always available
+    orjson = None
+
+# orjson writes floats below 1e-4 as 0.0000... and large ones as 1e16 where the
+# stdlib writes 1e-05 and 1e+16, and leaves DEL unescaped. Finding any of these
+# only means we re-encode with the stdlib, so false positives inside strings are
+# harmless.
+_EXPONENT = re.compile(rb'e-?\d')
+
+_WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+def http_date(value):
+    """Same output as werkzeug's http_date for dates, without the email.utils overhead."""
+    if isinstance(value, datetime):
+        if value.tzinfo is not None and value.tzinfo != timezone.utc:
+            value = value.astimezone(timezone.utc)
+    else:
+        value = datetime.combine(value, time())
+    return '%s, %02d %s %04d %02d:%02d:%02d GMT' % (
+        _WEEKDAYS[value.weekday()], value.day, _MONTHS[value.month - 1], value.year,
+        value.hour, value.minute, value.second,
+    )
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider that encodes responses with orjson when it is installed.
+
+    Output is byte-for-byte what Flask's default provider produces: sorted keys,
+    compact separators, ASCII escapes and datetimes as HTTP dates. Anything orjson
+    can't reproduce exactly (non-ASCII text, odd floats, big ints, indented debug
+    output) falls back to the stdlib encoder. The one exception is NaN/Infinity,
+    which orjson writes as null.
+    """
+
+    # 'http' matches Flask's default, 'iso' lets orjson format datetimes natively
+    datetime_format = 'http'
+
+    def default(self, o):
+        if isinstance(o, date):
+            return o.isoformat() if self.datetime_format == 'iso' else http_date(o)
+        return super().default(o)
+
+    def _orjson_options(self):
+        options = orjson.OPT_PASSTHROUGH_DATACLASS
+        if self.datetime_format != 'iso':
+            options |= orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        return options
+
+    def _use_orjson(self):
+        if orjson is None:
+            return False
+        # Leave the deprecated config overrides and pretty printing to Flask
+        for key in ('JSON_AS_ASCII', 'JSON_SORT_KEYS', 'JSONIFY_PRETTYPRINT_REGULAR', 'JSONIFY_MIMETYPE'):
+            if self._app.config.get(key) is not None:
+                return False
+        return self.compact or (self.compact is None and not self._app.debug)
+
+    def dumps_bytes(self, obj):
+        """Encode obj with orjson, or return None if the stdlib must be used."""
+        try:
+            body = orjson.dumps(obj, default=self.default, option=self._orjson_options())
+        except TypeError:
+            return None
+        if self.ensure_ascii and not body.isascii():
+            return None
+        if b'0.0000' in body or b'\x7f' in body or _EXPONENT.search(body):
+            return None
+        return body
+
+    def response(self, *args, **kwargs):
+        if not self._use_orjson():
+            return super().response(*args, **kwargs)
+
+        obj = self._prepare_response_obj(args, kwargs)
+        body = self.dumps_bytes(obj)
+        if body is None:
+            return super().response(obj)
+        return self._app.response_class(body + b'\n', mimetype=self.mimetype)
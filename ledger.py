@@ -0,0 +1,317 @@
+import click
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import and_, case, event, func, insert, inspect, or_, select, union_all
+from sqlalchemy.orm import Session
+from db import db
+from models import Bill, BillArchive, LedgerEntry, LedgerSnapshot, Transaction, TransactionArchive
+from versioning import bump_versions
+
+# Payment ledger. Money moves are recorded as append-only double-entry postings
+# of integer minor units, so balances add up exactly however many there are:
+#
+#   charge   bill created            debit receivable   credit revenue
+#   payment  transaction paid        debit mpesa        credit receivable
+#   refund   payment given back      debit receivable   credit mpesa
+#
+# A patient's balance is their receivable account: what they owe. `flask ledger
+# snapshot` (run periodically) stores every changed patient's balance as of the
+# last entry, so a balance at any point in time is the snapshot before it plus
+# the few entries since: two index seeks and a short range sum.
+#
+# Charges and payments are posted as bills and transactions are flushed through
+# the ORM. Core writes (flask seed, bulk deposits stay Pending) are not; `flask
+# ledger backfill` posts whatever is missing.
+#
+# Two limits follow from that design:
+#
+# - Snapshots and balances count entries by id range, which assumes entries
+#   become visible in id order. SQLite's single writer guarantees it. On a
+#   database with concurrent writers, an entry committed after a snapshot
+#   passed its (lower) id would be missing from that snapshot and every later
+#   one; run `flask ledger snapshot` only there when no entries are being
+#   posted, and `flask ledger verify` after it.
+# - Backfilled entries are dated when the backfill runs, not when the bill or
+#   payment happened: dating them earlier would break the id order above. A
+#   balance as of a time before a patient's latest backfilled entry would leave
+#   that entry out, so history_start() tells callers not to ask for one.
+
+MINOR_UNITS = 100  # cents per shilling
+
+POSTINGS = {
+    'charge': ('receivable', 'revenue'),
+    'payment': ('mpesa', 'receivable'),
+    'refund': ('receivable', 'mpesa'),
+}
+SETTLED_STATUSES = ('Paid', 'Refunded')
+
+
+def to_minor(amount):
+    """Amount in minor units, rounding half up on the decimal value as written."""
+    return int((Decimal(str(amount)) * MINOR_UNITS).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+
+def format_minor(amount):
+    return str((Decimal(amount) / MINOR_UNITS).quantize(Decimal(1) / MINOR_UNITS))
+
+
+def entry(kind, patient_id, amount, bill_id=None, transaction_id=None, created_at=None, backfilled=None):
+    debit_account, credit_account = POSTINGS[kind]
+    return {
+        'kind': kind, 'patient_id': patient_id, 'bill_id': bill_id, 'transaction_id': transaction_id,
+        'debit_account': debit_account, 'credit_account': credit_account, 'amount': amount,
+        'created_at': created_at or datetime.utcnow(), 'backfilled': backfilled,
+    }
+
+
+def balance_delta():
+    """What an entry adds to its patient's balance."""
+    return case(
+        (LedgerEntry.debit_account == 'receivable', LedgerEntry.amount),
+        (LedgerEntry.credit_account == 'receivable', -LedgerEntry.amount),
+        else_=0,
+    )
+
+
+def _bill_patients(connection, bill_ids):
+    # The bill may have been archived since the payment started
+    rows = connection.execute(union_all(
+        select(Bill.id, Bill.patient_id).where(Bill.id.in_(bill_ids)),
+        select(BillArchive.id, BillArchive.patient_id).where(BillArchive.id.in_(bill_ids)),
+    ))
+    return dict(rows.all())
+
+
+@event.listens_for(Session, 'after_flush')
+def _post_entries(session, flush_context):
+    now = datetime.utcnow()
+    rows = []
+    paid = []
+    for obj in session.new:
+        if isinstance(obj, Bill):
+            rows.append(entry('charge', obj.patient_id, to_minor(obj.amount), bill_id=obj.id, created_at=now))
+        elif isinstance(obj, Transaction) and obj.status == 'Paid':
+            paid.append(obj)
+    for obj in session.dirty:
+        if isinstance(obj, Transaction) and 'Paid' in inspect(obj).attrs.status.history.added:
+            paid.append(obj)
+
+    if paid:
+        connection = session.connection()
+        # A payment is only posted once, whatever its status does afterwards
+        posted = set(connection.execute(
+            select(LedgerEntry.transaction_id)
+            .where(LedgerEntry.kind == 'payment', LedgerEntry.transaction_id.in_([obj.id for obj in paid]))
+        ).scalars())
+        patients = _bill_patients(connection, {obj.bill_id for obj in paid})
+        for obj in paid:
+            if obj.id not in posted and obj.bill_id in patients:
+                rows.append(entry('payment', patients[obj.bill_id], to_minor(obj.amount),
+                                  bill_id=obj.bill_id, transaction_id=obj.id, created_at=now))
+    if rows:
+        session.connection().execute(insert(LedgerEntry), rows)
+        bump_versions(session.connection(), [LedgerEntry.__tablename__])
+
+
+def balance(patient_id, as_of=None):
+    """(balance in minor units, id of the last entry counted) of a patient, now or
+    as it stood at as_of (a UTC datetime), by entry date. as_of should not be
+    before history_start(patient_id)."""
+    upto = select(LedgerEntry.id).order_by(LedgerEntry.created_at.desc(), LedgerEntry.id.desc()).limit(1)
+    if as_of is not None:
+        upto = upto.where(LedgerEntry.created_at <= as_of)
+    upto = db.session.execute(upto).scalar() or 0
+
+    snapshot = db.session.execute(
+        select(LedgerSnapshot.entry_id, LedgerSnapshot.balance)
+        .where(LedgerSnapshot.patient_id == patient_id, LedgerSnapshot.entry_id <= upto)
+        .order_by(LedgerSnapshot.entry_id.desc()).limit(1)
+    ).first()
+    start, opening = snapshot if snapshot else (0, 0)
+    since = db.session.execute(
+        select(func.coalesce(func.sum(balance_delta()), 0))
+        .where(LedgerEntry.patient_id == patient_id, LedgerEntry.id > start, LedgerEntry.id <= upto)
+    ).scalar()
+    return opening + since, upto
+
+
+def history_start(patient_id):
+    """Earliest time a balance of the patient can be given as of: when their
+    latest backfilled entry was posted, or None if none of their entries were."""
+    return db.session.execute(
+        select(func.max(LedgerEntry.created_at))
+        .where(LedgerEntry.patient_id == patient_id, LedgerEntry.backfilled.is_(True))
+    ).scalar()
+
+
+def refunded(transaction_id):
+    return db.session.execute(
+        select(func.coalesce(func.sum(LedgerEntry.amount), 0))
+        .where(LedgerEntry.kind == 'refund', LedgerEntry.transaction_id == transaction_id)
+    ).scalar()
+
+
+ledger_cli = AppGroup('ledger', help='Post, snapshot and verify the payment ledger.')
+
+
+def _in_batches(connection, query, batch_size):
+    """Rows of query (ordered by its first column, an id) batch by batch."""
+    last_id = None
+    while True:
+        page = query if last_id is None else query.where(query.selected_columns[0] > last_id)
+        rows = connection.execute(page.limit(batch_size)).all()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+@ledger_cli.command('backfill')
+@click.option('--batch-size', type=int, help='Rows per transaction. Defaults to LEDGER_BATCH_SIZE.')
+def backfill_command(batch_size):
+    """Post charges for bills and payments for paid transactions the ledger is missing.
+
+    The entries are dated now, and balances of their patients can't be asked for
+    as of an earlier time."""
+    batch_size = batch_size or current_app.config['LEDGER_BATCH_SIZE']
+    charged = select(LedgerEntry.bill_id).where(LedgerEntry.kind == 'charge')
+    paid = select(LedgerEntry.transaction_id).where(LedgerEntry.kind == 'payment')
+    counts = {'charge': 0, 'payment': 0}
+    with db.engine.connect() as connection:
+        for model in (BillArchive, Bill):
+            query = (select(model.id, model.patient_id, model.amount)
+                     .where(model.id.not_in(charged)).order_by(model.id))
+            for rows in _in_batches(connection, query, batch_size):
+                connection.execute(insert(LedgerEntry), [
+                    entry('charge', row.patient_id, to_minor(row.amount), bill_id=row.id, backfilled=True)
+                    for row in rows
+                ])
+                bump_versions(connection, [LedgerEntry.__tablename__])
+                connection.commit()
+                counts['charge'] += len(rows)
+        for model in (TransactionArchive, Transaction):
+            query = (select(model.id, model.bill_id, model.amount)
+                     .where(model.status.in_(SETTLED_STATUSES), model.id.not_in(paid)).order_by(model.id))
+            for rows in _in_batches(connection, query, batch_size):
+                patients = _bill_patients(connection, {row.bill_id for row in rows})
+                entries = [entry('payment', patients[row.bill_id], to_minor(row.amount),
+                                 bill_id=row.bill_id, transaction_id=row.id, backfilled=True)
+                           for row in rows if row.bill_id in patients]
+                if entries:
+                    connection.execute(insert(LedgerEntry), entries)
+                    bump_versions(connection, [LedgerEntry.__tablename__])
+                connection.commit()
+                counts['payment'] += len(entries)
+    for kind, count in counts.items():
+        click.echo(f'{kind:<10}{count:>12,}')
+
+
+@ledger_cli.command('snapshot')
+def snapshot_command():
+    """Store the balance of every patient with entries since the last snapshot.
+
+    Assumes entries are committed in id order, as on SQLite; elsewhere run it
+    while nothing is being posted."""
+    with db.engine.begin() as connection:
+        since = connection.execute(select(func.coalesce(func.max(LedgerSnapshot.entry_id), 0))).scalar()
+        upto = connection.execute(select(func.coalesce(func.max(LedgerEntry.id), 0))).scalar()
+        changes = dict(connection.execute(
+            select(LedgerEntry.patient_id, func.sum(balance_delta()))
+            .where(LedgerEntry.id > since, LedgerEntry.id <= upto).group_by(LedgerEntry.patient_id)
+        ).all())
+        if changes:
+            # Each patient's latest snapshot; every earlier run covered all its entries
+            latest = (select(LedgerSnapshot.patient_id, func.max(LedgerSnapshot.entry_id).label('entry_id'))
+                      .where(LedgerSnapshot.patient_id.in_(changes)).group_by(LedgerSnapshot.patient_id)
+                      .subquery())
+            opening = dict(connection.execute(
+                select(LedgerSnapshot.patient_id, LedgerSnapshot.balance).join(latest, (
+                    (LedgerSnapshot.patient_id == latest.c.patient_id)
+                    & (LedgerSnapshot.entry_id == latest.c.entry_id)))
+            ).all())
+            now = datetime.utcnow()
+            connection.execute(insert(LedgerSnapshot), [
+                {'patient_id': patient_id, 'entry_id': upto, 'balance': opening.get(patient_id, 0) + delta,
+                 'taken_at': now}
+                for patient_id, delta in changes.items()
+            ])
+    click.echo(f'Snapshot {len(changes):,} patient balances up to entry {upto:,}')
+
+
+@ledger_cli.command('verify')
+@click.option('--batch-size', type=int, help='Rows per query. Defaults to LEDGER_BATCH_SIZE.')
+def verify_command(batch_size):
+    """Check the ledger adds up and agrees with bills, transactions and snapshots."""
+    batch_size = batch_size or current_app.config['LEDGER_BATCH_SIZE']
+    problems = 0
+
+    def report(check, count):
+        nonlocal problems
+        problems += count
+        click.echo(f'{check:<44}{"ok" if not count else f"{count:,} wrong":>12}')
+
+    with db.engine.connect() as connection:
+        # Trial balance: each posting debits and credits the same amount, so the
+        # accounts must sum to zero
+        accounts = {}
+        for account, debits, credits in connection.execute(union_all(
+            select(LedgerEntry.debit_account, func.sum(LedgerEntry.amount), 0).group_by(LedgerEntry.debit_account),
+            select(LedgerEntry.credit_account, 0, func.sum(LedgerEntry.amount)).group_by(LedgerEntry.credit_account),
+        )):
+            accounts[account] = accounts.get(account, 0) + debits - credits
+        for account, total in sorted(accounts.items()):
+            click.echo(f'{account:<32}{format_minor(total):>24}')
+        report('accounts sum to zero', int(sum(accounts.values()) != 0))
+
+        report('entries are well formed', connection.execute(
+            select(func.count()).select_from(LedgerEntry).where(or_(LedgerEntry.amount <= 0, ~or_(*(
+                and_(LedgerEntry.kind == kind, LedgerEntry.debit_account == debit, LedgerEntry.credit_account == credit)
+                for kind, (debit, credit) in POSTINGS.items()
+            ))))
+        ).scalar())
+
+        def compare(models, kind, key):
+            """Rows of models whose amount differs from their entries of kind."""
+            wrong = 0
+            for model in models:
+                query = select(model.id, model.amount).order_by(model.id)
+                if model in (Transaction, TransactionArchive):
+                    query = query.where(model.status.in_(SETTLED_STATUSES))
+                for rows in _in_batches(connection, query, batch_size):
+                    posted = dict(connection.execute(
+                        select(key, func.sum(LedgerEntry.amount))
+                        .where(LedgerEntry.kind == kind, key.in_([row.id for row in rows])).group_by(key)
+                    ).all())
+                    wrong += sum(1 for row in rows if posted.get(row.id) != to_minor(row.amount))
+            return wrong
+
+        report('bills charged their amount', compare((Bill, BillArchive), 'charge', LedgerEntry.bill_id))
+        report('paid transactions posted once, in full', compare(
+            (Transaction, TransactionArchive), 'payment', LedgerEntry.transaction_id))
+
+        refunds = select(LedgerEntry.transaction_id, func.sum(LedgerEntry.amount).label('amount')).where(
+            LedgerEntry.kind == 'refund').group_by(LedgerEntry.transaction_id).subquery()
+        payments = select(LedgerEntry.transaction_id, func.sum(LedgerEntry.amount).label('amount')).where(
+            LedgerEntry.kind == 'payment').group_by(LedgerEntry.transaction_id).subquery()
+        report('refunds within their payment', connection.execute(
+            select(func.count()).select_from(refunds)
+            .outerjoin(payments, payments.c.transaction_id == refunds.c.transaction_id)
+            .where(refunds.c.amount > func.coalesce(payments.c.amount, 0))
+        ).scalar())
+
+        snapshots = connection.execute(
+            select(LedgerSnapshot.patient_id, LedgerSnapshot.entry_id, LedgerSnapshot.balance)
+        ).all()
+        wrong = 0
+        for patient_id, entry_id, snapshot_balance in snapshots:
+            actual = connection.execute(
+                select(func.coalesce(func.sum(balance_delta()), 0))
+                .where(LedgerEntry.patient_id == patient_id, LedgerEntry.id <= entry_id)
+            ).scalar()
+            wrong += actual != snapshot_balance
+        report('snapshots match the entries', wrong)
+
+    if problems:
+        raise click.ClickException(f'{problems:,} problems found')
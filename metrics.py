@@ -0,0 +1,315 @@
+import glob
+import json
+import os
+import threading
+import time
+from functools import wraps
+from flask import g, request, has_app_context
+from db import db
+
+# Process-local metrics in Prometheus exposition format.
+#
+# Every worker keeps its own counters under one cheap lock. When METRICS_DIR is
+# set, workers periodically write a snapshot to METRICS_DIR/metrics-<pid>.json
+# and /metrics sums the snapshots of all workers, so a scrape served by any one
+# worker covers the whole gunicorn master. When a worker exits the master folds
+# its counters into METRICS_DIR/retired.json and removes its snapshot (so a new
+# worker reusing the pid starts clean), and the directory is emptied when the
+# master starts (gunicorn.conf.py).
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+_gauges = {}      # (name, labels) -> value
+_gauge_callbacks = []
+_help = {}
+_last_flush = 0.0
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def describe(name, kind, text):
+    _help[name] = (kind, text)
+
+
+def inc(name, amount=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def set_gauge(name, value, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _gauges[key] = value
+
+
+def add_gauge(name, amount, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _gauges[key] = _gauges.get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+    key = _key(name, labels)
+    with _lock:
+        series = _histograms.get(key)
+        if series is None:
+            series = _histograms[key] = [0] * len(LATENCY_BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+
+def gauge_callback(func):
+    """Register func() -> iterable of (name, labels, value), sampled at scrape time."""
+    _gauge_callbacks.append(func)
+    return func
+
+
+def cache_hit(cache):
+    inc('cache_requests_total', cache=cache, result='hit')
+
+
+def cache_miss(cache):
+    inc('cache_requests_total', cache=cache, result='miss')
+
+
+def timed_call(name, **labels):
+    """Decorator recording the duration of outbound calls and counting the ones that raise."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                inc(f'{name}_errors_total', **labels)
+                raise
+            finally:
+                observe(f'{name}_duration_seconds', time.perf_counter() - start, **labels)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    with _lock:
+        state = {
+            'counters': [[name, list(labels), value] for (name, labels), value in _counters.items()],
+            'histograms': [[name, list(labels), list(series)] for (name, labels), series in _histograms.items()],
+            'gauges': [[name, list(labels), value] for (name, labels), value in _gauges.items()],
+        }
+    for callback in _gauge_callbacks:
+        for name, labels, value in callback():
+            state['gauges'].append([name, sorted(labels.items()), value])
+    return state
+
+
+def flush(directory):
+    """Write this worker's snapshot for the other workers' /metrics to pick up."""
+    global _last_flush
+    _last_flush = time.monotonic()
+    _write(os.path.join(directory, f'metrics-{os.getpid()}.json'), snapshot())
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write(path, state):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def _merge(states):
+    counters, histograms, gauges = {}, {}, {}
+    for state in states:
+        for name, labels, value in state['counters']:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, series in state['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            if key in histograms:
+                histograms[key] = [a + b for a, b in zip(histograms[key], series)]
+            else:
+                histograms[key] = list(series)
+        for name, labels, value in state['gauges']:
+            key = (name, tuple(map(tuple, labels)))
+            gauges[key] = gauges.get(key, 0) + value
+    return counters, histograms, gauges
+
+
+def retire(directory, pid):
+    """Fold an exited worker's counters and histograms into retired.json and
+    remove its snapshot. Called by the master, one worker at a time."""
+    path = os.path.join(directory, f'metrics-{pid}.json')
+    state = _read(path)
+    if state is not None:
+        retired_path = os.path.join(directory, 'retired.json')
+        retired = _read(retired_path) or {'counters': [], 'histograms': [], 'gauges': []}
+        # Gauges describe a live process and go with it
+        state['gauges'] = []
+        counters, histograms, _ = _merge([retired, state])
+        _write(retired_path, {
+            'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+            'histograms': [[name, list(labels), series] for (name, labels), series in histograms.items()],
+            'gauges': [],
+        })
+    for stale in (path, f'{path}.tmp'):
+        try:
+            os.remove(stale)
+        except FileNotFoundError:
+            pass
+
+
+def clear(directory):
+    """Remove every snapshot, e.g. left over from a previous master."""
+    for path in glob.glob(os.path.join(directory, '*.json')) + glob.glob(os.path.join(directory, '*.json.tmp')):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def collect(directory=None):
+    """Merge this worker's live state with the other workers' latest snapshots."""
+    states = [snapshot()]
+    if directory:
+        own = os.path.join(directory, f'metrics-{os.getpid()}.json')
+        for path in glob.glob(os.path.join(directory, 'metrics-*.json')):
+            if path == own:
+                continue
+            state = _read(path)
+            if state is None:
+                continue
+            pid = int(os.path.basename(path)[len('metrics-'):-len('.json')])
+            # Until the master retires an exited worker its gauges no longer apply
+            if not _pid_alive(pid):
+                state['gauges'] = []
+            states.append(state)
+        retired = _read(os.path.join(directory, 'retired.json'))
+        if retired is not None:
+            states.append(retired)
+    return _merge(states)
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def render(directory=None):
+    counters, histograms, gauges = collect(directory)
+    lines = []
+    seen = set()
+
+    def header(name, kind):
+        if name not in seen:
+            seen.add(name)
+            if name in _help:
+                lines.append(f'# HELP {name} {_help[name][1]}')
+            lines.append(f'# TYPE {name} {kind}')
+
+    for (name, labels), value in sorted(counters.items()):
+        header(name, 'counter')
+        lines.append(f'{name}{_format_labels(labels)} {value}')
+    for (name, labels), value in sorted(gauges.items()):
+        header(name, 'gauge')
+        lines.append(f'{name}{_format_labels(labels)} {value}')
+    for (name, labels), series in sorted(histograms.items()):
+        header(name, 'histogram')
+        for bound, count in zip(LATENCY_BUCKETS, series):
+            lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {count}')
+        lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {series[-1]}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {series[-2]}')
+        lines.append(f'{name}_count{_format_labels(labels)} {series[-1]}')
+    return '\n'.join(lines) + '\n'
+
+
+describe('http_requests_total', 'counter', 'HTTP requests by endpoint and status.')
+describe('http_request_duration_seconds', 'histogram', 'HTTP request latency by endpoint.')
+describe('http_requests_in_flight', 'gauge', 'Requests currently being handled.')
+describe('mpesa_request_duration_seconds', 'histogram', 'Latency of outbound M-Pesa API calls.')
+describe('mpesa_request_errors_total', 'counter', 'Outbound M-Pesa API calls that failed.')
+describe('db_pool_checked_out', 'gauge', 'Database connections currently checked out of the pool.')
+describe('db_pool_size', 'gauge', 'Configured database connection pool size.')
+describe('cache_requests_total', 'counter', 'Cache lookups by cache and result.')
+
+
+@gauge_callback
+def _db_pool_gauges():
+    if not has_app_context():
+        return
+    for bind, engine in db.engines.items():
+        pool = engine.pool
+        labels = {'bind': bind or 'default'}
+        if hasattr(pool, 'checkedout'):
+            yield 'db_pool_checked_out', labels, pool.checkedout()
+        if hasattr(pool, 'size'):
+            yield 'db_pool_size', labels, pool.size()
+
+
+def _start_request():
+    g.metrics_start = time.perf_counter()
+    add_gauge('http_requests_in_flight', 1)
+
+
+def _finish_request(app):
+    def finish(response):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return response
+        add_gauge('http_requests_in_flight', -1)
+
+        # Label by endpoint rather than path so ids don't create new series
+        endpoint = request.endpoint or 'unmatched'
+        observe('http_request_duration_seconds', time.perf_counter() - start,
+                method=request.method, endpoint=endpoint)
+        inc('http_requests_total', method=request.method, endpoint=endpoint, status=str(response.status_code))
+
+        directory = app.config['METRICS_DIR']
+        if directory and time.monotonic() - _last_flush >= app.config['METRICS_FLUSH_INTERVAL']:
+            flush(directory)
+        return response
+    return finish
+
+
+def _abort_request(error):
+    # after_request doesn't run when a view raises, keep the in-flight gauge honest
+    if g.pop('metrics_start', None) is not None:
+        add_gauge('http_requests_in_flight', -1)
+
+
+def init_metrics(app):
+    if not app.config['METRICS_ENABLED']:
+        return
+    if app.config['METRICS_DIR']:
+        os.makedirs(app.config['METRICS_DIR'], exist_ok=True)
+    app.before_request(_start_request)
+    app.after_request(_finish_request(app))
+    app.teardown_request(_abort_request)
@@ -0,0 +1,87 @@
+import zlib
+from flask import request, current_app
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+# Suffix added to a response's ETag per content coding, since a compressed body
+# is a different representation. middleware.etag strips it when comparing.
+ETAG_SUFFIXES = ('-gzip', '-br')
+
+
+def _choose_encoding():
+    accepted = request.accept_encodings
+    gzip_quality = accepted['gzip']
+    if brotli is not None and accepted['br'] and accepted['br'] >= gzip_quality:
+        return 'br'
+    if gzip_quality:
+        return 'gzip'
+    return None
+
+
+def _gzip_compressor(level):
+    # wbits=31 writes a gzip header and trailer around the deflate stream
+    return zlib.compressobj(level, zlib.DEFLATED, 31)
+
+
+def _compress_body(data, encoding):
+    config = current_app.config
+    if encoding == 'br':
+        return brotli.compress(data, quality=config['COMPRESSION_BROTLI_LEVEL'])
+    compressor = _gzip_compressor(config['COMPRESSION_LEVEL'])
+    return compressor.compress(data) + compressor.flush()
+
+
+def _compress_stream(chunks, encoding, level, brotli_level):
+    # Flush after every chunk so streamed events reach the client right away
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=brotli_level)
+        for chunk in chunks:
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+    else:
+        compressor = _gzip_compressor(level)
+        for chunk in chunks:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+
+def compress_response(response):
+    config = current_app.config
+    if not config['COMPRESSION_ENABLED']:
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    if (
+        response.status_code < 200
+        or response.status_code in (204, 304)
+        or response.direct_passthrough
+        or 'Content-Encoding' in response.headers
+        or response.mimetype not in config['COMPRESSION_MIMETYPES']
+        or 'no-transform' in (response.headers.get('Cache-Control') or '')
+    ):
+        return response
+
+    encoding = _choose_encoding()
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(
+            response.iter_encoded(), encoding, config['COMPRESSION_LEVEL'], config['COMPRESSION_BROTLI_LEVEL']
+        )
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < config['COMPRESSION_MIN_SIZE']:
+            return response
+        response.set_data(_compress_body(data, encoding))
+
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f'{etag}-{encoding}', weak=weak)
+    return response
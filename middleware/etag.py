@@ -0,0 +1,100 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import request, current_app, make_response
+from db import db
+from versioning import get_versions
+from middleware.compression import ETAG_SUFFIXES
+import metrics
+
+
+def build_etag(tables):
+    versions = get_versions(db.session, tables)
+    key = '|'.join([
+        request.endpoint or '',
+        repr(sorted((request.view_args or {}).items())),
+        repr(sorted(request.args.items(multi=True))),
+        ','.join(f'{name}={version}' for name, version in zip(tables, versions)),
+    ])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def not_modified(etag):
+    """304 response if the client already holds etag, else None."""
+    # Clients echo back the tag of the representation they got, which may carry
+    # a content-coding suffix
+    for candidate in (etag,) + tuple(etag + suffix for suffix in ETAG_SUFFIXES):
+        if request.if_none_match.contains_weak(candidate):
+            response = current_app.response_class(status=304)
+            response.set_etag(candidate)
+            return response
+    return None
+
+
+class ResponseCache:
+    """Process-local LRU of response bodies by ETag. The ETag changes with the
+    versions of the tables read, so a hit is never stale; the TTL only bounds
+    how long an unused body is kept."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # etag -> (expires, body, mimetype)
+
+    def get(self, etag):
+        with self._lock:
+            entry = self._entries.get(etag)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[etag]
+                return None
+            self._entries.move_to_end(etag)
+            return entry[1:]
+
+    def put(self, etag, body, mimetype, ttl, max_size):
+        with self._lock:
+            self._entries[etag] = (time.monotonic() + ttl, body, mimetype)
+            self._entries.move_to_end(etag)
+            while len(self._entries) > max_size:
+                self._entries.popitem(last=False)
+
+
+response_cache = ResponseCache()
+
+
+# Answer conditional GETs from the version counters of the tables a view reads,
+# before the view runs any of its own queries. With cache_ttl, the name of a
+# config setting in seconds, 200 responses are also kept in response_cache
+# while that setting is above zero.
+def etag_versioned(*tables, cache_ttl=None):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            etag = build_etag(tables)
+            response = not_modified(etag)
+            if response is not None:
+                metrics.cache_hit('etag')
+                return response
+
+            metrics.cache_miss('etag')
+            ttl = current_app.config[cache_ttl] if cache_ttl else 0
+            if ttl > 0:
+                cached = response_cache.get(etag)
+                if cached is not None:
+                    metrics.cache_hit('response')
+                    response = current_app.response_class(cached[0], mimetype=cached[1])
+                    response.set_etag(etag)
+                    return response
+                metrics.cache_miss('response')
+
+            response = make_response(func(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+                if ttl > 0:
+                    response_cache.put(etag, response.get_data(), response.mimetype, ttl,
+                                       current_app.config['RESPONSE_CACHE_SIZE'])
+            return response
+        return wrapper
+    return decorator
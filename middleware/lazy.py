@@ -0,0 +1,39 @@
+import threading
+
+# Setup deferred to the first request, so processes that never serve one (CLI
+# commands, tests that only need the models) don't pay for it.
+
+
+class LazySetup:
+    """WSGI wrapper running setup(app) once, ahead of the first request.
+
+    Flask refuses new routes once it has handled a request, so this has to wrap
+    app.wsgi_app rather than be a before_request hook."""
+
+    def __init__(self, app, setup):
+        self.app = app
+        self.setup = setup
+        self.wsgi_app = app.wsgi_app
+        self.done = False
+        self._lock = threading.Lock()
+        app.extensions['lazy_setup'] = self
+
+    def load(self):
+        if self.done:
+            return
+        with self._lock:
+            if not self.done:
+                self.setup(self.app)
+                self.done = True
+
+    def __call__(self, environ, start_response):
+        if not self.done:
+            self.load()
+        return self.wsgi_app(environ, start_response)
+
+
+def ensure_loaded(app):
+    """Run the deferred setup now, if there is one."""
+    lazy = app.extensions.get('lazy_setup')
+    if lazy is not None:
+        lazy.load()
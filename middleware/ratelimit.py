@@ -0,0 +1,124 @@
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, has_app_context, jsonify
+import metrics
+
+try:
+    import redis
+except ImportError:  # redis is optional, buckets are kept per process without it
+    redis = None
+
+# Token-bucket rate limiting. A bucket holds up to `limit` tokens and refills at
+# limit/window tokens a second; every attempt takes one and attempts find it
+# empty are rejected. Buckets live in this process, or in Redis when
+# RATELIMIT_STORAGE_URL is set so all workers (and hosts) share them.
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBuckets:
+    """In-process buckets: key -> (tokens, updated at), least recently used
+    evicted beyond max_keys. An evicted bucket comes back full."""
+
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def take(self, key, limit, window, now=None):
+        """Take a token; returns 0 if there was one, else seconds until there is."""
+        now = time.monotonic() if now is None else now
+        rate = limit / window
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (limit, now))
+            tokens = min(limit, tokens + (now - updated) * rate)
+            retry_after = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not retry_after:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class RedisTokenBuckets:
+    """The same buckets in Redis, updated atomically by a Lua script. Falls back
+    to the in-process buckets while Redis can't be reached."""
+
+    SCRIPT = """
+    local limit, rate, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(state[1]) or limit
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(limit, tokens + math.max(0, now - updated) * rate)
+    local allowed = tokens >= 1
+    if allowed then tokens = tokens - 1 end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(limit / rate) + 1)
+    return {allowed and 1 or 0, tostring(tokens)}
+    """
+
+    def __init__(self, url, fallback):
+        self.client = redis.Redis.from_url(url, socket_timeout=0.1)
+        self.script = self.client.register_script(self.SCRIPT)
+        self.fallback = fallback
+
+    def take(self, key, limit, window, now=None):
+        rate = limit / window
+        try:
+            allowed, tokens = self.script(keys=[f'ratelimit:{key}'], args=[limit, rate, time.time()])
+        except redis.RedisError:
+            logger.warning('Rate limit store unavailable, using per-process buckets', exc_info=True)
+            return self.fallback.take(key, limit, window, now)
+        return 0 if int(allowed) else (1 - float(tokens)) / rate
+
+    def __len__(self):
+        return len(self.fallback)
+
+
+def init_ratelimit(app):
+    buckets = TokenBuckets(app.config['RATELIMIT_MAX_KEYS'])
+    url = app.config['RATELIMIT_STORAGE_URL']
+    if url and redis is not None:
+        buckets = RedisTokenBuckets(url, buckets)
+    elif url:
+        logger.warning('RATELIMIT_STORAGE_URL is set but redis is not installed, using per-process buckets')
+    app.extensions['ratelimit'] = buckets
+
+
+def hit(name, key, limit_setting, window_setting):
+    """Count an attempt against the `name` bucket of key, with its limit and window
+    read from the given config settings. Returns 0 if it is allowed, else the
+    seconds until it would be."""
+    config = current_app.config
+    if not config['RATELIMIT_ENABLED']:
+        return 0
+    retry_after = current_app.extensions['ratelimit'].take(
+        f'{name}:{key}', config[limit_setting], config[window_setting]
+    )
+    if retry_after:
+        metrics.inc('ratelimit_rejected_total', limiter=name)
+    return retry_after
+
+
+def too_many_requests(retry_after, message='Too many attempts, try again later'):
+    response = jsonify({"message": message})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(math.ceil(retry_after))
+    return response
+
+
+metrics.describe('ratelimit_rejected_total', 'counter', 'Attempts rejected by a rate limiter.')
+metrics.describe('ratelimit_tracked_keys', 'gauge', 'Rate limit buckets held in this process.')
+
+
+@metrics.gauge_callback
+def _tracked_keys():
+    if has_app_context() and 'ratelimit' in current_app.extensions:
+        yield 'ratelimit_tracked_keys', {}, len(current_app.extensions['ratelimit'])
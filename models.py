@@ -1,19 +1,89 @@
 from db import db
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import current_app, has_app_context
+from config import Config
+import hashing
+import base64
+import zlib
+from datetime import datetime
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, zlib is always available
+    zstandard = None
+
+# Compressed values are stored as text: marker + codec + ':' + base64 payload
+COMPRESSED_MARKER = '\x1b'
+
+
+def _compression_setting(name):
+    if has_app_context():
+        return current_app.config.get(name, getattr(Config, name))
+    return getattr(Config, name)
+
+
+def compress_text(value, codec, threshold):
+    data = value.encode('utf-8')
+    if codec == 'none' or len(data) <= threshold:
+        return value
+    if codec == 'zstd' and zstandard is not None:
+        payload = zstandard.ZstdCompressor().compress(data)
+    else:
+        codec = 'zlib'
+        payload = zlib.compress(data)
+
+    encoded = COMPRESSED_MARKER + codec + ':' + base64.b64encode(payload).decode('ascii')
+    # Keep the plain text if compressing didn't actually save anything
+    return encoded if len(encoded) < len(data) else value
+
+
+def decompress_text(value):
+    if not value or not value.startswith(COMPRESSED_MARKER):
+        return value
+    codec, _, payload = value[1:].partition(':')
+    data = base64.b64decode(payload)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Record is zstd-compressed but the zstandard package is not installed")
+        return zstandard.ZstdDecompressor().decompress(data).decode('utf-8')
+    return zlib.decompress(data).decode('utf-8')
+
+
+class CompressedText(db.TypeDecorator):
+    """Text column that transparently compresses large values at rest."""
+    impl = db.Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return value
+        return compress_text(
+            value,
+            _compression_setting('RECORD_COMPRESSION'),
+            _compression_setting('RECORD_COMPRESSION_THRESHOLD'),
+        )
+
+    def process_result_value(self, value, dialect):
+        return decompress_text(value)
+
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(50), unique=True, nullable=False)
-    password_hash = db.Column(db.String(100), nullable=False)
+    password_hash = db.Column(db.String(255), nullable=False)
     doctor_id = db.Column(db.String(100), nullable=True)
     patient_id = db.Column(db.String(100), nullable=True)
     role = db.Column(db.Integer, nullable=False, default=1)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hashing.hash_password(password)
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        # A hash made with an older method or cost is replaced while the
+        # password is at hand; the caller commits it
+        matches, new_hash = hashing.verify_password(self.password_hash, password)
+        if new_hash is not None:
+            self.password_hash = new_hash
+        return matches
     
     def set_role(self, role):
         if 1 <= role <= 3:
@@ -28,6 +98,15 @@ class User(db.Model):
         self.patient_id = patient_id
         
 class Doctor(db.Model):
+    # Deleted doctors are left out of every ORM query (soft_delete.py); the
+    # partial indexes only hold the rows each side needs
+    __table_args__ = (
+        db.Index('ix_doctor_specialization_live', 'specialization',
+                 sqlite_where=db.text('deleted_at IS NULL'), postgresql_where=db.text('deleted_at IS NULL')),
+        db.Index('ix_doctor_deleted', 'deleted_at',
+                 sqlite_where=db.text('deleted_at IS NOT NULL'), postgresql_where=db.text('deleted_at IS NOT NULL')),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(50))
     first_name = db.Column(db.String(50))
@@ -44,9 +123,17 @@ class Doctor(db.Model):
     start_of_employment = db.Column(db.String(10))
     emergency_contact = db.Column(db.String(15))
     emergency_contact_country_code = db.Column(db.String(5))
+    deleted_at = db.Column(db.DateTime, nullable=True)  # set by DELETE, the row goes at the next purge
 
 
 class Patient(db.Model):
+    __table_args__ = (
+        db.Index('ix_patient_doctor_live', 'doctor_id',
+                 sqlite_where=db.text('deleted_at IS NULL'), postgresql_where=db.text('deleted_at IS NULL')),
+        db.Index('ix_patient_deleted', 'deleted_at',
+                 sqlite_where=db.text('deleted_at IS NOT NULL'), postgresql_where=db.text('deleted_at IS NOT NULL')),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     first_name = db.Column(db.String(50))
     last_name = db.Column(db.String(50))
@@ -57,8 +144,17 @@ class Patient(db.Model):
     address = db.Column(db.String(200))
     doctor_id = db.Column(db.Integer)  # Foreign key to doctors table
     emergency_contact_phone_number = db.Column(db.String(15))
+    deleted_at = db.Column(db.DateTime, nullable=True)  # set by DELETE, the row goes at the next purge
 
 class Appointment(db.Model):
+    # A patient's or doctor's appointments, newest first, straight off the index.
+    # AUTOINCREMENT because archived ids (archive.py) must never be handed out again.
+    __table_args__ = (
+        db.Index('ix_appointment_patient_created', 'patient_id', 'created_at'),
+        db.Index('ix_appointment_doctor_created', 'doctor_id', 'created_at'),
+        {'sqlite_autoincrement': True},
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'))
     doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'))
@@ -71,23 +167,33 @@ class Appointment(db.Model):
     updated_at = db.Column(db.DateTime, default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
 
 class Record(db.Model):
+    __table_args__ = (db.Index('ix_record_patient_created', 'patient_id', 'creation_date'),)
+
     id = db.Column(db.Integer, primary_key=True)
     subject = db.Column(db.String(255), nullable=False)  
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)  
     creation_date = db.Column(db.DateTime, default=db.func.current_timestamp()) 
-    record = db.Column(db.Text, nullable=False)  
+    # Bodies can be large, so they are only loaded when explicitly asked for
+    record = db.deferred(db.Column(CompressedText, nullable=False))
 
     def __repr__(self):
         return f"<Record {self.subject} for Patient {self.patient_id}>"
 
 class Bill(db.Model):
     __tablename__ = 'bills'
+    __table_args__ = (
+        db.Index('ix_bills_patient_created', 'patient_id', 'creation_date'),
+        # Covers the aging report (aging.py): outstanding bills by age and doctor
+        db.Index('ix_bills_status_created', 'status', 'creation_date', 'appointment_id', 'amount'),
+        # Archived ids (archive.py) must never be handed out again
+        {'sqlite_autoincrement': True},
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     status = db.Column(db.String(50), nullable=False, default="Pending")  # Example statuses: "Paid", "Pending", etc.
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
-    appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.id'), nullable=True)
-    transaction_id = db.Column(db.Integer, db.ForeignKey('transactions.id'), nullable=True)
+    appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.id'), nullable=True, index=True)
+    transaction_id = db.Column(db.Integer, db.ForeignKey('transactions.id'), nullable=True, index=True)
     creation_date = db.Column(db.DateTime, default=db.func.current_timestamp()) 
     amount = db.Column(db.Float, nullable=False)
     description = db.Column(db.String(200))
@@ -96,10 +202,16 @@ class Bill(db.Model):
 
 class Transaction(db.Model):
     __tablename__ = 'transactions'
+    # Stale pending payments for `flask reconcile-mpesa`. AUTOINCREMENT because
+    # archived ids (archive.py) must never be handed out again.
+    __table_args__ = (
+        db.Index('ix_transactions_status_date', 'status', 'transaction_date'),
+        {'sqlite_autoincrement': True},
+    )
     
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    checkout_request_id = db.Column(db.String, nullable=False)
-    bill_id = db.Column(db.Integer, nullable=False)
+    checkout_request_id = db.Column(db.String, nullable=False, index=True)
+    bill_id = db.Column(db.Integer, nullable=False, index=True)
     status = db.Column(db.String, nullable=False)
     amount = db.Column(db.Float, nullable=False)
     paying_phone_number = db.Column(db.String, nullable=False)
@@ -108,3 +220,82 @@ class Transaction(db.Model):
     
     def __repr__(self):
         return f'<Transaction {self.id}>'
+
+class ResourceVersion(db.Model):
+    __tablename__ = 'resource_versions'
+
+    # One row per table, bumped in the same transaction as every write to it
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+def _archive_model(name, model, indexed=()):
+    """Mapped copy of model's table for rows the archival job (archive.py) moves out.
+
+    Same columns, without foreign keys, defaults or unique constraints, so rows can
+    be copied across as they are."""
+    columns = {
+        column.key: db.Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable,
+                              autoincrement=False, index=column.key in indexed)
+        for column in model.__table__.columns
+    }
+    return type(name, (db.Model,), {'__tablename__': f'{model.__tablename__}_archive', **columns})
+
+AppointmentArchive = _archive_model('AppointmentArchive', Appointment, indexed=('patient_id', 'doctor_id'))
+BillArchive = _archive_model('BillArchive', Bill, indexed=('patient_id',))
+TransactionArchive = _archive_model('TransactionArchive', Transaction)
+
+class ChangeEvent(db.Model):
+    __tablename__ = 'change_events'
+    # AUTOINCREMENT so sequence numbers are never reused, even once old events are pruned
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    # Outbox row written in the same transaction as the change it describes (changes.py)
+    seq = db.Column(db.Integer, primary_key=True)
+    resource = db.Column(db.String(50), nullable=False)
+    resource_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(10), nullable=False)  # 'created', 'updated' or 'deleted'
+    changed_at = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp(), index=True)
+
+class LedgerEntry(db.Model):
+    __tablename__ = 'ledger_entries'
+    # Append-only, so ids follow posting order. AUTOINCREMENT so none is ever reused.
+    __table_args__ = (
+        db.Index('ix_ledger_patient_entry', 'patient_id', 'id'),
+        db.Index('ix_ledger_created_entry', 'created_at', 'id'),
+        {'sqlite_autoincrement': True},
+    )
+
+    # One double-entry posting (ledger.py): amount moves from credit_account to debit_account
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(10), nullable=False)  # 'charge', 'payment' or 'refund'
+    patient_id = db.Column(db.Integer, nullable=False)
+    bill_id = db.Column(db.Integer, nullable=True, index=True)
+    transaction_id = db.Column(db.Integer, nullable=True, index=True)
+    debit_account = db.Column(db.String(20), nullable=False)
+    credit_account = db.Column(db.String(20), nullable=False)
+    amount = db.Column(db.BigInteger, nullable=False)  # minor units (cents), always positive
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    backfilled = db.Column(db.Boolean, nullable=True)  # posted by `flask ledger backfill`, dated when it ran
+
+class LedgerSnapshot(db.Model):
+    __tablename__ = 'ledger_snapshots'
+    __table_args__ = (db.Index('ix_ledger_snapshot_patient_entry', 'patient_id', 'entry_id', unique=True),)
+
+    # A patient's receivable balance counting every ledger entry up to entry_id
+    id = db.Column(db.Integer, primary_key=True)
+    patient_id = db.Column(db.Integer, nullable=False)
+    entry_id = db.Column(db.Integer, nullable=False)
+    balance = db.Column(db.BigInteger, nullable=False)  # minor units, positive when the patient owes
+    taken_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class BillAgingSnapshot(db.Model):
+    __tablename__ = 'bill_aging_snapshots'
+
+    # One row per doctor and age bucket of an aging report saved by `flask aging-snapshot`
+    id = db.Column(db.Integer, primary_key=True)
+    taken_at = db.Column(db.DateTime, nullable=False, index=True)
+    doctor_id = db.Column(db.Integer, nullable=True)  # None for bills not raised for an appointment
+    specialization = db.Column(db.String(50), nullable=True)
+    bucket = db.Column(db.String(10), nullable=False)
+    bill_count = db.Column(db.Integer, nullable=False)
+    amount = db.Column(db.Float, nullable=False)
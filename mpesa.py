@@ -0,0 +1,144 @@
+import base64
+import threading
+import time
+from datetime import datetime
+import requests
+from requests.adapters import HTTPAdapter
+from flask import current_app
+from middleware.ratelimit import TokenBuckets
+import metrics
+
+# Daraja (M-Pesa) API client. One per worker, shared by its threads: the HTTP
+# connections are pooled and the OAuth token is fetched once and reused until
+# shortly before it expires, instead of once per call. MPESA_BASE_URL points it
+# at the sandbox, production or a local stand-in (benchmarks/mpesa_standin.py).
+# STK pushes are paced to MPESA_STK_PUSH_RATE a second per worker, within the
+# rate Safaricom allows the shortcode.
+
+# Returned by the STK query while the customer hasn't answered the prompt yet
+STILL_PROCESSING = '500.001.1001'
+
+
+class MpesaError(Exception):
+    pass
+
+
+class MpesaClient:
+    # Refetch the token this long before Safaricom says it expires
+    TOKEN_MARGIN = 60
+
+    def __init__(self, base_url, consumer_key, consumer_secret, shortcode, passkey, callback_url, timeout,
+                 pool_size=10, push_rate=0):
+        self.base_url = base_url.rstrip('/')
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.shortcode = shortcode
+        self.passkey = passkey
+        self.callback_url = callback_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount(self.base_url, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self._token_lock = threading.Lock()
+        self._token = None
+        self._token_expires = 0.0
+        self.push_rate = push_rate
+        self._pacer = TokenBuckets(1)
+
+    @metrics.timed_call('mpesa_request', operation='oauth_token')
+    def _fetch_token(self):
+        response = self.session.get(
+            f'{self.base_url}/oauth/v1/generate', params={'grant_type': 'client_credentials'},
+            auth=(self.consumer_key, self.consumer_secret), timeout=self.timeout,
+        )
+        response.raise_for_status()
+        data = response.json()
+        return data['access_token'], float(data.get('expires_in', 3599))
+
+    def access_token(self):
+        with self._token_lock:
+            if self._token is None or time.monotonic() >= self._token_expires:
+                self._token, expires_in = self._fetch_token()
+                self._token_expires = time.monotonic() + max(0.0, expires_in - self.TOKEN_MARGIN)
+            return self._token
+
+    def _password(self):
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        password = base64.b64encode(f'{self.shortcode}{self.passkey}{timestamp}'.encode('utf-8')).decode('utf-8')
+        return password, timestamp
+
+    def _post(self, path, payload):
+        response = self.session.post(
+            f'{self.base_url}{path}', json=payload, timeout=self.timeout,
+            headers={'Authorization': f'Bearer {self.access_token()}'},
+        )
+        if response.status_code == 401:
+            # Revoked or expired early; fetch a new token once
+            with self._token_lock:
+                self._token = None
+            response = self.session.post(
+                f'{self.base_url}{path}', json=payload, timeout=self.timeout,
+                headers={'Authorization': f'Bearer {self.access_token()}'},
+            )
+        try:
+            return response.json()
+        except ValueError:
+            raise MpesaError(f'{path} answered {response.status_code} without JSON')
+
+    def _wait_for_push_slot(self):
+        if not self.push_rate:
+            return
+        # Up to a second's worth at once, then push_rate a second
+        burst = max(1.0, self.push_rate)
+        while True:
+            wait = self._pacer.take('stk_push', burst, burst / self.push_rate)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def stk_push(self, phone_number, amount, account_reference, description):
+        self._wait_for_push_slot()
+        return self._stk_push(phone_number, amount, account_reference, description)
+
+    @metrics.timed_call('mpesa_request', operation='stk_push')
+    def _stk_push(self, phone_number, amount, account_reference, description):
+        password, timestamp = self._password()
+        return self._post('/mpesa/stkpush/v1/processrequest', {
+            "BusinessShortCode": self.shortcode,
+            "Password": password,
+            "Timestamp": timestamp,
+            "TransactionType": "CustomerPayBillOnline",
+            "Amount": amount,
+            "PartyA": phone_number,
+            "PartyB": self.shortcode,
+            "PhoneNumber": phone_number,
+            "CallBackURL": self.callback_url,
+            "AccountReference": account_reference,
+            "TransactionDesc": description,
+        })
+
+    @metrics.timed_call('mpesa_request', operation='stk_query')
+    def stk_query(self, checkout_request_id):
+        """Status of an STK push. ResultCode '0' means paid, any other ResultCode
+        that it failed; errorCode STILL_PROCESSING that it isn't settled yet."""
+        password, timestamp = self._password()
+        return self._post('/mpesa/stkpushquery/v1/query', {
+            "BusinessShortCode": self.shortcode,
+            "Password": password,
+            "Timestamp": timestamp,
+            "CheckoutRequestID": checkout_request_id,
+        })
+
+
+def get_client():
+    """This worker's client for the current app, created on first use (so never
+    in the gunicorn master, whose connections the workers would share)."""
+    client = current_app.extensions.get('mpesa')
+    if client is None:
+        config = current_app.config
+        client = current_app.extensions['mpesa'] = MpesaClient(
+            config['MPESA_BASE_URL'], config['MPESA_CONSUMER_KEY'], config['MPESA_CONSUMER_SECRET'],
+            config['MPESA_SHORTCODE'], config['MPESA_PASSKEY'], config['MPESA_CALLBACK_URL'],
+            config['MPESA_TIMEOUT'], push_rate=config['MPESA_STK_PUSH_RATE'],
+            pool_size=max(10, config['MPESA_RECONCILE_WORKERS'], config['MPESA_BULK_WORKERS']),
+        )
+    return client
@@ -0,0 +1,228 @@
+import queue
+import threading
+import time
+import logging
+from flask import current_app, request
+from sqlalchemy import func, select
+from db import db
+from models import Appointment, Bill, ChangeEvent, Transaction
+
+# Server-sent events. Each worker runs one background poller that tails the
+# change_events outbox (changes.py) and publishes what it finds to an
+# in-process broker, which fans each event out to the open streams subscribed
+# to its channels. The outbox is the broker between workers: a write served by
+# any worker reaches the streams held by all of them within SSE_POLL_INTERVAL.
+#
+# An open stream is a generator waiting on its own queue. Under gunicorn's
+# gevent worker (the default in gunicorn.conf.py) that is a greenlet, not a
+# thread, so a worker can hold thousands of them.
+
+logger = logging.getLogger(__name__)
+
+# Outbox resources streamed, and the columns their events carry
+STREAMED = {
+    'appointments': (Appointment, ('doctor_id', 'patient_id', 'status', 'appointment_date')),
+    'bills': (Bill, ('patient_id', 'status', 'amount')),
+    'transactions': (Transaction, ('bill_id', 'status', 'amount', 'receipt_number')),
+}
+
+
+def channels_for(resource, row):
+    """Channels an event is published on: the doctor's schedule for appointments,
+    the bill (and the transaction itself) for payment status."""
+    if resource == 'appointments':
+        return [f"doctor:{row['doctor_id']}"]
+    if resource == 'bills':
+        return [f"bill:{row['id']}"]
+    return [f"transaction:{row['id']}", f"bill:{row['bill_id']}"]
+
+
+def format_event(event_type, data, event_id=None):
+    lines = [f'id: {event_id}'] if event_id is not None else []
+    lines += [f'event: {event_type}', f'data: {current_app.json.dumps(data)}']
+    return ('\n'.join(lines) + '\n\n').encode('utf-8')
+
+
+def current_seq(connection):
+    return connection.execute(select(func.coalesce(func.max(ChangeEvent.seq), 0))).scalar()
+
+
+def load_events(connection, since, limit, until=None):
+    """Outbox events after since (and up to until) as (seq, channels, encoded
+    message), oldest first, with the current state of each row. Deleted rows
+    have no channels."""
+    query = (
+        select(ChangeEvent.seq, ChangeEvent.resource, ChangeEvent.resource_id, ChangeEvent.op)
+        .where(ChangeEvent.seq > since, ChangeEvent.resource.in_(STREAMED))
+        .order_by(ChangeEvent.seq).limit(limit)
+    )
+    if until is not None:
+        query = query.where(ChangeEvent.seq <= until)
+    changes = connection.execute(query).all()
+
+    states = {}
+    for resource, (model, columns) in STREAMED.items():
+        ids = {change.resource_id for change in changes if change.resource == resource}
+        if ids:
+            rows = connection.execute(
+                select(model.id, *(getattr(model, column) for column in columns)).where(model.id.in_(ids))
+            ).mappings()
+            states.update({(resource, row['id']): dict(row) for row in rows})
+
+    events = []
+    for seq, resource, resource_id, op in changes:
+        row = states.get((resource, resource_id))
+        if row is None:
+            events.append((seq, [], None))
+            continue
+        message = format_event(resource, {'op': op, **row}, event_id=seq)
+        events.append((seq, channels_for(resource, row), message))
+    return events
+
+
+class Subscription:
+    def __init__(self, channels, size, since):
+        self.channels = channels
+        # Every event after this seq is put on the queue
+        self.since = since
+        self.queue = queue.Queue(maxsize=size)
+        self.overflowed = False
+
+    def put(self, seq, message):
+        try:
+            self.queue.put_nowait((seq, message))
+        except queue.Full:
+            # The client can't keep up; end its stream so it reconnects and replays
+            self.overflowed = True
+
+
+class Broker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._channels = {}  # channel -> set of Subscription
+        # Seq of the last event published, None while nobody is subscribed
+        self._since = None
+        self._poller = None
+
+    def subscribe(self, channels, size, app):
+        """Subscription to channels, receiving every event after its since."""
+        baseline = None
+        if self._since is None:
+            # Polling starts from the events committed before this subscription
+            with app.app_context(), db.engine.connect() as connection:
+                baseline = current_seq(connection)
+        with self._lock:
+            if self._since is None:
+                self._since = baseline
+            subscription = Subscription(channels, size, self._since)
+            for channel in channels:
+                self._channels.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subscribers = self._channels.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._channels[channel]
+
+    def publish(self, channels, seq, message):
+        # Under the same lock as subscribe, so a new subscription either gets
+        # this event or has a since at or after it
+        with self._lock:
+            self._since = seq
+            subscribers = set().union(*(self._channels.get(channel, ()) for channel in channels))
+        for subscription in subscribers:
+            subscription.put(seq, message)
+
+    def _position(self):
+        """Seq to poll after, or None (forgetting it) when nobody is subscribed."""
+        with self._lock:
+            if not self._channels:
+                # Nobody to tell about what happens meanwhile
+                self._since = None
+            return self._since
+
+    def ensure_polling(self, app):
+        # Started by the first stream in each worker, never in the gunicorn master
+        with self._lock:
+            if self._poller is None or not self._poller.is_alive():
+                self._poller = threading.Thread(target=self._poll, args=(app,), name='sse-outbox-poller', daemon=True)
+                self._poller.start()
+
+    def _poll(self, app):
+        with app.app_context():
+            interval = app.config['SSE_POLL_INTERVAL']
+            page_size = app.config['CHANGE_FEED_PAGE_SIZE']
+            while True:
+                time.sleep(interval)
+                since = self._position()
+                if since is None:
+                    continue
+                try:
+                    with db.engine.connect() as connection:
+                        events = load_events(connection, since, page_size)
+                except Exception:
+                    logger.exception('Polling the change feed failed')
+                    continue
+                for seq, channels, message in events:
+                    self.publish(channels, seq, message)
+
+
+broker = Broker()
+
+
+def stream(channels):
+    """SSE response publishing the events on channels as they happen. A client
+    reconnecting with Last-Event-ID first gets what it missed, or a `reset` event
+    if that is more than a page of the change feed and it should reload instead."""
+    app = current_app._get_current_object()
+    config = app.config
+    channels = set(channels)
+    last_event_id = request.headers.get('Last-Event-ID', '')
+    last_seq = int(last_event_id) if last_event_id.isdigit() else None
+    heartbeat = config['SSE_HEARTBEAT_INTERVAL']
+
+    def replay(since, until):
+        """Messages after since, up to where the subscription takes over."""
+        page_size = config['CHANGE_FEED_PAGE_SIZE']
+        with app.app_context(), db.engine.connect() as connection:
+            events = load_events(connection, since, page_size + 1, until=until)
+        if len(events) > page_size:
+            return [format_event('reset', {})]
+        return [message for _, event_channels, message in events if channels.intersection(event_channels)]
+
+    def generate():
+        # Subscribed here rather than in the view: a generator that never starts
+        # never runs its finally, and would leave the subscription behind
+        subscription = broker.subscribe(channels, config['SSE_QUEUE_SIZE'], app)
+        broker.ensure_polling(app)
+        try:
+            # Reconnect quickly, the client has nothing to fetch in between
+            yield f"retry: {int(config['SSE_RETRY_MS'])}\n\n".encode('utf-8')
+            sent = 0
+            if last_seq is not None:
+                # The client may be ahead of this worker's poller
+                sent = last_seq
+                if last_seq < subscription.since:
+                    yield from replay(last_seq, subscription.since)
+            while not subscription.overflowed:
+                try:
+                    seq, message = subscription.queue.get(timeout=heartbeat)
+                except queue.Empty:
+                    # Keeps proxies from closing an idle stream and notices disconnects
+                    yield b': keepalive\n\n'
+                    continue
+                # Already sent by the replay
+                if seq > sent:
+                    sent = seq
+                    yield message
+        finally:
+            broker.unsubscribe(subscription)
+
+    response = app.response_class(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # nginx would otherwise buffer the stream
+    return response
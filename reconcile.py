@@ -0,0 +1,104 @@
+import click
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select
+from db import db
+from models import Bill, Transaction
+import mpesa
+
+# M-Pesa reconciliation. A transaction stays Pending until Safaricom's callback
+# arrives, and some never do. `flask reconcile-mpesa` asks the STK query API
+# about the ones left pending too long and settles them as Paid (with their
+# bill) or Failed. Saved through the ORM, so the change feed and the payment
+# status streams see the outcome just as they would the callback's.
+
+logger = logging.getLogger(__name__)
+
+
+def stale_pending(cutoff, after_id, limit):
+    """(id, checkout_request_id) of transactions started before cutoff and still
+    pending, by ascending id; served by ix_transactions_status_date."""
+    return db.session.execute(
+        select(Transaction.id, Transaction.checkout_request_id)
+        .where(Transaction.status == 'Pending',
+               Transaction.transaction_date < cutoff.strftime('%Y-%m-%d %H:%M:%S'),
+               Transaction.id > after_id)
+        .order_by(Transaction.id).limit(limit)
+    ).all()
+
+
+def query_outcome(client, checkout_request_id):
+    """'Paid', 'Failed', 'pending' while the customer can still answer, or
+    'error' if M-Pesa couldn't tell."""
+    try:
+        response = client.stk_query(checkout_request_id)
+    except Exception:
+        logger.warning('STK query for %s failed', checkout_request_id, exc_info=True)
+        return 'error'
+    result_code = response.get('ResultCode')
+    if result_code is not None:
+        return 'Paid' if str(result_code) == '0' else 'Failed'
+    if response.get('errorCode') == mpesa.STILL_PROCESSING:
+        return 'pending'
+    logger.warning('STK query for %s answered %s', checkout_request_id, response)
+    return 'error'
+
+
+def apply_outcomes(outcomes):
+    """Settle the transactions in outcomes ({id: 'Paid' or 'Failed'}) that are
+    still pending, and mark the bills of the paid ones Paid, in one commit."""
+    transactions = Transaction.query.filter(Transaction.id.in_(outcomes), Transaction.status == 'Pending').all()
+    for transaction in transactions:
+        transaction.status = outcomes[transaction.id]
+    paid_bill_ids = {transaction.bill_id for transaction in transactions if transaction.status == 'Paid'}
+    if paid_bill_ids:
+        for bill in Bill.query.filter(Bill.id.in_(paid_bill_ids), Bill.status != 'Paid'):
+            bill.status = 'Paid'
+    db.session.commit()
+
+
+@click.command('reconcile-mpesa')
+@click.option('--minutes', type=int,
+              help='Check transactions pending for longer than this. Defaults to MPESA_RECONCILE_AFTER_MINUTES.')
+@click.option('--workers', type=int, help='STK queries in flight at once. Defaults to MPESA_RECONCILE_WORKERS.')
+@click.option('--batch-size', type=int, help='Transactions per commit. Defaults to MPESA_RECONCILE_BATCH_SIZE.')
+@click.option('--dry-run', is_flag=True, help='Query M-Pesa but save nothing.')
+@with_appcontext
+def reconcile_command(minutes, workers, batch_size, dry_run):
+    """Settle pending M-Pesa transactions whose callback never arrived."""
+    config = current_app.config
+    cutoff = datetime.now() - timedelta(
+        minutes=minutes if minutes is not None else config['MPESA_RECONCILE_AFTER_MINUTES'])
+    workers = workers or config['MPESA_RECONCILE_WORKERS']
+    batch_size = batch_size or config['MPESA_RECONCILE_BATCH_SIZE']
+    client = mpesa.get_client()
+
+    started = time.perf_counter()
+    counts = dict.fromkeys(('Paid', 'Failed', 'pending', 'error'), 0)
+    last_id = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            page = stale_pending(cutoff, last_id, batch_size)
+            if not page:
+                break
+            last_id = page[-1].id
+            # Nothing is held open while the queries run
+            db.session.rollback()
+            results = executor.map(lambda row: query_outcome(client, row.checkout_request_id), page)
+            outcomes = {}
+            for row, outcome in zip(page, results):
+                counts[outcome] += 1
+                if outcome in ('Paid', 'Failed'):
+                    outcomes[row.id] = outcome
+            if outcomes and not dry_run:
+                apply_outcomes(outcomes)
+
+    for outcome, count in counts.items():
+        click.echo(f'{outcome.lower():<10}{count:>10,}')
+    action = 'Checked' if dry_run else 'Reconciled'
+    click.echo(f'{action} transactions pending since before {cutoff:%Y-%m-%d %H:%M} '
+               f'in {time.perf_counter() - started:.1f}s')
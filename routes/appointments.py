@@ -1,7 +1,10 @@
 from flask import Blueprint, request, jsonify
-from models import Appointment, Bill, Patient  
-from sqlalchemy import desc
+from models import Appointment, AppointmentArchive, Bill, Doctor
 from db import db
+from serializers import appointment_serializer
+from middleware.etag import etag_versioned
+from archive import load_with_archive
+import pubsub
 
 appointments_bp = Blueprint('appointments', __name__)
 
@@ -59,6 +62,8 @@ def create_appointment():
     )
     
     db.session.add(new_appointment)
+    # The bill refers to the appointment's id, which the flush assigns
+    db.session.flush()
 
     # Create a Bill record after creating the appointment
     new_bill = Bill(
@@ -75,6 +80,7 @@ def create_appointment():
 
 # Endpoint to fetch all appointments for a specific doctor
 @appointments_bp.route('/doctor/<int:doctor_id>', methods=['GET'])
+@etag_versioned('appointment', 'appointment_archive', 'patient')
 def get_appointments_by_doctor(doctor_id):
     """
     Get all appointments for a specific doctor
@@ -87,6 +93,16 @@ def get_appointments_by_doctor(doctor_id):
         required: true
         type: integer
         description: The ID of the doctor to fetch appointments for
+      - name: fields
+        in: query
+        required: false
+        type: string
+        description: Comma-separated list of fields to return (defaults to all)
+      - name: include_archived
+        in: query
+        required: false
+        type: integer
+        description: Set to 1 to include history moved to the archive
     responses:
       200:
         description: A list of appointments for the specified doctor
@@ -134,37 +150,47 @@ def get_appointments_by_doctor(doctor_id):
                   emergency_contact_phone_number:
                     type: string
     """
-    appointments = Appointment.query.filter_by(doctor_id=doctor_id).order_by(desc(Appointment.created_at)).all()
-    results = []
-    
-    for appointment in appointments:
-        patient = Patient.query.get(appointment.patient_id)
+    fields = appointment_serializer.requested_fields()
+    appointments = load_with_archive(appointment_serializer, fields, AppointmentArchive, order_by='created_at',
+                                     doctor_id=doctor_id)
 
-        results.append({
-            "id": appointment.id,
-            "patient_id": appointment.patient_id,
-            "doctor_id": appointment.doctor_id,
-            "appointment_date": appointment.appointment_date,
-            "cost": appointment.cost,
-            "status": appointment.status,
-            "reason_for_visit": appointment.reason_for_visit,
-            "notes": appointment.notes,
-            "created_at": appointment.created_at,
-            "updated_at": appointment.updated_at,
-            "patient": {
-                "id": patient.id,
-                "first_name": patient.first_name,
-                "last_name": patient.last_name,
-                "email": patient.email,
-                "phone_number": patient.phone_number,
-                "emergency_contact_phone_number": patient.emergency_contact_phone_number,
-            } if patient else None  
-        })
-    
-    return jsonify(results), 200
+    # Patients are looked up in one query for the whole page
+    return jsonify(appointment_serializer.dump_many(appointments, fields)), 200
+
+# Live updates to a doctor's schedule
+@appointments_bp.route('/doctor/<int:doctor_id>/events', methods=['GET'])
+def stream_appointments_by_doctor(doctor_id):
+    """
+    Stream a doctor's appointment changes
+    ---
+    tags:
+      - Appointments
+    produces:
+      - text/event-stream
+    parameters:
+      - name: doctor_id
+        in: path
+        required: true
+        type: integer
+      - name: Last-Event-ID
+        in: header
+        required: false
+        type: integer
+        description: Id of the last event received, to get the ones missed while disconnected
+    responses:
+      200:
+        description: >
+          Server-sent events stream. `appointments` events as the doctor's appointments are created or updated. Each event's
+          data is the row's current state with `op` set to created or updated.
+      404:
+        description: Doctor not found
+    """
+    Doctor.query.get_or_404(doctor_id)
+    return pubsub.stream([f'doctor:{doctor_id}'])
 
 # Endpoint to fetch all appointments for a specific patient
 @appointments_bp.route('/patient/<int:patient_id>', methods=['GET'])
+@etag_versioned('appointment', 'appointment_archive')
 def get_appointments_by_patient(patient_id):
     """
     Get all appointments for a specific patient
@@ -177,6 +203,16 @@ def get_appointments_by_patient(patient_id):
         required: true
         type: integer
         description: The ID of the patient to fetch appointments for
+      - name: fields
+        in: query
+        required: false
+        type: string
+        description: Comma-separated list of fields to return (defaults to all)
+      - name: include_archived
+        in: query
+        required: false
+        type: integer
+        description: Set to 1 to include history moved to the archive
     responses:
       200:
         description: A list of appointments for the specified patient
@@ -207,24 +243,14 @@ def get_appointments_by_patient(patient_id):
                 type: string
                 format: date-time
     """
-    appointments = Appointment.query.filter_by(patient_id=patient_id).order_by(desc(Appointment.created_at)).all()
-    
-    results = []
-    
-    for appointment in appointments:
-        results.append({
-            "id": appointment.id,
-            "patient_id": appointment.patient_id,
-            "doctor_id": appointment.doctor_id,
-            "appointment_date": appointment.appointment_date,
-            "status": appointment.status,
-            "reason_for_visit": appointment.reason_for_visit,
-            "notes": appointment.notes,
-            "created_at": appointment.created_at,
-            "updated_at": appointment.updated_at
-        })
-    
-    return jsonify(results), 200
+    fields = appointment_serializer.requested_fields(default=[
+        'id', 'patient_id', 'doctor_id', 'appointment_date', 'status', 'reason_for_visit', 'notes', 'created_at',
+        'updated_at'
+    ])
+    appointments = load_with_archive(appointment_serializer, fields, AppointmentArchive, order_by='created_at',
+                                     patient_id=patient_id)
+
+    return jsonify(appointment_serializer.dump_many(appointments, fields)), 200
 
 # Endpoint to update the status of an appointment
 @appointments_bp.route('/<int:appointment_id>', methods=['PATCH'])
@@ -2,6 +2,7 @@ from flask import Blueprint, request, jsonify
 from flask_jwt_extended import create_access_token
 from models import User
 from db import db
+from middleware import ratelimit
 
 auth_bp = Blueprint('auth_bp', __name__)
 
@@ -103,13 +104,28 @@ def login():
               description: Patient ID (if applicable)
       401:
         description: Invalid credentials
+      429:
+        description: Too many attempts from this address or for this account; see Retry-After
+      503:
+        description: Too many passwords being checked; retry shortly
     """
     data = request.get_json()
     email = data['email']
     password = data['password']
 
+    # Turn away brute force before it costs a password hash. The account bucket
+    # is only charged for attempts the address bucket lets through. Behind a
+    # proxy remote_addr is the client's when TRUSTED_PROXY_HOPS is set.
+    retry_after = (ratelimit.hit('login_ip', request.remote_addr, 'LOGIN_IP_LIMIT', 'LOGIN_IP_WINDOW')
+                   or ratelimit.hit('login_account', str(email).strip().lower(),
+                                    'LOGIN_ACCOUNT_LIMIT', 'LOGIN_ACCOUNT_WINDOW'))
+    if retry_after:
+        return ratelimit.too_many_requests(retry_after, "Too many login attempts, try again later")
+
     user = User.query.filter_by(email=email).first()
     if user and user.check_password(password):
+        # Saves the hash if check_password upgraded it
+        db.session.commit()
         access_token = create_access_token(identity={'email': user.email})
 
         if user.role == 2:
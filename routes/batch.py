@@ -0,0 +1,168 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import json
+from flask import Blueprint, request, jsonify, current_app, g
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+from db import db
+
+batch_bp = Blueprint('batch', __name__)
+
+READ_METHODS = ('GET', 'HEAD')
+# Headers of the batch request that every sub-request inherits
+INHERITED_HEADERS = ('Authorization', 'Cookie', 'Accept-Language')
+
+
+@contextmanager
+def _fresh_g():
+    """A sub-request sharing the batch's app context gets an empty g of its own,
+    so per-request state (metrics, SQL stats) doesn't clobber the batch's."""
+    saved = dict(vars(g))
+    vars(g).clear()
+    try:
+        yield
+    finally:
+        vars(g).clear()
+        vars(g).update(saved)
+
+
+def _environ(app, sub_request):
+    headers = {name: request.headers[name] for name in INHERITED_HEADERS if name in request.headers}
+    headers.update(sub_request.get('headers') or {})
+    builder = EnvironBuilder(
+        path=sub_request['path'],
+        method=sub_request.get('method', 'GET').upper(),
+        base_url=request.host_url,
+        headers=headers,
+        json=sub_request.get('body'),
+        environ_base={'REMOTE_ADDR': request.remote_addr},
+    )
+    try:
+        return builder.get_environ()
+    finally:
+        builder.close()
+
+
+def _run(app, environ):
+    """Dispatch one sub-request in process and return its response entry."""
+    app_iter, status, headers = run_wsgi_app(app.wsgi_app, environ)
+    try:
+        # A stream never ends, so it can't be part of a batch
+        if headers.get('Content-Type', '').startswith('text/event-stream'):
+            return {"status": 400, "body": {"error": "Streaming endpoints can't be batched"}}
+        data = b''.join(app_iter)
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+    body = data.decode('utf-8') if data else None
+    if body and headers.get('Content-Type', '').startswith('application/json'):
+        body = json.loads(body)
+    entry_headers = {name: value for name, value in headers.items() if name not in ('Content-Length', 'Vary')}
+    return {"status": int(status.split(' ', 1)[0]), "headers": entry_headers, "body": body}
+
+
+def _run_shared(app, environ):
+    # Inside the batch's app context, so on the batch's DB session
+    with _fresh_g():
+        entry = _run(app, environ)
+    if not db.session.is_active:
+        # A sub-request failed mid-flush; don't let it break the ones after it
+        db.session.rollback()
+    return entry
+
+
+@batch_bp.route('/batch', methods=['POST'])
+def run_batch():
+    """
+    Run several API requests in one round trip
+    ---
+    tags:
+      - Batch
+    description: >
+      Sub-requests run in order against the same API, in process, inheriting the
+      batch's Authorization and cookies. They share the batch's database session,
+      so reads after a write see it. Consecutive reads (GET/HEAD) that come before
+      any write are run in parallel.
+    parameters:
+      - name: batch
+        in: body
+        required: true
+        schema:
+          type: object
+          properties:
+            requests:
+              type: array
+              items:
+                type: object
+                properties:
+                  method:
+                    type: string
+                    example: "GET"
+                  path:
+                    type: string
+                    example: "/patients/3"
+                  headers:
+                    type: object
+                  body:
+                    type: object
+    responses:
+      200:
+        description: One entry per sub-request, in the same order
+        schema:
+          type: object
+          properties:
+            responses:
+              type: array
+              items:
+                type: object
+                properties:
+                  status:
+                    type: integer
+                    example: 200
+                  headers:
+                    type: object
+                  body:
+                    type: object
+      400:
+        description: Invalid batch
+    """
+    data = request.get_json(silent=True) or {}
+    sub_requests = data.get('requests')
+    max_requests = current_app.config['BATCH_MAX_REQUESTS']
+    if not isinstance(sub_requests, list) or not all(
+        isinstance(sub, dict) and isinstance(sub.get('path'), str) and sub['path'].startswith('/')
+        for sub in sub_requests
+    ):
+        return jsonify({"error": "requests must be a list of objects with an absolute path"}), 400
+    if len(sub_requests) > max_requests:
+        return jsonify({"error": f"At most {max_requests} requests can be batched"}), 400
+
+    app = current_app._get_current_object()
+    max_workers = current_app.config['BATCH_MAX_WORKERS']
+    responses = [None] * len(sub_requests)
+    environs = []
+    for index, sub_request in enumerate(sub_requests):
+        if sub_request['path'].split('?', 1)[0].rstrip('/') == request.path:
+            responses[index] = {"status": 400, "body": {"error": "Batches can't be nested"}}
+            environs.append(None)
+        else:
+            environs.append(_environ(app, sub_request))
+
+    index = 0
+    while index < len(environs):
+        # Run of reads starting here, before anything in the batch has written
+        end = index
+        while (end < len(environs) and environs[end] is not None
+               and environs[end]['REQUEST_METHOD'] in READ_METHODS and not db.session.info.get('wrote')):
+            end += 1
+        if end - index > 1 and max_workers > 1:
+            # Each on a pool thread, with its own app context and session
+            with ThreadPoolExecutor(max_workers=min(max_workers, end - index)) as executor:
+                responses[index:end] = executor.map(lambda environ: _run(app, environ), environs[index:end])
+            index = end
+            continue
+        if environs[index] is not None:
+            responses[index] = _run_shared(app, environs[index])
+        index += 1
+
+    return jsonify({"responses": responses}), 200
@@ -1,6 +1,12 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, current_app
+from datetime import datetime
 from db import db
-from models import Bill
+from models import Bill, BillArchive
+from serializers import bill_serializer
+from middleware.etag import etag_versioned
+from archive import include_archived
+import pubsub
+import aging
 
 bills_bp = Blueprint('bills', __name__)
 
@@ -55,3 +61,174 @@ def create_bill():
 
     return jsonify({"message": "Bill created successfully"}), 200
 
+@bills_bp.route('/', methods=['GET'])
+@etag_versioned('bills', 'bills_archive')
+def get_bills():
+    """
+    Get bills by id
+    ---
+    tags:
+      - Bills
+    parameters:
+      - name: ids
+        in: query
+        required: true
+        type: string
+        description: Comma-separated ids of the bills to fetch
+      - name: fields
+        in: query
+        required: false
+        type: string
+        description: Comma-separated list of fields to return (defaults to all but transactions)
+      - name: include_archived
+        in: query
+        required: false
+        type: integer
+        description: Set to 1 to also look for the ids in the archive
+    responses:
+      200:
+        description: The bills found, in the order asked for, and the ids that don't exist
+        schema:
+          type: object
+          properties:
+            items:
+              type: array
+              items:
+                type: object
+                properties:
+                  id:
+                    type: integer
+                  status:
+                    type: string
+                  patient_id:
+                    type: integer
+                  appointment_id:
+                    type: integer
+                  transaction_id:
+                    type: integer
+                  creation_date:
+                    type: string
+                    format: date-time
+                  amount:
+                    type: number
+                  description:
+                    type: string
+            missing:
+              type: array
+              items:
+                type: integer
+      400:
+        description: ids missing or invalid
+    """
+    fields = bill_serializer.requested_fields(default=[
+        'id', 'status', 'patient_id', 'appointment_id', 'transaction_id', 'creation_date', 'amount', 'description'
+    ])
+    ids = bill_serializer.requested_ids()
+    if ids is None:
+        return jsonify({"error": "ids is required"}), 400
+
+    models = [Bill, BillArchive] if include_archived() else [Bill]
+    bills, missing = bill_serializer.load_by_ids(ids, fields, models=models)
+    return jsonify({"items": bill_serializer.dump_many(bills, fields), "missing": missing}), 200
+
+@bills_bp.route('/aging', methods=['GET'])
+def get_bills_aging():
+    """
+    Outstanding bills by age, per doctor and per specialization
+    ---
+    tags:
+      - Bills
+    description: >
+      Amounts and counts of bills not yet paid, bucketed by days since they were
+      raised (0-30, 31-60, 61-90, 90+). Bills are attributed to the doctor of the
+      appointment they were raised for; others have no doctor. With
+      AGING_FROM_SNAPSHOT the nightly snapshot is served when recent enough.
+    parameters:
+      - name: live
+        in: query
+        required: false
+        type: integer
+        description: Set to 1 to compute the report now rather than serve the snapshot
+    responses:
+      200:
+        description: The aging report
+        schema:
+          type: object
+          properties:
+            as_of:
+              type: string
+              format: date-time
+            source:
+              type: string
+              description: live or snapshot
+              example: "live"
+            buckets:
+              type: array
+              items:
+                type: string
+              example: ["0-30", "31-60", "61-90", "90+"]
+            total:
+              type: object
+              description: count and amount per bucket
+            by_doctor:
+              type: array
+              items:
+                type: object
+                properties:
+                  doctor_id:
+                    type: integer
+                  name:
+                    type: string
+                  specialization:
+                    type: string
+                  buckets:
+                    type: object
+            by_specialization:
+              type: array
+              items:
+                type: object
+                properties:
+                  specialization:
+                    type: string
+                  buckets:
+                    type: object
+    """
+    config = current_app.config
+    now = datetime.utcnow()
+    if config['AGING_FROM_SNAPSHOT'] and request.args.get('live', '').lower() not in ('1', 'true'):
+        snapshot = aging.latest_snapshot(config['AGING_SNAPSHOT_MAX_AGE'], now)
+        if snapshot is not None:
+            taken_at, rows = snapshot
+            return jsonify(aging.build_report(rows, taken_at, 'snapshot')), 200
+    return jsonify(aging.build_report(aging.compute(now), now, 'live')), 200
+
+# Live payment status of a bill
+@bills_bp.route('/<int:bill_id>/events', methods=['GET'])
+def stream_bill_status(bill_id):
+    """
+    Stream a bill's payment status
+    ---
+    tags:
+      - Bills
+    produces:
+      - text/event-stream
+    parameters:
+      - name: bill_id
+        in: path
+        required: true
+        type: integer
+      - name: Last-Event-ID
+        in: header
+        required: false
+        type: integer
+        description: Id of the last event received, to get the ones missed while disconnected
+    responses:
+      200:
+        description: >
+          Server-sent events stream. `bills` events when the bill changes and `transactions` events as payments against it progress. Each event's
+          data is the row's current state with `op` set to created or updated.
+      404:
+        description: Bill not found
+    """
+    Bill.query.get_or_404(bill_id)
+    return pubsub.stream([f'bill:{bill_id}'])
@@ -0,0 +1,93 @@
+from flask import Blueprint, jsonify, request, current_app
+from sqlalchemy import func, select
+from db import db
+from models import ChangeEvent
+
+changes_bp = Blueprint('changes', __name__)
+
+@changes_bp.route('/changes', methods=['GET'])
+def get_changes():
+    """
+    Change feed
+    ---
+    tags:
+      - Changes
+    description: >
+      Creates, updates and deletes of patients, doctors, appointments, records,
+      bills and transactions in the order they happened. Start from since=0, then
+      pass the returned `next` as since to get only what changed after.
+    parameters:
+      - name: since
+        in: query
+        required: false
+        type: integer
+        description: Return events after this sequence number (defaults to 0)
+      - name: limit
+        in: query
+        required: false
+        type: integer
+        description: Maximum number of events to return (defaults to and is capped at CHANGE_FEED_PAGE_SIZE)
+    responses:
+      200:
+        description: A page of change events
+        schema:
+          type: object
+          properties:
+            changes:
+              type: array
+              items:
+                type: object
+                properties:
+                  seq:
+                    type: integer
+                    example: 42
+                  resource:
+                    type: string
+                    example: "appointments"
+                  id:
+                    type: integer
+                    example: 7
+                  op:
+                    type: string
+                    example: "updated"
+                  changed_at:
+                    type: string
+                    format: date-time
+            next:
+              type: integer
+              example: 42
+            has_more:
+              type: boolean
+              example: false
+      400:
+        description: Invalid since or limit
+      410:
+        description: Events after since have been pruned, re-read the full lists and start over from since=0
+    """
+    page_size = current_app.config['CHANGE_FEED_PAGE_SIZE']
+    try:
+        since = int(request.args.get('since', 0))
+        limit = min(int(request.args.get('limit', page_size)), page_size)
+    except ValueError:
+        return jsonify({"error": "since and limit must be integers"}), 400
+    if since < 0 or limit < 1:
+        return jsonify({"error": "since must be >= 0 and limit >= 1"}), 400
+
+    rows = db.session.execute(
+        select(ChangeEvent.seq, ChangeEvent.resource, ChangeEvent.resource_id, ChangeEvent.op, ChangeEvent.changed_at)
+        .where(ChangeEvent.seq > since).order_by(ChangeEvent.seq).limit(limit + 1)
+    ).all()
+
+    # A consumer that fell behind the retention window has missed events for good
+    if since and (not rows or rows[0].seq > since + 1):
+        oldest = db.session.execute(select(func.min(ChangeEvent.seq))).scalar()
+        if oldest is not None and oldest > since + 1:
+            return jsonify({"error": "Events after since have been pruned", "oldest": oldest}), 410
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    changes = [
+        {"seq": seq, "resource": resource, "id": resource_id, "op": op, "changed_at": changed_at}
+        for seq, resource, resource_id, op, changed_at in rows
+    ]
+    return jsonify({"changes": changes, "next": rows[-1].seq if rows else since, "has_more": has_more}), 200
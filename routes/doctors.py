@@ -1,8 +1,10 @@
 from flask import Blueprint, jsonify, request
 from db import db  # Import the db instance
-from models import Doctor, User, Patient, Record, Bill
+from datetime import datetime
+from models import Doctor, User, Patient
 import json
-from sqlalchemy import desc
+from serializers import doctor_serializer, patient_serializer
+from middleware.etag import etag_versioned
 
 
 doctors_bp = Blueprint('doctors', __name__)
@@ -100,14 +102,16 @@ def add_doctor():
         emergency_contact=data['emergency_contact'],
         emergency_contact_country_code=data['emergency_contact_country_code']
     )
-    db.session.add(new_doctor)
-    db.session.commit()
-
+    # Hashed before anything is saved, so a busy hashing pool leaves nothing half added
     password = data['first_name'] + "." + data['surname']
     role = 2
 
     new_user = User(email=email)
     new_user.set_password(password)
+
+    db.session.add(new_doctor)
+    db.session.commit()
+
     new_user.set_doctor_id(new_doctor.id)
     new_user.set_role(role)  
 
@@ -118,12 +122,27 @@ def add_doctor():
 
 # Route to fetch all doctors (GET method)
 @doctors_bp.route('/', methods=['GET'])
+@etag_versioned('doctor')
 def get_doctors():
     """
     Get all doctors
     ---
     tags:
       - Doctors
+    parameters:
+      - name: fields
+        in: query
+        required: false
+        type: string
+        description: Comma-separated list of fields to return (defaults to all)
+      - name: ids
+        in: query
+        required: false
+        type: string
+        description: >
+          Comma-separated ids to fetch. The response is then an object with the
+          matching doctors under items, in the order asked for, and the ids that
+          don't exist under missing.
     responses:
       200:
         description: A list of doctors
@@ -169,28 +188,14 @@ def get_doctors():
               emergency_contact_country_code:
                 type: string
     """
-    doctors = Doctor.query.all()
-    output = []
-    for doctor in doctors:
-        output.append({
-            'id': doctor.id,
-            'title': doctor.title,
-            'first_name': doctor.first_name,
-            'surname': doctor.surname,
-            'gender': doctor.gender,
-            'date_of_birth': doctor.date_of_birth,
-            'specialization': doctor.specialization,
-            'phone_number_country_code': doctor.phone_number_country_code,
-            'phone_number': doctor.phone_number,
-            'email': doctor.email,
-            'address': doctor.address,
-            'years_of_experience': doctor.years_of_experience,
-            'qualifications': json.loads(doctor.qualifications),  # Convert JSON string back to list
-            'start_of_employment': doctor.start_of_employment,
-            'emergency_contact': doctor.emergency_contact,
-            'emergency_contact_country_code': doctor.emergency_contact_country_code
-        })
-    return jsonify(output), 200
+    fields = doctor_serializer.requested_fields()
+    ids = doctor_serializer.requested_ids()
+    if ids is not None:
+        doctors, missing = doctor_serializer.load_by_ids(ids, fields)
+        return jsonify({"items": doctor_serializer.dump_many(doctors, fields), "missing": missing}), 200
+
+    doctors = Doctor.query.options(doctor_serializer.load_only(fields)).all()
+    return jsonify(doctor_serializer.dump_many(doctors, fields)), 200
 
 # Route to edit an existing doctor by ID (PATCH method)
 @doctors_bp.route('/<int:id>', methods=['PATCH'])
@@ -275,6 +280,7 @@ def edit_doctor(id):
 
 # Endpoint to fetch doctors by specialization
 @doctors_bp.route('/specialization', methods=['GET'])
+@etag_versioned('doctor')
 def get_doctors_by_specialization():
     """
     Get doctors by specialization
@@ -287,6 +293,11 @@ def get_doctors_by_specialization():
         required: true
         type: string
         description: The specialization of doctors to filter by
+      - name: fields
+        in: query
+        required: false
+        type: string
+        description: Comma-separated list of fields to return (defaults to all)
     responses:
       200:
         description: A list of doctors with the specified specialization
@@ -312,14 +323,9 @@ def get_doctors_by_specialization():
     if not specialization:
         return jsonify({"error": "Specialization parameter is required"}), 400
 
-    doctors = Doctor.query.filter_by(specialization=specialization).all()
-    return jsonify([{
-        "id": doctor.id,
-        "title": doctor.title,
-        "first_name": doctor.first_name,
-        "surname": doctor.surname,
-        "specialization": doctor.specialization
-    } for doctor in doctors]), 200
+    fields = doctor_serializer.requested_fields(default=['id', 'title', 'first_name', 'surname', 'specialization'])
+    doctors = Doctor.query.filter_by(specialization=specialization).options(doctor_serializer.load_only(fields)).all()
+    return jsonify(doctor_serializer.dump_many(doctors, fields)), 200
 
 # Route to delete a doctor by ID (DELETE method)
 @doctors_bp.route('/<int:id>', methods=['DELETE'])
@@ -340,12 +346,14 @@ def delete_doctor(id):
         description: Doctor deleted successfully
     """
     doctor = Doctor.query.get_or_404(id)
-    db.session.delete(doctor)
+    # Hidden from now on; `flask purge` removes it and everything that depends on it
+    doctor.deleted_at = datetime.utcnow()
     db.session.commit()
     return jsonify({'message': 'Doctor deleted successfully!'}), 200
 
 # Route to get all patients by doctor ID
 @doctors_bp.route('/patients/<int:doctor_id>', methods=['GET'])
+@etag_versioned('patient', 'record', 'bills')
 def get_patients_by_doctor(doctor_id):
     """
     Get all patients by doctor ID
@@ -358,6 +366,16 @@ def get_patients_by_doctor(doctor_id):
         required: true
         type: integer
         description: The ID of the doctor to get patients for
+      - name: summary
+        in: query
+        required: false
+        type: boolean
+        description: Leave record bodies out of the nested records list
+      - name: fields
+        in: query
+        required: false
+        type: string
+        description: Comma-separated list of fields to return (defaults to all)
     responses:
       200:
         description: A list of patients for the specified doctor
@@ -418,52 +436,19 @@ def get_patients_by_doctor(doctor_id):
       404:
         description: No patients found for this doctor
     """
+    summary = request.args.get('summary', '').lower() in ('1', 'true', 'yes')
+    fields = patient_serializer.requested_fields(default=[
+        'id', 'first_name', 'last_name', 'gender', 'emergency_contact_phone_number', 'date_of_birth', 'email',
+        'phone_number', 'address', 'records', 'bills'
+    ])
+
     # Query all patients where the doctor_id matches
-    patients = Patient.query.filter_by(doctor_id=doctor_id).all()
+    patients = Patient.query.filter_by(doctor_id=doctor_id).options(patient_serializer.load_only(fields)).all()
 
     # Check if any patients are found
     if not patients:
         return jsonify({'message': 'No patients found for this doctor'}), 404
 
-    # Prepare the results in JSON format
-    results = []
-    for patient in patients:
-        records = Record.query.filter_by(patient_id=patient.id).order_by(desc(Record.creation_date)).all()
-        records_list = [
-            {
-                "id": record.id,
-                "subject": record.subject,
-                "creation_date": record.creation_date,
-                "record": record.record
-            }
-            for record in records
-        ]
-
-        # Fetch bills for the patient, ordered by creation_date
-        bills = Bill.query.filter_by(patient_id=patient.id).order_by(desc(Bill.creation_date)).all()
-        bills_list = [
-            {
-                "id": bill.id,
-                "status": bill.status,
-                "amount": bill.amount,
-                "description": bill.description,
-                "creation_date": bill.creation_date
-            }
-            for bill in bills
-        ]
-
-        results.append({
-            "id": patient.id,
-            "first_name": patient.first_name,
-            "last_name": patient.last_name,
-            "gender": patient.gender,
-            "emergency_contact_phone_number": patient.emergency_contact_phone_number,
-            "date_of_birth": patient.date_of_birth,
-            "email": patient.email,
-            "phone_number": patient.phone_number,
-            "address": patient.address,
-            "records": records_list,
-            "bills": bills_list
-        })
-
-    return jsonify(results), 200
+    # Records and bills are fetched for all patients at once, newest first
+    nested_fields = {'records': ['id', 'subject', 'creation_date']} if summary else None
+    return jsonify(patient_serializer.dump_many(patients, fields, nested_fields=nested_fields)), 200
@@ -0,0 +1,20 @@
+from flask import Blueprint, current_app
+import metrics
+
+metrics_bp = Blueprint('metrics', __name__)
+
+@metrics_bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Prometheus metrics
+    ---
+    tags:
+      - Monitoring
+    produces:
+      - text/plain
+    responses:
+      200:
+        description: Request latency, M-Pesa call, DB pool and cache metrics in Prometheus text format
+    """
+    body = metrics.render(current_app.config['METRICS_DIR'])
+    return current_app.response_class(body, mimetype='text/plain', content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,10 +1,32 @@
-from flask import Blueprint, request, jsonify
-from models import Patient, Doctor, Bill, Record, User
+from flask import Blueprint, request, jsonify, current_app
+from models import Patient, Appointment, Bill, BillArchive, Record, User
 from db import db
-from sqlalchemy import desc
+from datetime import datetime, timezone
+from serializers import patient_serializer, bill_serializer, record_serializer, appointment_serializer
+from middleware.etag import etag_versioned
+from archive import load_with_archive
+import ledger
 
 patients_bp = Blueprint('patients', __name__)
 
+# Fields returned for patients unless ?fields= asks otherwise
+PATIENT_FIELDS = [
+    'id', 'first_name', 'last_name', 'date_of_birth', 'gender', 'phone_number', 'email', 'address',
+    'emergency_contact_phone_number', 'doctor'
+]
+
+# Sections of GET /patients/<id>/chart: (model, serializer, fields, newest-first column)
+CHART_SECTIONS = {
+    'appointments': (Appointment, appointment_serializer, [
+        'id', 'doctor_id', 'appointment_date', 'cost', 'status', 'reason_for_visit', 'notes', 'created_at', 'updated_at'
+    ], 'created_at'),
+    'bills': (Bill, bill_serializer, [
+        'id', 'status', 'amount', 'description', 'creation_date', 'appointment_id', 'transactions'
+    ], 'creation_date'),
+    # Bodies are fetched one at a time via /records/<id>
+    'records': (Record, record_serializer, ['id', 'subject', 'creation_date'], 'creation_date'),
+}
+
 # Endpoint to create a new patient
 @patients_bp.route('/', methods=['POST'])
 def add_patient():
@@ -71,14 +93,16 @@ def add_patient():
         doctor_id=data['doctor_id'],
         emergency_contact_phone_number=data['emergency_contact_phone_number']
     )
-    db.session.add(new_patient)
-    db.session.commit()
-
+    # Hashed before anything is saved, so a busy hashing pool leaves nothing half added
     password = data['first_name'] + "." + data['last_name']
     role = 3
 
     new_user = User(email=email)
     new_user.set_password(password)
+
+    db.session.add(new_patient)
+    db.session.commit()
+
     new_user.set_patient_id(new_patient.id)
     new_user.set_role(role)  
 
@@ -88,12 +112,27 @@ def add_patient():
 
 # Endpoint to fetch all patients
 @patients_bp.route('/', methods=['GET'])
+@etag_versioned('patient', 'doctor')
 def get_patients():
     """
     Get all patients
     ---
     tags:
       - Patients
+    parameters:
+      - name: fields
+        in: query
+        required: false
+        type: string
+        description: Comma-separated list of fields to return (defaults to all)
+      - name: ids
+        in: query
+        required: false
+        type: string
+        description: >
+          Comma-separated ids to fetch. The response is then an object with the
+          matching patients under items, in the order asked for, and the ids that
+          don't exist under missing.
     responses:
       200:
         description: A list of patients
@@ -131,30 +170,44 @@ def get_patients():
                   Phone_Number:
                     type: string
     """
-    patients = Patient.query.all()
-    results = []
-    
-    for patient in patients:
-        doctor = Doctor.query.get(patient.doctor_id)
+    fields = patient_serializer.requested_fields(default=PATIENT_FIELDS)
+    ids = patient_serializer.requested_ids()
+    if ids is not None:
+        patients, missing = patient_serializer.load_by_ids(ids, fields)
+        return jsonify({"items": patient_serializer.dump_many(patients, fields), "missing": missing}), 200
 
-        results.append({
-            "id": patient.id,
-            "first_name": patient.first_name,
-            "last_name": patient.last_name,
-            "date_of_birth": patient.date_of_birth,
-            "gender": patient.gender,
-            "phone_number": patient.phone_number,
-            "email": patient.email,
-            "address": patient.address,
-            "emergency_contact_phone_number": patient.emergency_contact_phone_number,
-            "doctor": {
-                "id": doctor.id,
-                "Name": doctor.title + " " + doctor.surname + " " + doctor.first_name + " (" + doctor.specialization + ")",
-                "Phone_Number": doctor.phone_number_country_code + " " + doctor.phone_number,
-            } if doctor else None
-        })
-    
-    return jsonify(results), 200
+    patients = Patient.query.options(patient_serializer.load_only(fields)).all()
+    return jsonify(patient_serializer.dump_many(patients, fields)), 200
+
+@patients_bp.route('/<int:patient_id>', methods=['GET'])
+@etag_versioned('patient', 'doctor')
+def get_patient(patient_id):
+    """
+    Get a patient
+    ---
+    tags:
+      - Patients
+    parameters:
+      - name: patient_id
+        in: path
+        required: true
+        type: integer
+      - name: fields
+        in: query
+        required: false
+        type: string
+        description: Comma-separated list of fields to return (defaults to all)
+    responses:
+      200:
+        description: The patient, with the same fields as in the patient list
+      404:
+        description: Patient not found
+    """
+    fields = patient_serializer.requested_fields(default=PATIENT_FIELDS)
+    patients, _ = patient_serializer.load_by_ids([patient_id], fields)
+    if not patients:
+        return jsonify({"message": "Patient not found"}), 404
+    return jsonify(patient_serializer.dump(patients[0], fields)), 200
 
 # Endpoint to update patient details
 @patients_bp.route('/<int:patient_id>', methods=['PATCH'])
@@ -234,11 +287,171 @@ def delete_patient(patient_id):
         description: Patient deleted successfully
     """
     patient = Patient.query.get_or_404(patient_id)
-    db.session.delete(patient)
+    # Hidden from now on; `flask purge` removes it and everything that depends on it
+    patient.deleted_at = datetime.utcnow()
     db.session.commit()
     return jsonify({"message": "Patient deleted"}), 204
 
+@patients_bp.route('/<int:patient_id>/chart', methods=['GET'])
+@etag_versioned('patient', 'doctor', 'appointment', 'bills', 'transactions', 'record', cache_ttl='CHART_CACHE_TTL')
+def get_patient_chart(patient_id):
+    """
+    Get a patient's chart
+    ---
+    tags:
+      - Patients
+    description: >
+      Demographics and assigned doctor, the latest appointments, the latest bills
+      with their transactions and the latest records (without bodies), newest
+      first, in a fixed number of queries. Archived history is left out.
+    parameters:
+      - name: patient_id
+        in: path
+        required: true
+        type: integer
+      - name: appointments_limit
+        in: query
+        required: false
+        type: integer
+        description: Most appointments to return (defaults to CHART_SECTION_LIMIT)
+      - name: bills_limit
+        in: query
+        required: false
+        type: integer
+        description: Most bills to return (defaults to CHART_SECTION_LIMIT)
+      - name: records_limit
+        in: query
+        required: false
+        type: integer
+        description: Most records to return (defaults to CHART_SECTION_LIMIT)
+    responses:
+      200:
+        description: The patient's chart
+        schema:
+          type: object
+          properties:
+            patient:
+              type: object
+            appointments:
+              type: array
+              items:
+                type: object
+            bills:
+              type: array
+              items:
+                type: object
+            records:
+              type: array
+              items:
+                type: object
+            has_more:
+              type: object
+              description: Per section, whether there is more than the limit returned
+      400:
+        description: Invalid limit
+      404:
+        description: Patient not found
+    """
+    config = current_app.config
+    limits = {}
+    for section in CHART_SECTIONS:
+        try:
+            limit = int(request.args.get(f'{section}_limit', config['CHART_SECTION_LIMIT']))
+        except ValueError:
+            return jsonify({"error": f"{section}_limit must be an integer"}), 400
+        limits[section] = max(0, min(limit, config['CHART_MAX_SECTION_LIMIT']))
+
+    patients, _ = patient_serializer.load_by_ids([patient_id], PATIENT_FIELDS)
+    if not patients:
+        return jsonify({"message": "Patient not found"}), 404
+    chart = {"patient": patient_serializer.dump(patients[0], PATIENT_FIELDS), "has_more": {}}
+
+    # One query per section off its (patient_id, date) index, plus one for the
+    # bills' transactions
+    for section, (model, serializer, fields, newest) in CHART_SECTIONS.items():
+        rows = []
+        if limits[section]:
+            rows = (model.query.filter_by(patient_id=patient_id).options(serializer.load_only(fields))
+                    .order_by(getattr(model, newest).desc(), model.id.desc()).limit(limits[section] + 1).all())
+        chart["has_more"][section] = len(rows) > limits[section]
+        chart[section] = serializer.dump_many(rows[:limits[section]], fields)
+
+    return jsonify(chart), 200
+
+@patients_bp.route('/<int:patient_id>/balance', methods=['GET'])
+@etag_versioned('patient', 'ledger_entries')
+def get_patient_balance(patient_id):
+    """
+    Get what a patient owes, now or at a point in time
+    ---
+    tags:
+      - Patients
+    description: >
+      The patient's receivable balance in the payment ledger: bills charged, less
+      payments, plus refunds. Read from the latest balance snapshot before the
+      requested time plus the ledger entries since.
+    parameters:
+      - name: patient_id
+        in: path
+        required: true
+        type: integer
+      - name: as_of
+        in: query
+        required: false
+        type: string
+        format: date-time
+        description: ISO 8601 time to get the balance at (UTC unless it has an offset). Defaults to now.
+    responses:
+      200:
+        description: The patient's balance
+        schema:
+          type: object
+          properties:
+            patient_id:
+              type: integer
+              example: 1
+            balance:
+              type: string
+              example: "1500.00"
+            balance_minor:
+              type: integer
+              description: The balance in cents
+              example: 150000
+            entry_id:
+              type: integer
+              description: Last ledger entry counted
+      400:
+        description: Invalid as_of, or one before the patient's ledger history was backfilled
+      404:
+        description: Patient not found
+    """
+    as_of = request.args.get('as_of')
+    if as_of:
+        try:
+            as_of = datetime.fromisoformat(as_of)
+        except ValueError:
+            return jsonify({"error": "as_of must be an ISO 8601 date-time"}), 400
+        if as_of.tzinfo is not None:
+            as_of = as_of.astimezone(timezone.utc).replace(tzinfo=None)
+
+    if db.session.get(Patient, patient_id) is None:
+        return jsonify({"message": "Patient not found"}), 404
+    if as_of:
+        # Older bills and payments were posted by a backfill and are dated from it
+        start = ledger.history_start(patient_id)
+        if start is not None and as_of < start:
+            return jsonify({"error": f"as_of must not be before {start.isoformat()}, "
+                                     "when this patient's ledger history was backfilled"}), 400
+    balance, entry_id = ledger.balance(patient_id, as_of or None)
+    return jsonify({
+        "patient_id": patient_id,
+        "balance": ledger.format_minor(balance),
+        "balance_minor": balance,
+        "entry_id": entry_id,
+    }), 200
+
 @patients_bp.route('/<int:patient_id>/bills', methods=['GET'])
+@etag_versioned('bills', 'bills_archive', 'transactions')
 def get_bills_by_patient(patient_id):
     """
     Get all bills for a patient
@@ -251,6 +464,16 @@ def get_bills_by_patient(patient_id):
         required: true
         type: integer
         description: The ID of the patient to get bills for
+      - name: fields
+        in: query
+        required: false
+        type: string
+        description: Comma-separated list of fields to return (defaults to all)
+      - name: include_archived
+        in: query
+        required: false
+        type: integer
+        description: Set to 1 to include history moved to the archive
     responses:
       200:
         description: A list of bills for the specified patient
@@ -273,27 +496,19 @@ def get_bills_by_patient(patient_id):
       404:
         description: No bills found for this patient
     """
+    fields = bill_serializer.requested_fields(default=['id', 'status', 'creation_date', 'amount', 'description'])
+
     # Query all bills where the patient_id matches
-    bills = Bill.query.filter_by(patient_id=patient_id).order_by(desc(Bill.creation_date)).all()
+    bills = load_with_archive(bill_serializer, fields, BillArchive, order_by='creation_date', patient_id=patient_id)
 
     # Check if any bills are found
     if not bills:
         return jsonify({'message': 'No bills found for this patient'}), 404
 
-    # Prepare the results in JSON format
-    results = []
-    for bill in bills:
-        results.append({
-            "id": bill.id,
-            "status": bill.status,
-            "creation_date": bill.creation_date,
-            "amount": bill.amount,
-            "description": bill.description  # Include the description field
-        })
-
-    return jsonify(results), 200
+    return jsonify(bill_serializer.dump_many(bills, fields)), 200
 
 @patients_bp.route('/<int:patient_id>/records', methods=['GET'])
+@etag_versioned('record')
 def get_records_for_patient(patient_id):
     """
     Get all records for a patient
@@ -306,6 +521,16 @@ def get_records_for_patient(patient_id):
         required: true
         type: integer
         description: The ID of the patient to get records for
+      - name: summary
+        in: query
+        required: false
+        type: boolean
+        description: Only return id, subject and creation_date (bodies are fetched via /records/<id>)
+      - name: fields
+        in: query
+        required: false
+        type: string
+        description: Comma-separated list of fields to return (defaults to all)
     responses:
       200:
         description: A list of records for the specified patient
@@ -326,22 +551,16 @@ def get_records_for_patient(patient_id):
       404:
         description: No records found for this patient
     """
+    summary = request.args.get('summary', '').lower() in ('1', 'true', 'yes')
+    default_fields = ['id', 'subject', 'creation_date'] if summary else ['id', 'subject', 'creation_date', 'record']
+    fields = record_serializer.requested_fields(default=default_fields)
+
     # Query all records where the patient_id matches
-    records = Record.query.filter_by(patient_id=patient_id).all()
+    records = Record.query.filter_by(patient_id=patient_id).options(record_serializer.load_only(fields)).all()
 
     # Check if any records are found
     if not records:
         return jsonify({'message': 'No records found for this patient'}), 404
 
-    # Prepare the results in JSON format
-    results = []
-    for record in records:
-        results.append({
-            "id": record.id,
-            "subject": record.subject,
-            "creation_date": record.creation_date,
-            "record": record.record,
-        })
-
-    return jsonify(results), 200
+    return jsonify(record_serializer.dump_many(records, fields)), 200
 
@@ -1,6 +1,8 @@
 from flask import Blueprint, request, jsonify
 from models import Record
+from serializers import record_serializer
 from db import db
+from middleware.etag import etag_versioned
 
 records_bp = Blueprint('records', __name__)
 
@@ -53,4 +55,49 @@ def add_record():
 
     return jsonify({'message': 'Record added successfully!'}), 200
 
+# Route to fetch a single record including its body
+@records_bp.route('/<int:record_id>', methods=['GET'])
+@etag_versioned('record')
+def get_record(record_id):
+    """
+    Get a single record with its full body
+    ---
+    tags:
+      - Records
+    parameters:
+      - name: record_id
+        in: path
+        required: true
+        type: integer
+        description: The ID of the record to fetch
+      - name: fields
+        in: query
+        required: false
+        type: string
+        description: Comma-separated list of fields to return (defaults to all)
+    responses:
+      200:
+        description: The requested record
+        schema:
+          type: object
+          properties:
+            id:
+              type: integer
+            subject:
+              type: string
+            patient_id:
+              type: integer
+            creation_date:
+              type: string
+              format: date-time
+            record:
+              type: string
+      404:
+        description: Record not found
+    """
+    fields = record_serializer.requested_fields()
+    record = Record.query.options(record_serializer.load_only(fields)).filter_by(id=record_id).first()
+    if not record:
+        return jsonify({'error': 'Record not found'}), 404
 
+    return jsonify(record_serializer.dump(record, fields)), 200
@@ -1,11 +1,17 @@
+from concurrent.futures import ThreadPoolExecutor
 from flask import Blueprint, request, jsonify, current_app
-from db import db
-#import requests
-from models import Transaction, Bill
-import base64
+from db import db, begin_immediate
+from models import Transaction, TransactionArchive, Bill, BillArchive, Patient, ChangeEvent, LedgerEntry
 from datetime import datetime
 import logging
-from sqlalchemy import desc
+from sqlalchemy import insert, select
+from serializers import transaction_serializer
+from middleware.etag import etag_versioned
+from archive import load_with_archive
+from changes import FEED_RESOURCES
+import pubsub
+import mpesa
+import ledger
 
 transactions_bp = Blueprint('transactions', __name__)
 logger = logging.getLogger(__name__)
@@ -72,12 +78,24 @@ def add_transaction():
     return jsonify({"message": "Transaction added", "transaction_id": new_transaction.id}), 201
 
 @transactions_bp.route('/', methods=['GET'])
+@etag_versioned('transactions', 'transactions_archive')
 def get_all_transactions():
     """
     Retrieve all transactions
     ---
     tags:
       - Transactions
+    parameters:
+      - name: fields
+        in: query
+        required: false
+        type: string
+        description: Comma-separated list of fields to return (defaults to all)
+      - name: include_archived
+        in: query
+        required: false
+        type: integer
+        description: Set to 1 to include history moved to the archive
     responses:
       200:
         description: A list of transactions
@@ -114,69 +132,18 @@ def get_all_transactions():
       500:
         description: Internal Server Error
     """
+    fields = transaction_serializer.requested_fields()
     try:
         # Query all transactions from the database
-        transactions = Transaction.query.all()
-
-        # Prepare the transactions list in JSON format
-        transactions_list = [
-            {
-                "id": transaction.id,
-                "checkout_request_id": transaction.checkout_request_id,
-                "bill_id": transaction.bill_id,
-                "status": transaction.status,
-                "amount": transaction.amount,
-                "paying_phone_number": transaction.paying_phone_number,
-                "receipt_number": transaction.receipt_number,
-                "transaction_date": transaction.transaction_date
-            }
-            for transaction in transactions
-        ]
-
-        return jsonify(transactions_list), 200
+        transactions = load_with_archive(transaction_serializer, fields, TransactionArchive)
+
+        return jsonify(transaction_serializer.dump_many(transactions, fields)), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-# Function to get OAuth token
-def get_mpesa_access_token(consumer_key, consumer_secret):
-    api_url = "https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials"
-    r = requests.get(api_url, auth=(consumer_key, consumer_secret))
-    json_response = r.json()
-    access_token = json_response['access_token']
-    return access_token
-
 # Function to initiate STK push
 def stk_push_request(phone_number, amount, bill_id, description):
-    access_token = get_mpesa_access_token(current_app.config['MPESA_CONSUMER_KEY'], current_app.config['MPESA_CONSUMER_SECRET'])
-    api_url = "https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest"
-    
-    headers = {"Authorization": f"Bearer {access_token}"}
-    shortcode = current_app.config['MPESA_SHORTCODE']
-
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    passkey = 'bfb279f9aa9bdbcf158e97dd71a467cd2e0c893059b10f78e6b72ada1ed2c919'
-    data_to_encode = '174379' + passkey + timestamp
-    password = base64.b64encode(data_to_encode.encode('utf-8')).decode('utf-8')
-
-    # STK Push payload
-    payload = {
-        "BusinessShortCode": shortcode,
-        "Password": password,
-        "Timestamp": timestamp,
-        "TransactionType": "CustomerPayBillOnline",
-        "Amount": amount,
-        "PartyA": phone_number,
-        "PartyB": shortcode,
-        "PhoneNumber": phone_number,
-        "CallBackURL": 'https://your_callback_url.com/transactions/callback',
-        "AccountReference": f"{bill_id}_transaction",
-        "TransactionDesc": description
-    }
-
-    logger.info("Payload Data: %s", payload)
-
-    response = requests.post(api_url, json=payload, headers=headers)
-    return response.json()
+    return mpesa.get_client().stk_push(phone_number, amount, f"{bill_id}_transaction", description)
 
 @transactions_bp.route('/deposit', methods=['POST'])
 def initiate_mpesa_payment():
@@ -253,6 +220,291 @@ def initiate_mpesa_payment():
     else:
         return jsonify({"message": "Failed to initiate STK Push", "error": stk_response.get('errorMessage')}), 400
 
+def _bulk_push(client, bill, phone_number, description):
+    try:
+        return client.stk_push(phone_number, bill.amount, f"{bill.id}_transaction", description)
+    except Exception as e:
+        logger.warning("STK push for bill %s failed", bill.id, exc_info=True)
+        return {"errorMessage": str(e)}
+
+def _record_pending(rows):
+    """Insert Pending transactions and commit; {checkout request id: id}.
+
+    One multi-row INSERT for all of them. It bypasses the ORM flush, so the change
+    feed events are added here; RETURNING order isn't guaranteed, hence matching
+    ids by checkout request id."""
+    ids = dict(db.session.execute(
+        insert(Transaction).values(rows).returning(Transaction.checkout_request_id, Transaction.id)
+    ).all())
+    db.session.execute(insert(ChangeEvent), [
+        {'resource': FEED_RESOURCES[Transaction], 'resource_id': transaction_id, 'op': 'created',
+         'changed_at': datetime.utcnow()}
+        for transaction_id in ids.values()
+    ])
+    db.session.commit()
+    return ids
+
+@transactions_bp.route('/deposit/bulk', methods=['POST'])
+def initiate_bulk_mpesa_payments():
+    """
+    Initiate M-Pesa payments for many bills at once
+    ---
+    tags:
+      - Transactions
+    description: >
+      Sends an STK push for each bill, several at a time and paced to the rate M-Pesa
+      allows, and records a Pending transaction for every push M-Pesa accepts. A
+      payment without a phone number is sent to the bill's patient's number.
+    parameters:
+      - name: payments
+        in: body
+        required: true
+        schema:
+          type: object
+          properties:
+            payments:
+              type: array
+              items:
+                type: object
+                properties:
+                  bill_id:
+                    type: integer
+                    example: 1
+                  phone_number:
+                    type: string
+                    example: "254712345678"
+            description:
+              type: string
+              example: "Payment for services"
+    responses:
+      200:
+        description: One outcome per payment, in the same order
+        schema:
+          type: object
+          properties:
+            results:
+              type: array
+              items:
+                type: object
+                properties:
+                  bill_id:
+                    type: integer
+                    example: 1
+                  status:
+                    type: string
+                    description: initiated, failed, not_found, already_paid or duplicate
+                    example: "initiated"
+                  transaction_id:
+                    type: integer
+                    example: 1
+                  error:
+                    type: string
+            initiated:
+              type: integer
+              example: 1
+            failed:
+              type: integer
+              description: Payments not initiated, for whatever reason
+              example: 0
+      400:
+        description: Invalid payments list
+    """
+    data = request.get_json(silent=True) or {}
+    payments = data.get('payments')
+    description = data.get('description', 'Payment')
+    max_bills = current_app.config['MPESA_BULK_MAX_BILLS']
+    if not isinstance(payments, list) or not payments or not all(
+        isinstance(payment, dict) and isinstance(payment.get('bill_id'), int) for payment in payments
+    ):
+        return jsonify({"error": "payments must be a non-empty list of objects with a bill_id"}), 400
+    if len(payments) > max_bills:
+        return jsonify({"error": f"At most {max_bills} payments can be initiated at once"}), 400
+
+    # Every bill, and its patient's phone number, in one query
+    bills = {row.id: row for row in db.session.execute(
+        select(Bill.id, Bill.amount, Bill.status, Patient.phone_number)
+        .outerjoin(Patient, Patient.id == Bill.patient_id)
+        .where(Bill.id.in_({payment['bill_id'] for payment in payments}))
+    )}
+
+    results = [None] * len(payments)
+    pushes = []  # (index, bill, phone number)
+    seen = set()
+    for index, payment in enumerate(payments):
+        bill_id = payment['bill_id']
+        bill = bills.get(bill_id)
+        phone_number = payment.get('phone_number') or (bill.phone_number if bill else None)
+        if bill is None:
+            results[index] = {"bill_id": bill_id, "status": "not_found"}
+        elif bill_id in seen:
+            results[index] = {"bill_id": bill_id, "status": "duplicate"}
+        elif bill.status == 'Paid':
+            results[index] = {"bill_id": bill_id, "status": "already_paid"}
+        elif not phone_number:
+            results[index] = {"bill_id": bill_id, "status": "failed", "error": "No phone number"}
+        else:
+            pushes.append((index, bill, phone_number))
+        seen.add(bill_id)
+
+    # Pushed a chunk at a time, and each chunk's accepted pushes are saved before
+    # the next is sent: a customer who was prompted has a Pending transaction for
+    # the callback and `flask reconcile-mpesa` to find, even if the request dies
+    config = current_app.config
+    client = mpesa.get_client()
+    chunk_size = config['MPESA_BULK_CHUNK_SIZE']
+    workers = max(1, min(config['MPESA_BULK_WORKERS'], len(pushes)))
+    initiated = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in range(0, len(pushes), chunk_size):
+            chunk = pushes[start:start + chunk_size]
+            responses = list(executor.map(
+                lambda push: _bulk_push(client, push[1], push[2], description), chunk
+            ))
+            transaction_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            accepted = []  # (index, transaction row)
+            for (index, bill, phone_number), stk_response in zip(chunk, responses):
+                if stk_response.get('ResponseCode') == '0':
+                    accepted.append((index, {
+                        'checkout_request_id': stk_response.get('CheckoutRequestID'),
+                        'bill_id': bill.id,
+                        'status': "Pending",
+                        'amount': bill.amount,
+                        'paying_phone_number': phone_number,
+                        'transaction_date': transaction_date,
+                    }))
+                else:
+                    results[index] = {"bill_id": bill.id, "status": "failed", "error": stk_response.get('errorMessage')}
+            if not accepted:
+                continue
+
+            try:
+                ids = _record_pending([row for _, row in accepted])
+            except Exception:
+                db.session.rollback()
+                # The customers were prompted all the same; log enough to settle them by hand
+                logger.exception("Could not save transactions for accepted STK pushes %s",
+                                 [(row['bill_id'], row['checkout_request_id']) for _, row in accepted])
+                for index, row in accepted:
+                    results[index] = {"bill_id": row['bill_id'], "status": "failed",
+                                      "error": "Payment request sent but not recorded"}
+                # Prompt nobody else while saving fails
+                for index, bill, _ in pushes[start + chunk_size:]:
+                    results[index] = {"bill_id": bill.id, "status": "failed", "error": "Not sent"}
+                break
+            initiated += len(accepted)
+            for index, row in accepted:
+                results[index] = {"bill_id": row['bill_id'], "status": "initiated",
+                                  "transaction_id": ids[row['checkout_request_id']]}
+
+    failed = sum(1 for result in results if result['status'] != 'initiated')
+    return jsonify({"results": results, "initiated": initiated, "failed": failed}), 200
+
+@transactions_bp.route('/<int:transaction_id>/refund', methods=['POST'])
+def refund_transaction(transaction_id):
+    """
+    Record a refund of a paid transaction
+    ---
+    tags:
+      - Transactions
+    description: >
+      Posts a refund to the payment ledger for money given back to the payer, all of
+      it or part. Once all of it has been refunded the transaction is marked Refunded.
+    parameters:
+      - name: transaction_id
+        in: path
+        required: true
+        type: integer
+      - name: refund
+        in: body
+        required: false
+        schema:
+          type: object
+          properties:
+            amount:
+              type: number
+              example: 500
+              description: Amount refunded (defaults to whatever of the payment is left)
+    responses:
+      201:
+        description: Refund recorded
+        schema:
+          type: object
+          properties:
+            message:
+              type: string
+              example: "Refund recorded"
+            refunded:
+              type: string
+              example: "500.00"
+            status:
+              type: string
+              example: "Paid"
+      400:
+        description: Transaction not paid, or amount invalid or more than is left to refund
+      404:
+        description: Transaction not found
+      409:
+        description: The transaction's bill no longer exists
+    """
+    data = request.get_json(silent=True) or {}
+    # Locked until the commit, so concurrent refunds can't both pass the check
+    # against what is left and together refund more than was paid
+    begin_immediate()
+    transaction = Transaction.query.filter_by(id=transaction_id).with_for_update().first_or_404()
+    if transaction.status != 'Paid':
+        return jsonify({"error": "Only paid transactions can be refunded"}), 400
+
+    remaining = ledger.to_minor(transaction.amount) - ledger.refunded(transaction.id)
+    try:
+        amount = ledger.to_minor(data['amount']) if data.get('amount') is not None else remaining
+    except (ArithmeticError, ValueError, TypeError):
+        return jsonify({"error": "amount must be a number"}), 400
+    if not 0 < amount <= remaining:
+        return jsonify({"error": f"amount must be more than 0 and at most {ledger.format_minor(remaining)}"}), 400
+
+    bill = db.session.get(Bill, transaction.bill_id) or db.session.get(BillArchive, transaction.bill_id)
+    if bill is None:
+        return jsonify({"error": "The bill this transaction paid no longer exists"}), 409
+    db.session.add(LedgerEntry(**ledger.entry('refund', bill.patient_id, amount, bill_id=transaction.bill_id,
+                                               transaction_id=transaction.id)))
+    if amount == remaining:
+        transaction.status = "Refunded"
+    db.session.commit()
+
+    return jsonify({"message": "Refund recorded", "refunded": ledger.format_minor(amount),
+                    "status": transaction.status}), 201
+
+# Live status of a payment, e.g. while waiting for the M-Pesa callback
+@transactions_bp.route('/<int:transaction_id>/events', methods=['GET'])
+def stream_transaction_status(transaction_id):
+    """
+    Stream a transaction's status
+    ---
+    tags:
+      - Transactions
+    produces:
+      - text/event-stream
+    parameters:
+      - name: transaction_id
+        in: path
+        required: true
+        type: integer
+      - name: Last-Event-ID
+        in: header
+        required: false
+        type: integer
+        description: Id of the last event received, to get the ones missed while disconnected
+    responses:
+      200:
+        description: >
+          Server-sent events stream. `transactions` events as the transaction's status changes, e.g. once the M-Pesa callback arrives. Each event's
+          data is the row's current state with `op` set to created or updated.
+      404:
+        description: Transaction not found
+    """
+    Transaction.query.get_or_404(transaction_id)
+    return pubsub.stream([f'transaction:{transaction_id}'])
+
 @transactions_bp.route('/callback', methods=['POST'])
 def mpesa_callback():
     """
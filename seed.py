@@ -0,0 +1,309 @@
+import click
+import random
+import time
+from bisect import bisect
+from itertools import accumulate, chain
+from operator import itemgetter
+from datetime import datetime, timedelta
+from flask.cli import with_appcontext
+from sqlalchemy import func, select, text
+from db import db, create_missing_indexes
+from models import User, Doctor, Patient, Appointment, Bill, Record, Transaction
+from versioning import bump_versions
+
+# Synthetic data for capacity testing, written with bulk Core inserts.
+# Everything is derived from the seed, so the same arguments always produce the
+# same rows (only the password salt differs). All generated users share one
+# password, hashed once up front. Secondary indexes are dropped for the load and
+# rebuilt in one pass at the end, which is much cheaper than updating them row
+# by row; if the seed fails part way, the next app start rebuilds them.
+
+SEEDED = (User, Doctor, Patient, Appointment, Bill, Transaction, Record)
+
+FIRST_NAMES = ['Wanjiru', 'Otieno', 'Achieng', 'Kamau', 'Njeri', 'Mutua', 'Akinyi', 'Kiprop', 'Chebet', 'Omondi',
+               'Wambui', 'Mwangi', 'Atieno', 'Kibet', 'Nyambura', 'Barasa', 'Auma', 'Korir', 'Wairimu', 'Onyango']
+LAST_NAMES = ['Kariuki', 'Odhiambo', 'Mwangi', 'Ochieng', 'Kimani', 'Wekesa', 'Njoroge', 'Cheruiyot', 'Mutiso',
+              'Owino', 'Githinji', 'Rotich', 'Nyongesa', 'Maina', 'Ouma', 'Langat', 'Kamau', 'Okoth', 'Koech', 'Ndungu']
+SPECIALIZATIONS = [('General Practice', 30), ('Pediatrics', 15), ('Obstetrics', 12), ('Surgery', 10),
+                   ('Cardiology', 8), ('Dermatology', 6), ('Orthopedics', 7), ('Oncology', 4), ('Psychiatry', 5),
+                   ('Ophthalmology', 3)]
+REASONS = ['Routine checkup', 'Fever', 'Follow-up', 'Antenatal visit', 'Vaccination', 'Back pain', 'Headache',
+           'Lab results review', 'Chest pain', 'Skin rash', 'Injury', 'Prescription refill']
+APPOINTMENT_STATUSES = [('Completed', 70), ('Scheduled', 20), ('Canceled', 10)]
+COSTS = [(500, 20), (1000, 40), (1500, 15), (2500, 15), (5000, 8), (12000, 2)]
+RECORD_WORDS = ('patient reports symptoms examination shows normal elevated blood pressure temperature '
+                'prescribed medication follow up advised review labs history allergies none known '
+                'vitals stable improving condition referred specialist').split()
+
+
+def _picker(random, values, weights=None):
+    """Return a function picking from values, optionally weighted.
+
+    Cheaper than random.choice()/choices(): a single random() call plus a
+    bisect over precomputed cumulative weights."""
+    values = list(values)
+    if weights is None:
+        count = len(values)
+        return lambda: values[int(random() * count)]
+    cumulative = list(accumulate(weights))
+    total, last = cumulative[-1], len(values) - 1
+    return lambda: values[bisect(cumulative, random() * total, 0, last)]
+
+
+def _phone(random):
+    return f'7{int(random() * 10 ** 8):08d}'
+
+
+def _next_id(connection, model):
+    return (connection.execute(select(func.max(model.id))).scalar() or 0) + 1
+
+
+# Rows per INSERT on positional (SQLite) drivers; well under SQLite's 32766 bound parameters
+ROWS_PER_STATEMENT = 100
+
+
+class _Writer:
+    """Inserts rows with one executemany per batch. Statements are compiled once and
+    only columns whose type needs it (dates, compressed text) go through a bind
+    processor, memoised since generated values repeat a lot. This skips the per-row
+    parameter handling of Connection.execute(), which costs more than the insert.
+
+    On positional drivers each statement inserts ROWS_PER_STATEMENT rows: SQLite
+    runs a statement's setup, and updates sqlite_sequence for AUTOINCREMENT tables,
+    once per execution rather than once per row."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.counts = {}
+        self._statements = {}
+
+    def _statement(self, table, columns):
+        key = (table.name, columns)
+        if key not in self._statements:
+            dialect = self.connection.dialect
+            compiled = table.insert().compile(dialect=dialect, column_keys=list(columns))
+            keys = compiled.positiontup if compiled.positional else columns
+            processors = []
+            for i, name in enumerate(keys):
+                processor = table.c[name].type.dialect_impl(dialect).bind_processor(dialect)
+                if processor is not None:
+                    processors.append((i, processor, {}))
+            multirow = None
+            if compiled.positional:
+                placeholders = compiled.string[compiled.string.rindex('('):]
+                multirow = compiled.string + f', {placeholders}' * (ROWS_PER_STATEMENT - 1)
+            self._statements[key] = compiled, multirow, tuple(keys), processors
+        return self._statements[key]
+
+    def flush(self, model, rows):
+        if not rows:
+            return
+        table = model.__table__
+        compiled, multirow, keys, processors = self._statement(table, tuple(rows[0]))
+        values = list(map(itemgetter(*keys), rows))
+        if processors:
+            # A column at a time, so the per-value work runs in map() rather than a Python loop
+            columns = list(zip(*values))
+            for i, processor, memo in processors:
+                column = columns[i]
+                for value in set(column).difference(memo):
+                    memo[value] = processor(value)
+                columns[i] = map(memo.__getitem__, column)
+            values = list(zip(*columns))
+        if multirow:
+            full = len(values) - len(values) % ROWS_PER_STATEMENT
+            if full:
+                self.connection.exec_driver_sql(multirow, [
+                    tuple(chain.from_iterable(values[i:i + ROWS_PER_STATEMENT]))
+                    for i in range(0, full, ROWS_PER_STATEMENT)
+                ])
+            values = values[full:]
+        else:
+            values = [dict(zip(keys, row)) for row in values]
+        if values:
+            self.connection.exec_driver_sql(compiled.string, values)
+        self.counts[table.name] = self.counts.get(table.name, 0) + len(rows)
+        rows.clear()
+
+
+def generate(connection, doctors, patients, appointments_per_patient, record_ratio, days, start, password_hash,
+             seed, batch_size):
+    rng = random.Random(seed)
+    random_ = rng.random
+    writer = _Writer(connection)
+    first_name = _picker(random_, FIRST_NAMES)
+    last_name = _picker(random_, LAST_NAMES)
+    gender = _picker(random_, ['Male', 'Female'])
+    specialization = _picker(random_, *zip(*SPECIALIZATIONS))
+    status = _picker(random_, *zip(*APPOINTMENT_STATUSES))
+    cost = _picker(random_, *zip(*COSTS))
+    reason = _picker(random_, REASONS)
+    town = _picker(random_, ['Nairobi', 'Mombasa', 'Kisumu', 'Nakuru', 'Eldoret'])
+
+    user_id = _next_id(connection, User)
+    doctor_id = first_doctor = _next_id(connection, Doctor)
+    patient_id = _next_id(connection, Patient)
+    appointment_id = _next_id(connection, Appointment)
+    bill_id = _next_id(connection, Bill)
+    transaction_id = _next_id(connection, Transaction)
+    record_id = _next_id(connection, Record)
+
+    users, rows = [], []
+    for _ in range(doctors):
+        first, last = first_name(), last_name()
+        email = f'{first}.{last}.{doctor_id}@doctors.seed'.lower()
+        rows.append({
+            'id': doctor_id, 'title': 'Dr.', 'first_name': first, 'surname': last, 'gender': gender(),
+            'date_of_birth': f'{rng.randint(1955, 1995)}-01-01', 'specialization': specialization(),
+            'phone_number_country_code': '+254', 'phone_number': _phone(random_), 'email': email,
+            'address': 'Nairobi', 'years_of_experience': int(rng.triangular(1, 35, 8)), 'qualifications': '["MBChB"]',
+            'start_of_employment': f'{rng.randint(2000, 2023)}-01-01', 'emergency_contact': '0700000000',
+            'emergency_contact_country_code': '+254',
+        })
+        users.append({'id': user_id, 'email': email, 'password_hash': password_hash,
+                      'doctor_id': str(doctor_id), 'role': 2})
+        user_id += 1
+        doctor_id += 1
+        if len(rows) >= batch_size:
+            writer.flush(Doctor, rows)
+            writer.flush(User, users)
+    writer.flush(Doctor, rows)
+    writer.flush(User, users)
+
+    # A few doctors carry most of the patient load
+    doctor_ids = list(range(first_doctor, doctor_id))
+    doctor_weights = [1 / (rank + 1) ** 0.8 for rank in range(len(doctor_ids))]
+    rng.shuffle(doctor_weights)
+    busy_doctor = _picker(random_, doctor_ids, doctor_weights)
+    any_doctor = _picker(random_, doctor_ids)
+
+    # Visits are booked in 15 minute slots, 08:00 to 18:00
+    slot = _picker(random_, [
+        start + timedelta(days=day, minutes=8 * 60 + 15 * index) for day in range(days) for index in range(40)
+    ])
+    # Note bodies come from a pool with log-normal lengths; building one per row is the slow part
+    note = _picker(random_, [
+        ' '.join(rng.choices(RECORD_WORDS, k=max(int(rng.lognormvariate(4, 0.8)), 3))) for _ in range(1024)
+    ])
+
+    patient_rows, appointment_rows, bill_rows, transaction_rows, record_rows = [], [], [], [], []
+    for _ in range(patients):
+        first, last = first_name(), last_name()
+        email = f'{first}.{last}.{patient_id}@patients.seed'.lower()
+        own_doctor = busy_doctor()
+        patient_rows.append({
+            'id': patient_id, 'first_name': first, 'last_name': last,
+            'date_of_birth': f'{1940 + int(random_() * 84)}-{1 + int(random_() * 12):02d}-{1 + int(random_() * 28):02d}',
+            'gender': gender(), 'phone_number': _phone(random_), 'email': email, 'address': town(),
+            'doctor_id': own_doctor, 'emergency_contact_phone_number': _phone(random_),
+        })
+        users.append({'id': user_id, 'email': email, 'password_hash': password_hash,
+                      'patient_id': str(patient_id), 'role': 3})
+        user_id += 1
+
+        # Visits per patient are geometrically distributed around the requested mean
+        visits = int(rng.expovariate(1 / appointments_per_patient)) if appointments_per_patient else 0
+        for _ in range(visits):
+            created_at = slot()
+            visit_status = status()
+            visit_cost = cost()
+            appointment_rows.append({
+                'id': appointment_id, 'patient_id': patient_id,
+                'doctor_id': own_doctor if random_() < 0.8 else any_doctor(), 'cost': visit_cost,
+                'appointment_date': (created_at + timedelta(days=int(random_() * 15))).date().isoformat(),
+                'status': visit_status, 'reason_for_visit': reason(), 'notes': '',
+                'created_at': created_at, 'updated_at': created_at,
+            })
+
+            paid = visit_status == 'Completed' and random_() < 0.8
+            bill_rows.append({
+                'id': bill_id, 'status': 'Paid' if paid else 'Pending', 'patient_id': patient_id,
+                'appointment_id': appointment_id, 'transaction_id': transaction_id if paid else None,
+                'creation_date': created_at, 'amount': float(visit_cost),
+                'description': f'Bill for appointment {appointment_id}',
+            })
+            if paid or random_() < 0.1:
+                transaction_rows.append({
+                    'id': transaction_id, 'checkout_request_id': f'ws_CO_seed_{seed}_{transaction_id}',
+                    'bill_id': bill_id, 'status': 'Paid' if paid else 'Pending', 'amount': float(visit_cost),
+                    'paying_phone_number': f'254{_phone(random_)}',
+                    'receipt_number': f'S{seed}X{transaction_id}' if paid else None,
+                    'transaction_date': str(created_at + timedelta(minutes=1 + int(random_() * 600))),
+                })
+                transaction_id += 1
+
+            if visit_status == 'Completed' and random_() < record_ratio:
+                record_rows.append({
+                    'id': record_id, 'subject': reason(), 'patient_id': patient_id,
+                    'creation_date': created_at, 'record': note(),
+                })
+                record_id += 1
+
+            appointment_id += 1
+            bill_id += 1
+
+        patient_id += 1
+        if len(patient_rows) >= batch_size:
+            writer.flush(Patient, patient_rows)
+            writer.flush(User, users)
+        if len(appointment_rows) >= batch_size:
+            writer.flush(Appointment, appointment_rows)
+            writer.flush(Bill, bill_rows)
+            writer.flush(Transaction, transaction_rows)
+            writer.flush(Record, record_rows)
+
+    for model, remaining in ((Patient, patient_rows), (User, users), (Appointment, appointment_rows),
+                             (Bill, bill_rows), (Transaction, transaction_rows), (Record, record_rows)):
+        writer.flush(model, remaining)
+    return writer.counts
+
+
+@click.command('seed')
+@click.option('--doctors', default=100, show_default=True)
+@click.option('--patients', default=10000, show_default=True)
+@click.option('--appointments-per-patient', default=4.0, show_default=True, help='Mean visits per patient.')
+@click.option('--record-ratio', default=0.6, show_default=True, help='Share of completed visits with a record.')
+@click.option('--days', default=730, show_default=True, help='How far back the generated history goes.')
+@click.option('--start', default='2023-01-01', show_default=True, help='Date the history starts at.')
+@click.option('--password', default='password', show_default=True, help='Password of every generated user.')
+@click.option('--seed', 'seed_value', default=1, show_default=True, help='Random seed; same seed, same data.')
+@click.option('--batch-size', default=10000, show_default=True)
+@with_appcontext
+def seed_command(doctors, patients, appointments_per_patient, record_ratio, days, start, password, seed_value,
+                 batch_size):
+    """Generate a synthetic hospital for capacity testing."""
+    template = User(email='')
+    template.set_password(password)
+
+    started = time.perf_counter()
+    with db.engine.connect() as connection:
+        sqlite = connection.dialect.name == 'sqlite'
+        if sqlite:
+            # Durability isn't needed for throwaway data. Only this connection is
+            # affected, and SQLite won't change it inside a transaction.
+            synchronous = connection.execute(text('PRAGMA synchronous')).scalar()
+            connection.execute(text('PRAGMA synchronous = OFF'))
+            connection.commit()
+        # Unique indexes stay, they are constraints
+        for model in SEEDED:
+            for index in model.__table__.indexes:
+                if not index.unique:
+                    index.drop(connection, checkfirst=True)
+        connection.commit()
+        counts = generate(
+            connection, doctors, patients, appointments_per_patient, record_ratio, days,
+            datetime.strptime(start, '%Y-%m-%d'), template.password_hash, seed_value, batch_size,
+        )
+        bump_versions(connection, counts)
+        connection.commit()
+        create_missing_indexes(connection)
+        connection.commit()
+        if sqlite:
+            connection.execute(text(f'PRAGMA synchronous = {int(synchronous)}'))
+            connection.commit()
+    elapsed = time.perf_counter() - started
+
+    total = sum(counts.values())
+    for table, count in sorted(counts.items()):
+        click.echo(f'{table:<14}{count:>12,}')
+    click.echo(f'{total:,} rows in {elapsed:.1f}s ({total / elapsed:,.0f} rows/s)')
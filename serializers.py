@@ -0,0 +1,224 @@
+import json
+from flask import request
+from sqlalchemy.orm import load_only
+from werkzeug.exceptions import BadRequest
+from models import Doctor, Patient, Appointment, Record, Bill, Transaction
+
+# Keep IN (...) lists well below SQLite's bound parameter limit
+IN_CHUNK_SIZE = 500
+
+# Most ids one ?ids= multi-get may ask for
+MAX_REQUESTED_IDS = 1000
+
+
+class SelectionError(BadRequest):
+    """Raised when ?fields= or ?ids= can't be honoured; answered with a 400."""
+
+
+class FieldSelectionError(SelectionError):
+    """Raised when ?fields= names a field the serializer doesn't know about."""
+
+
+class IdSelectionError(SelectionError):
+    """Raised when ?ids= isn't a list of integer ids, or is too long."""
+
+
+class Field:
+    """A response field read from one or more model columns."""
+
+    def __init__(self, *attrs, getter=None):
+        self.attrs = attrs
+        self.getter = getter
+
+    def value(self, obj):
+        if self.getter is not None:
+            return self.getter(obj)
+        return getattr(obj, self.attrs[0])
+
+
+class Nested:
+    """Many-to-one field, e.g. an appointment's patient, loaded with one IN query."""
+
+    def __init__(self, key, serializer, fields):
+        self.attrs = (key,)
+        self.key = key
+        self.serializer = serializer
+        self.fields = fields
+
+    def resolve(self, objs, fields):
+        ids = {getattr(obj, self.key) for obj in objs} - {None}
+        model = self.serializer.model
+        by_id = {}
+        for chunk in _chunks(sorted(ids)):
+            query = model.query.filter(model.id.in_(chunk)).options(self.serializer.load_only(fields))
+            for row in query:
+                by_id[row.id] = self.serializer.dump(row, fields)
+        return {id(obj): by_id.get(getattr(obj, self.key)) for obj in objs}
+
+
+class NestedList:
+    """One-to-many field, e.g. a patient's bills, loaded with one IN query."""
+
+    def __init__(self, foreign_key, serializer, fields, order_by=None):
+        self.attrs = ('id',)
+        self.foreign_key = foreign_key
+        self.serializer = serializer
+        self.fields = fields
+        self.order_by = order_by
+
+    def resolve(self, objs, fields):
+        model = self.serializer.model
+        fk = getattr(model, self.foreign_key)
+        grouped = {obj.id: [] for obj in objs}
+        for chunk in _chunks(sorted(grouped)):
+            query = model.query.filter(fk.in_(chunk)).options(
+                self.serializer.load_only(fields, extra=(self.foreign_key,))
+            )
+            if self.order_by is not None:
+                query = query.order_by(self.order_by)
+            for row in query:
+                grouped[getattr(row, self.foreign_key)].append(self.serializer.dump(row, fields))
+        return {id(obj): grouped[obj.id] for obj in objs}
+
+
+class Serializer:
+    """Turns model instances into response dicts, limited to the requested fields."""
+
+    def __init__(self, model, fields):
+        self.model = model
+        self.fields = fields
+
+    def requested_fields(self, default=None):
+        """Field names from ?fields=, or the route's default field list."""
+        raw = request.args.get('fields')
+        if not raw:
+            return list(default or self.fields)
+
+        names = [name.strip() for name in raw.split(',') if name.strip()]
+        unknown = [name for name in names if name not in self.fields]
+        if unknown:
+            raise FieldSelectionError(f"Unknown fields: {', '.join(unknown)}")
+        return names
+
+    def requested_ids(self):
+        """Ids from ?ids=1,2,3 in the order given, without repeats, or None if
+        the request doesn't ask for specific ids."""
+        raw = request.args.get('ids')
+        if raw is None:
+            return None
+        try:
+            ids = [int(value) for value in raw.split(',') if value.strip()]
+        except ValueError:
+            raise IdSelectionError("ids must be a comma-separated list of integers")
+        ids = list(dict.fromkeys(ids))
+        if len(ids) > MAX_REQUESTED_IDS:
+            raise IdSelectionError(f"At most {MAX_REQUESTED_IDS} ids can be requested at once")
+        return ids
+
+    def load_by_ids(self, ids, names, models=None):
+        """(rows in the order of ids, ids with no row), with one IN query per chunk
+        of ids. models defaults to the serializer's; with several (e.g. its archive
+        table too), ids not found in one are looked up in the next."""
+        found = {}
+        for model in models or [self.model]:
+            remaining = sorted(set(ids) - found.keys())
+            for chunk in _chunks(remaining):
+                query = model.query.filter(model.id.in_(chunk)).options(
+                    self.load_only(names, extra=('id',), model=model)
+                )
+                found.update((row.id, row) for row in query)
+        return [found[id_] for id_ in ids if id_ in found], [id_ for id_ in ids if id_ not in found]
+
+    def load_only(self, names, extra=(), model=None):
+        """Loader option restricting the SELECT to the columns the fields need.
+        model defaults to the serializer's, pass another with the same columns
+        (e.g. its archive table) to load that instead."""
+        model = model or self.model
+        attrs = set(extra)
+        for name in names:
+            attrs.update(self.fields[name].attrs)
+        return load_only(*[getattr(model, attr) for attr in sorted(attrs)])
+
+    def dump(self, obj, names):
+        return self.dump_many([obj], names)[0]
+
+    def dump_many(self, objs, names, nested_fields=None):
+        nested_fields = nested_fields or {}
+        resolved = {}
+        for name in names:
+            field = self.fields[name]
+            if isinstance(field, (Nested, NestedList)):
+                resolved[name] = field.resolve(objs, nested_fields.get(name, field.fields)) if objs else {}
+
+        results = []
+        for obj in objs:
+            data = {}
+            for name in names:
+                if name in resolved:
+                    data[name] = resolved[name][id(obj)]
+                else:
+                    data[name] = self.fields[name].value(obj)
+            results.append(data)
+        return results
+
+
+def _chunks(values):
+    for start in range(0, len(values), IN_CHUNK_SIZE):
+        yield values[start:start + IN_CHUNK_SIZE]
+
+
+def _columns(*names):
+    return {name: Field(name) for name in names}
+
+
+doctor_serializer = Serializer(Doctor, {
+    **_columns('id', 'title', 'first_name', 'surname', 'gender', 'date_of_birth', 'specialization',
+               'phone_number_country_code', 'phone_number', 'email', 'address', 'years_of_experience'),
+    # Stored as a JSON string, returned as a list
+    'qualifications': Field('qualifications', getter=lambda doctor: json.loads(doctor.qualifications)),
+    **_columns('start_of_employment', 'emergency_contact', 'emergency_contact_country_code'),
+})
+
+# Short doctor form nested into patient listings
+doctor_contact_serializer = Serializer(Doctor, {
+    'id': Field('id'),
+    'Name': Field('title', 'surname', 'first_name', 'specialization', getter=lambda doctor: (
+        doctor.title + " " + doctor.surname + " " + doctor.first_name + " (" + doctor.specialization + ")"
+    )),
+    'Phone_Number': Field('phone_number_country_code', 'phone_number', getter=lambda doctor: (
+        doctor.phone_number_country_code + " " + doctor.phone_number
+    )),
+})
+
+record_serializer = Serializer(Record, _columns('id', 'subject', 'patient_id', 'creation_date', 'record'))
+
+transaction_serializer = Serializer(Transaction, _columns(
+    'id', 'checkout_request_id', 'bill_id', 'status', 'amount', 'paying_phone_number', 'receipt_number',
+    'transaction_date'
+))
+
+bill_serializer = Serializer(Bill, {
+    **_columns('id', 'status', 'patient_id', 'appointment_id', 'transaction_id', 'creation_date', 'amount',
+               'description'),
+    'transactions': NestedList('bill_id', transaction_serializer, [
+        'id', 'status', 'amount', 'receipt_number', 'transaction_date'
+    ], order_by=Transaction.id),
+})
+
+patient_serializer = Serializer(Patient, {
+    **_columns('id', 'first_name', 'last_name', 'date_of_birth', 'gender', 'phone_number', 'email', 'address',
+               'doctor_id', 'emergency_contact_phone_number'),
+    'doctor': Nested('doctor_id', doctor_contact_serializer, ['id', 'Name', 'Phone_Number']),
+    'records': NestedList('patient_id', record_serializer, ['id', 'subject', 'creation_date', 'record'],
+                          order_by=Record.creation_date.desc()),
+    'bills': NestedList('patient_id', bill_serializer, ['id', 'status', 'amount', 'description', 'creation_date'],
+                        order_by=Bill.creation_date.desc()),
+})
+
+appointment_serializer = Serializer(Appointment, {
+    **_columns('id', 'patient_id', 'doctor_id', 'appointment_date', 'cost', 'status', 'reason_for_visit', 'notes',
+               'created_at', 'updated_at'),
+    'patient': Nested('patient_id', patient_serializer, [
+        'id', 'first_name', 'last_name', 'email', 'phone_number', 'emergency_contact_phone_number'
+    ]),
+})
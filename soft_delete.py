@@ -0,0 +1,117 @@
+import click
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import String, and_, cast, delete, event, func, insert, literal, select, update
+from sqlalchemy.orm import Session, with_loader_criteria
+from db import db
+from models import (Appointment, AppointmentArchive, Bill, BillArchive, ChangeEvent, Doctor, Patient, Record,
+                    Transaction, TransactionArchive, User)
+from changes import FEED_RESOURCES
+from versioning import bump_versions
+
+# Soft delete. DELETE /patients/<id> and /doctors/<id> only set deleted_at, and
+# every ORM SELECT leaves those rows out (pass the execution option
+# include_deleted=True to see them). `flask purge` later removes them together
+# with the rows that hang off them, in set-based batches.
+
+SOFT_DELETED = (Patient, Doctor)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _hide_soft_deleted(orm_execute_state):
+    if (orm_execute_state.is_select and not orm_execute_state.is_column_load
+            and not orm_execute_state.execution_options.get('include_deleted')):
+        orm_execute_state.statement = orm_execute_state.statement.options(*(
+            with_loader_criteria(model, lambda cls: cls.deleted_at.is_(None), include_aliases=True)
+            for model in SOFT_DELETED
+        ))
+
+
+def purge_steps(cutoff):
+    """(table, condition, values) in the order they run: dependent rows first, the
+    deleted patients and doctors last. values updates the matching rows instead
+    of deleting them, for rows that outlive what they point at."""
+    patients = select(Patient.id).where(Patient.deleted_at < cutoff)
+    doctors = select(Doctor.id).where(Doctor.deleted_at < cutoff)
+    # Either side of a link may have been archived without the other
+    patient_bills = select(Bill.id).where(Bill.patient_id.in_(patients)).union(
+        select(BillArchive.id).where(BillArchive.patient_id.in_(patients)))
+    doctor_appointments = select(Appointment.id).where(Appointment.doctor_id.in_(doctors)).union(
+        select(AppointmentArchive.id).where(AppointmentArchive.doctor_id.in_(doctors)))
+    return [
+        # A patient's history goes with them
+        (Transaction, Transaction.bill_id.in_(patient_bills), None),
+        (TransactionArchive, TransactionArchive.bill_id.in_(patient_bills), None),
+        (Bill, Bill.patient_id.in_(patients), None),
+        (BillArchive, BillArchive.patient_id.in_(patients), None),
+        (Appointment, Appointment.patient_id.in_(patients), None),
+        (AppointmentArchive, AppointmentArchive.patient_id.in_(patients), None),
+        (Record, Record.patient_id.in_(patients), None),
+        (User, User.patient_id.in_(select(cast(Patient.id, String)).where(Patient.deleted_at < cutoff)), None),
+        (Patient, Patient.deleted_at < cutoff, None),
+        # A doctor's appointments go, their patients and the patients' bills stay
+        (Patient, Patient.doctor_id.in_(doctors), {'doctor_id': None}),
+        (Bill, Bill.appointment_id.in_(doctor_appointments), {'appointment_id': None}),
+        (BillArchive, BillArchive.appointment_id.in_(doctor_appointments), {'appointment_id': None}),
+        (Appointment, Appointment.doctor_id.in_(doctors), None),
+        (AppointmentArchive, AppointmentArchive.doctor_id.in_(doctors), None),
+        (User, User.doctor_id.in_(select(cast(Doctor.id, String)).where(Doctor.deleted_at < cutoff)), None),
+        (Doctor, Doctor.deleted_at < cutoff, None),
+    ]
+
+
+def purge_rows(connection, model, condition, values, batch_size):
+    """Delete (or update with values) the matching rows in batches of ascending
+    id, one short transaction each, recording them in the change feed. Returns
+    the number of rows affected."""
+    table = model.__table__
+    resource = FEED_RESOURCES.get(model)
+    affected = 0
+    while True:
+        ids = connection.execute(
+            select(table.c.id).where(condition).order_by(table.c.id).limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            return affected
+        batch = and_(condition, table.c.id.between(ids[0], ids[-1]))
+        if resource is not None:
+            connection.execute(insert(ChangeEvent).from_select(
+                ['resource', 'resource_id', 'op', 'changed_at'],
+                select(literal(resource), table.c.id, literal('deleted' if values is None else 'updated'),
+                       literal(datetime.utcnow())).where(batch),
+            ))
+        if values is None:
+            connection.execute(delete(table).where(batch))
+        else:
+            connection.execute(update(table).where(batch).values(**values))
+        bump_versions(connection, [table.name])
+        connection.commit()
+        affected += len(ids)
+
+
+@click.command('purge')
+@click.option('--grace-days', type=float, help='Only purge rows deleted this long ago. Defaults to PURGE_GRACE_DAYS.')
+@click.option('--batch-size', type=int, help='Rows per transaction. Defaults to PURGE_BATCH_SIZE.')
+@click.option('--dry-run', is_flag=True, help='Only count what would be purged.')
+@with_appcontext
+def purge_command(grace_days, batch_size, dry_run):
+    """Remove soft-deleted patients and doctors and the rows that depend on them."""
+    config = current_app.config
+    cutoff = datetime.utcnow() - timedelta(days=grace_days if grace_days is not None else config['PURGE_GRACE_DAYS'])
+    batch_size = batch_size or config['PURGE_BATCH_SIZE']
+
+    started = time.perf_counter()
+    with db.engine.connect() as connection:
+        for model, condition, values in purge_steps(cutoff):
+            action = 'delete' if values is None else 'update'
+            if dry_run:
+                count = connection.execute(
+                    select(func.count()).select_from(model.__table__).where(condition)
+                ).scalar()
+            else:
+                count = purge_rows(connection, model, condition, values, batch_size)
+            click.echo(f'{action:<8}{model.__tablename__:<22}{count:>10,}')
+    if not dry_run:
+        click.echo(f'Purged rows deleted before {cutoff:%Y-%m-%d %H:%M} UTC in {time.perf_counter() - started:.1f}s')
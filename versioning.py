@@ -0,0 +1,51 @@
+from sqlalchemy import event, update, insert, select
+from sqlalchemy.orm import Session
+from models import ResourceVersion
+
+# Per-table version counters. Every flush or ORM-level INSERT/UPDATE/DELETE
+# bumps the counters of the tables it touched, inside the same transaction, so
+# the counters are shared by all workers and never run ahead of the data.
+
+
+def bump_versions(connection, tables):
+    tables = sorted(set(tables) - {ResourceVersion.__tablename__})
+    if not tables:
+        return
+    result = connection.execute(
+        update(ResourceVersion).where(ResourceVersion.name.in_(tables))
+        .values(version=ResourceVersion.version + 1)
+    )
+    if result.rowcount < len(tables):
+        # First write to a table since the counters were created
+        existing = set(connection.execute(
+            select(ResourceVersion.name).where(ResourceVersion.name.in_(tables))
+        ).scalars())
+        connection.execute(insert(ResourceVersion), [
+            {'name': name, 'version': 1} for name in tables if name not in existing
+        ])
+
+
+def get_versions(session, tables):
+    rows = session.execute(
+        select(ResourceVersion.name, ResourceVersion.version).where(ResourceVersion.name.in_(tables))
+    )
+    versions = dict(rows.all())
+    return [versions.get(name, 0) for name in tables]
+
+
+@event.listens_for(Session, 'after_flush')
+def _bump_after_flush(session, flush_context):
+    tables = {obj.__table__.name for obj in list(session.new) + list(session.dirty) + list(session.deleted)
+              if hasattr(obj, '__table__')}
+    if tables:
+        bump_versions(session.connection(), tables)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _bump_after_bulk_statement(orm_execute_state):
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete):
+        return None
+    table = orm_execute_state.statement.table
+    result = orm_execute_state.invoke_statement()
+    bump_versions(orm_execute_state.session.connection(), [table.name])
+    return result